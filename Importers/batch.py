@@ -0,0 +1,267 @@
+"""Parallel extraction of many statements at once.
+
+Usage: python Importers/batch.py my.config Csv/ [Csv/2018-*.csv ...]
+
+Each input file is identified and extracted by the importers of the config in
+a process pool, then written to its own .beancount file in the output
+directory, named after the input like the files of Data/. The include list of
+the top-level ledger is updated with the new files, and only then are the
+rows recorded as imported in the fingerprint indexes. With --dedup, the
+transactions reported by several statements of the batch are flagged or
+merged first, see dedup.py.
+"""
+__copyright__ = "Copyright (C) 2018 Dongchao Li"
+__license__ = "GNU GPLv2"
+
+import argparse
+import concurrent.futures
+import datetime
+import glob
+import io
+import logging
+import os
+from os import path
+
+from beancount.core import data
+from beancount.ingest import cache
+from beancount.ingest import extract
+from beancount.ingest import identify
+
+import beanmaker
+import columnar
+import dedup
+import snapshot
+from fingerprint import commit_claims, deferred_commits, release_claims
+from ledger import ShardedLedger, update_include_file, write_atomically
+from registry import ImporterRegistry
+
+# The importers of the config, and whether to use the columnar backend, set
+# once in each worker process.
+_IMPORTERS = None
+_COLUMNAR = False
+
+
+def load_importers(config_filename):
+    """Get the list of importers of a config file, from its snapshot if possible.
+
+    Args:
+      config_filename: A path string, the name of a config like my.config.
+    Returns:
+      An ImporterRegistry of the importers of the CONFIG list of the config.
+    Raises:
+      snapshot.ConfigError: If the importers of the config are invalid.
+    """
+    return snapshot.load_config(config_filename)
+
+
+def find_files(files_or_directories):
+    """Expand a list of files, directories and glob patterns into CSV files.
+
+    Args:
+      files_or_directories: A list of path strings or glob patterns.
+    Returns:
+      A sorted list of absolute file names, without duplicates.
+    """
+    filenames = set()
+    for pattern in files_or_directories:
+        for name in glob.glob(pattern) or [pattern]:
+            if path.isdir(name):
+                filenames.update(path.join(name, child)
+                                 for child in os.listdir(name)
+                                 if child.lower().endswith('.csv'))
+            elif path.isfile(name):
+                filenames.add(name)
+    return sorted(path.abspath(filename) for filename in filenames)
+
+
+def _init_worker(config_filename, columnar=False):
+    global _IMPORTERS, _COLUMNAR
+    _IMPORTERS = load_importers(config_filename)
+    _COLUMNAR = columnar
+
+
+def _extract_from_file(filename, importer):
+    if not _COLUMNAR:
+        return extract.extract_from_file(filename, importer)
+    entries = columnar.extract(importer, cache.get_file(filename))
+    entries.sort(key=data.entry_sortkey)
+    return entries
+
+
+def extract_file(filename, importers=None):
+    """Identify a file and extract it with every importer which matched.
+
+    Args:
+      filename: An absolute path string.
+      importers: An ImporterRegistry or a list of importers, the ones of the
+        worker by default.
+    Returns:
+      A triple of the file name, the list of its entries, sorted by date, and
+      the claims of its rows in the fingerprint indexes of the importers. The
+      list is None if no importer identified the file. The claims are to be
+      given to commit_claims() once the entries are written, or to
+      release_claims() if they cannot be.
+    """
+    file = cache.get_file(filename)
+    registry = importers or _IMPORTERS
+    if not isinstance(registry, ImporterRegistry):
+        registry = ImporterRegistry(registry)
+    matched = registry.match(file)
+    if not matched:
+        return filename, None, []
+    entries = []
+    with deferred_commits() as claims:
+        try:
+            for importer in matched:
+                entries.extend(_extract_from_file(filename, importer))
+        except BaseException:
+            release_claims(claims)
+            raise
+        finally:
+            beanmaker.clear_parsed_cache()
+    entries.sort(key=data.entry_sortkey)
+    return filename, entries, claims
+
+
+def output_name(filename, output_dir):
+    """Get the name of the .beancount file written for an input file.
+
+    Args:
+      filename: A path string of a statement, like 'Csv/2018-01-2.csv'.
+      output_dir: A path string of the output directory, like 'Data'.
+    Returns:
+      A path string, like 'Data/2018-01-2.beancount'.
+    """
+    return path.join(output_dir,
+                     '{}.beancount'.format(path.splitext(path.basename(filename))[0]))
+
+
+def format_entries(source, entries):
+    """Render extracted entries like bean-extract does.
+
+    Args:
+      source: A path string, the statement the entries come from.
+      entries: A list of directives.
+    Returns:
+      A string, the contents of a .beancount file.
+    """
+    outfile = io.StringIO()
+    outfile.write(extract.HEADER)
+    outfile.write(identify.SECTION.format(source))
+    outfile.write('\n')
+    extract.print_extracted_entries(entries, outfile)
+    return outfile.getvalue()
+
+
+def write_entries(filename, source, entries):
+    """Write extracted entries like bean-extract does, atomically.
+
+    Args:
+      filename: A path string, the .beancount file to write.
+      source: A path string, the statement the entries come from.
+      entries: A list of directives.
+    """
+    write_atomically(filename, format_entries(source, entries))
+
+
+def run(config_filename, files_or_directories, output_dir, include_filename=None,
+        jobs=None, columnar=False, sharded=False, dedup_mode=None):
+    """Extract many files in parallel and write one .beancount file per input.
+
+    With sharded, the entries are appended to the per-account, per-month
+    shards of a ShardedLedger in the output directory instead.
+
+    Args:
+      config_filename: A path string, the name of a config like my.config.
+      files_or_directories: A list of path strings or glob patterns.
+      output_dir: A path string, the directory of the .beancount files.
+      include_filename: An optional path string, a ledger whose include list
+        is updated with the written files.
+      jobs: The number of worker processes, the number of CPUs by default.
+      columnar: Whether to extract through the columnar backend.
+      sharded: Whether to write to shards instead of one file per input.
+      dedup_mode: None, or 'flag' or 'merge' to flag or remove the
+        transactions reported by several inputs. Flagged duplicates are
+        written commented out, and not written to shards.
+    Returns:
+      A list of (input file name, output file name, entries) triples, in
+      date order of their first entries. The output file name is the output
+      directory when sharded.
+    """
+    filenames = find_files(files_or_directories)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs,
+                                                initializer=_init_worker,
+                                                initargs=(config_filename, columnar)) as executor:
+        futures = [executor.submit(extract_file, filename) for filename in filenames]
+    # The rows extracted are only recorded as imported once written.
+    claims = [claim for future in futures if future.exception() is None
+              for claim in future.result()[2]]
+    try:
+        results = _write_results(futures, output_dir, include_filename, sharded, dedup_mode)
+    except BaseException:
+        release_claims(claims)
+        raise
+    commit_claims(claims)
+    return results
+
+
+def _write_results(futures, output_dir, include_filename, sharded, dedup_mode):
+    results = []
+    for future in futures:
+        filename, entries, _ = future.result()
+        if entries is None:
+            logging.warning("No importer identified %s", filename)
+            continue
+        outname = output_dir if sharded else output_name(filename, output_dir)
+        results.append((filename, outname, entries))
+
+    # Merge the results in date order of their first entries.
+    results.sort(key=lambda result: (result[2][0].date if result[2] else datetime.date.max,
+                                     result[1]))
+
+    # Find the transactions reported by several inputs.
+    if dedup_mode:
+        hook = dedup.merge_duplicates if dedup_mode == 'merge' else dedup.flag_duplicates
+        deduplicated = hook([(filename, entries) for filename, _, entries in results])
+        results = [(filename, outname, entries)
+                   for (filename, outname, _), (_, entries) in zip(results, deduplicated)]
+    if sharded:
+        with ShardedLedger(output_dir, include_filename) as ledger:
+            for _, _, entries in results:
+                ledger.write([entry for entry in entries
+                              if dedup.DUPLICATE_META not in entry.meta])
+        return results
+    os.makedirs(output_dir, exist_ok=True)
+    for filename, outname, entries in results:
+        write_entries(outname, filename, entries)
+    if include_filename:
+        update_include_file(include_filename, [outname for _, outname, _ in results])
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('config', help="Importers config file, like my.config")
+    parser.add_argument('inputs', nargs='+',
+                        help="Statement files, directories or glob patterns")
+    parser.add_argument('-o', '--output-dir', default='Data',
+                        help="Directory of the .beancount files")
+    parser.add_argument('-i', '--include-file',
+                        help="Ledger whose include list to update, like Data/2018.beancount")
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help="Number of worker processes (default: number of CPUs)")
+    parser.add_argument('--columnar', action='store_true',
+                        help="Use the columnar backend, for very large statements")
+    parser.add_argument('--sharded', action='store_true',
+                        help="Append to per-account, per-month shards of the output directory")
+    parser.add_argument('--dedup', choices=['flag', 'merge'],
+                        help="Flag or merge the transactions reported by several statements")
+    args = parser.parse_args()
+    for filename, outname, entries in run(args.config, args.inputs, args.output_dir,
+                                          args.include_file, args.jobs, args.columnar,
+                                          args.sharded, args.dedup):
+        print('{}: {} entries'.format(filename if args.sharded else outname, len(entries)))
+
+
+if __name__ == '__main__':
+    main()
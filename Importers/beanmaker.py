@@ -1,4 +1,11 @@
 """CSV importer.
+
+The module is loaded by every run of the beancount ingest tools, and only
+the modules needed to construct the importers of a config, beancount.ingest
+included for the ImporterProtocol they derive from, are imported at load
+time. The dependencies of extraction (dateutil, the fingerprint index,
+the profiler, the spill file of a ReverseSpool) are imported on first use,
+and the account maps are compiled into classifiers on first use too.
 """
 __copyright__ = "Copyright (C) 2018 Dongchao Li"
 __license__ = "GNU GPLv2"
@@ -6,23 +13,62 @@ __license__ = "GNU GPLv2"
 import csv
 import datetime
 import enum
+import functools
 import io
+import itertools
+import logging
+import os
 import collections
+import collections.abc
 import re
 from os import path
 from typing import Union, Dict, Callable, Optional
 
-import dateutil.parser
 from beancount.core.number import D
 from beancount.core.number import ZERO
 from beancount.core.amount import Amount
-from beancount.utils.date_utils import parse_date_liberally
 from beancount.core import data
 from beancount.core import flags
 from beancount.ingest import importer
 
+from csvstream import (LRUCache, decode_row, file_encoding, file_identity, open_mapped_rows,
+                       read_head)
+
 DEFAULT = "DEFAULT"
 
+# Maximum number of bytes of the head of a file sniffed to detect its header.
+SNIFF_MAX_BYTES = 64 * 1024
+
+# Number of transactions per chunk of a ReverseSpool, and number of full
+# chunks it holds in memory before spilling the oldest ones to disk.
+SPOOL_CHUNK_SIZE = 4096
+SPOOL_MEMORY_CHUNKS = 16
+
+# Size of the blocks read backwards from the end of a file to find its last row.
+TAIL_BLOCK_SIZE = 8192
+
+# Number of leading values of a column parsed by dateutil to infer its format,
+# and number of parsed values memoized by each DateParser.
+DATE_INFER_SAMPLES = 8
+DATE_CACHE_SIZE = 4096
+
+# Number of parsed amount strings memoized by parse_amount().
+AMOUNT_CACHE_SIZE = 4096
+
+# Maximum size of the files whose parsed rows are cached, so that file_date()
+# and extract() read them once, and number of files cached. Larger files are
+# streamed every time instead, to keep memory bounded.
+PARSED_CACHE_MAX_BYTES = 16 * 1024 * 1024
+PARSED_CACHE_SIZE = 4
+
+# The intervals of the balance entries of a RunningBalance: after the last
+# row only, or at the start of every day or month too.
+BALANCE_INTERVALS = (None, 'daily', 'monthly')
+
+# Maximum number of remarks resolved by a TransferResolver, past the pairs of
+# keywords it starts with, which are memoized.
+TRANSFER_CACHE_SIZE = 65536
+
 # The set of interpretable columns.
 class Col(enum.Enum):
     # The settlement date, the date we should create the posting at.
@@ -68,6 +114,9 @@ class Col(enum.Enum):
     # Transaction status
     STATUS = '[STATUS]'
 
+    # The unique number of the transaction, used to fingerprint the row.
+    TXN_ID = '[TXN_ID]'
+
 # The set of status which says DEBIT or CREDIT
 class Debit_or_credit(enum.Enum):
     DEBIT = '[DEBIT]'
@@ -77,6 +126,15 @@ class Debit_or_credit(enum.Enum):
     UNCERTAINTY = '[UNCERTAINTY]'
 
 
+# Full-width digits and signs of Chinese statements, to their ASCII forms.
+_AMOUNT_TRANSLATION = str.maketrans(dict(
+    {chr(ord('０') + digit): str(digit) for digit in range(10)},
+    **{'，': ',', '．': '.', '－': '-', '＋': '+', '\u2212': '-'}))
+
+# The optional sign, the currency symbols or blanks, and the number of an amount.
+_AMOUNT_RE = re.compile(r'([-+]?)[^\d\-+]*(\d[\d,]*\.?\d*)')
+
+
 def cast_to_decimal(amount):
     """Cast the amount to either an instance of Decimal or None.
 
@@ -87,8 +145,42 @@ def cast_to_decimal(amount):
     """
     if amount is None:
         return None
-    amount = ''.join(amount.split(','))
-    return D(re.findall(r"\d+\.?\d*", amount)[0])
+    return parse_amount(amount)
+
+
+def parse_balance(balance):
+    """Cast a balance to either an instance of Decimal or None.
+
+    Args:
+        balance: A string of balance, possibly blank.
+    Returns:
+        The corresponding Decimal of balance, or None if the cell is blank.
+    """
+    if balance is None or not balance.strip():
+        return None
+    return D(balance)
+
+
+@functools.lru_cache(maxsize=AMOUNT_CACHE_SIZE)
+def parse_amount(amount):
+    """Parse an amount string into a Decimal, in a single regex scan.
+
+    Full-width characters are accepted, currency symbols and thousands
+    separators are ignored, and a leading sign is kept. Results are memoized,
+    since statements repeat the same amounts a lot.
+
+    Args:
+        amount: A string of amount, like '¥1,000.00', '-5.20', '２００'.
+    Returns:
+        The corresponding Decimal of amount.
+    Raises:
+        ValueError: If the string contains no number.
+    """
+    match = _AMOUNT_RE.search(amount.translate(_AMOUNT_TRANSLATION))
+    if match is None:
+        raise ValueError("Invalid amount: {!r}".format(amount))
+    sign, number = match.groups()
+    return D(sign + number.replace(',', ''))
 
 
 def get_amounts(iconfig, row, DRCR_status, allow_zero_amounts=False):
@@ -103,6 +195,20 @@ def get_amounts(iconfig, row, DRCR_status, allow_zero_amounts=False):
         A pair of (debit-amount, credit-amount), both of which are either an
         instance of Decimal or None, or not available.
     """
+    debit, credit = select_amounts(iconfig, row, DRCR_status)
+    return convert_amounts(debit, credit, allow_zero_amounts)
+
+
+def select_amounts(iconfig, row, DRCR_status):
+    """Get the strings of the debit and credit amounts of a row.
+
+    Args:
+        iconfig: A dict of Col to row index.
+        row: A row array containing the values of the given row.
+        DRCR_status: The Debit_or_credit status of the row.
+    Returns:
+        A pair of (debit-string, credit-string), each of which may be None.
+    """
     debit, credit = None, None
     if Col.AMOUNT in iconfig:
         amount = row[iconfig[Col.AMOUNT]]
@@ -114,16 +220,37 @@ def get_amounts(iconfig, row, DRCR_status, allow_zero_amounts=False):
     else:
         debit, credit = [row[iconfig[col]] if col in iconfig else None
                          for col in [Col.AMOUNT_DEBIT, Col.AMOUNT_CREDIT]]
+    return debit, credit
+
+
+def convert_amounts(debit, credit, allow_zero_amounts=False):
+    """Convert the strings of the debit and credit amounts of a row.
+
+    The direction of an amount comes from its column, DEBIT or CREDIT, or
+    from the DRCR status for a single AMOUNT column: the sign of the cells is
+    ignored, so a debit of '-12.50' is posted as -12.50 like a debit of
+    '12.50', and a credit of '-3.00' as 3.00.
+
+    Args:
+        debit: A string of the debit amount, or None.
+        credit: A string of the credit amount, or None.
+        allow_zero_amounts: Is a transaction with amount D('0.00') okay? If not,
+            return (None, None).
+    Returns:
+        A pair of (debit-amount, credit-amount), both of which are either an
+        instance of Decimal or None, or not available.
+    """
+    # Parse each amount once.
+    debit_amount = parse_amount(debit) if debit else None
+    credit_amount = parse_amount(credit) if credit else None
 
     # If zero amounts aren't allowed, return null value.
-    is_zero_amount = ((credit is not None and cast_to_decimal(credit) == ZERO) and
-                      (debit is not None and cast_to_decimal(debit) == ZERO))
+    is_zero_amount = debit_amount == ZERO and credit_amount == ZERO
     if not allow_zero_amounts and is_zero_amount:
         return (None, None)
 
-
-    return (-cast_to_decimal(debit) if debit else None,
-            cast_to_decimal(credit) if credit else None)
+    return (-abs(debit_amount) if debit_amount is not None else None,
+            abs(credit_amount) if credit_amount is not None else None)
 
 
 def get_debit_or_credit_status(iconfig, row, DRCR_dict):
@@ -163,7 +290,10 @@ class Importer(importer.ImporterProtocol):
                  DRCR_dict: Optional[Dict]=None,
                  assets_account: Optional[Dict]=None,
                  debit_account: Optional[Dict]=None,
-                 credit_account: Optional[Dict]=None):
+                 credit_account: Optional[Dict]=None,
+                 fingerprint_index: Optional[str]=None,
+                 profile: Union[bool, str]=False,
+                 balance_interval: Optional[str]=None):
         """Constructor.
 
         Args:
@@ -190,6 +320,21 @@ class Importer(importer.ImporterProtocol):
                 occurs in the DRCR column. If DRCR column is revealed and
                 DRCR_dict is None, the status of trasaction will be uncertain.
             assets_account: An optional dict of user-defined.
+            fingerprint_index: An optional path of a FingerprintIndex database.
+                If given, the rows already imported by a previous run are
+                skipped. The rows are fingerprinted by their TXN_ID, DATE and
+                amount columns if TXN_ID is configured, by all their fields
+                otherwise.
+            profile: Whether to time the stages of extract() and count the
+                rows skipped by reason. The report is written as JSON to
+                stderr if true, or appended as a line to the file at the
+                given path string.
+            balance_interval: None, 'daily' or 'monthly'. The running
+                balance of the BALANCE column is checked row after row in
+                any case, and the first row which does not add up is
+                reported. With an interval, a balance entry is also made at
+                the start of every day or month following rows, besides the
+                one after the last row.
         """
 
         assert isinstance(config, dict)
@@ -205,6 +350,10 @@ class Importer(importer.ImporterProtocol):
         self.csv_dialect = csv_dialect
         self.narration_sep = narration_sep
         self.close_flag = close_flag
+        self.fingerprint_index = fingerprint_index
+        self.profile = profile
+        assert balance_interval in BALANCE_INTERVALS
+        self.balance_interval = balance_interval
 
         # Reverse the key and value of the DRCR_dict.
         self.DRCR_dict = dict(zip(DRCR_dict.values(), DRCR_dict.keys())) if isinstance(DRCR_dict, dict) else {}
@@ -222,6 +371,9 @@ class Importer(importer.ImporterProtocol):
         self.institution = institution
         self.categorizer = categorizer
 
+        # The ImporterRegistry this importer is dispatched by, if any.
+        self.registry = None
+
     def name(self):
         """Generate an importer name printed out.
 
@@ -234,6 +386,42 @@ class Importer(importer.ImporterProtocol):
         """
         return '{}: "{}"'.format(super().name(), self.file_account(None))
 
+    # Compile the account maps once, on first use, instead of scanning them
+    # for every row.
+    @functools.cached_property
+    def assets_classifier(self):
+        return AccountClassifier(self.assets_account)
+
+    @functools.cached_property
+    def debit_classifier(self):
+        return AccountClassifier(self.debit_account)
+
+    @functools.cached_property
+    def credit_classifier(self):
+        return AccountClassifier(self.credit_account)
+
+    @functools.cached_property
+    def transfer_resolver(self):
+        return TransferResolver(self.assets_classifier, self.assets_account,
+                                self.default_account)
+
+    def report_unresolved_transfers(self, file, profiler=None):
+        """Report the remarks of uncertain rows resolved to default accounts, at once.
+
+        Args:
+            file: A cache.FileMemo instance, the file extracted.
+            profiler: An optional Profiler counting the unresolved rows.
+        """
+        unresolved = self.transfer_resolver.drain()
+        if not unresolved:
+            return
+        if profiler is not None:
+            profiler.count('unresolved_transfers', sum(unresolved.values()))
+        logging.warning("%s: %d remarks of uncertain rows not resolved to a transfer, "
+                        "posted to the default accounts: %s",
+                        file.name, len(unresolved),
+                        ', '.join('{} ({})'.format(remark, count)
+                                  for remark, count in unresolved.items()))
     
     def identify(self, file):
         """Whether the importer can handle the given file.
@@ -243,12 +431,18 @@ class Importer(importer.ImporterProtocol):
         figure out the list of (file, importer) pairs. This function is used
         by bean-identity and bean-extract tools.
         
+        When the importer belongs to an ImporterRegistry, the answer is looked
+        up in the registry, which identifies each file once for all of its
+        importers.
+
         Returns:
             A bool to identity whether or not.
         """
+        if self.registry is not None:
+            return self.registry.identify(self, file)
         if file.mimetype() != 'text/csv':
             return False
-        iconfig, has_header = normalize_config(self.config, file.head(-1))
+        iconfig, has_header = normalize_file_config(self.config, file)
         if len(iconfig) != len(self.config):
             return False
         return True
@@ -296,24 +490,121 @@ class Importer(importer.ImporterProtocol):
         """
         
         
-        iconfig, has_header = normalize_config(self.config, file.head(-1))
+        iconfig, has_header = normalize_file_config(self.config, file)
         if Col.DATE in iconfig:
-            reader = iter(csv.reader(open(file.name)))
+            parsed = self.parse_file(file, iconfig, has_header)
+            if parsed is not None:
+                return parsed.max_date
+            max_date = None
+            date_parser = DateParser(self.dateutil_kwds)
+            rows = self._data_rows(file, has_header, ParsedFile(),
+                                   columns={0, iconfig[Col.DATE]})
+            try:
+                for _, row in rows:
+                    date_str = row[iconfig[Col.DATE]]
+                    date = date_parser.parse(date_str)
+                    if max_date is None or date > max_date:
+                        max_date = date
+            finally:
+                rows.close()
+            return max_date
+
+    def parse_file(self, file, iconfig, has_header, profiler=None):
+        """Parse the data rows of a file and their dates, once.
+
+        The result is cached by file identity, so that file_date() and
+        extract() read and parse the file a single time.
+
+        Args:
+            file: A cache.FileMemo instance.
+            iconfig: A dict of Col types to integer indexes of the fields.
+            has_header: A boolean, true if the file has a header.
+            profiler: An optional Profiler timing the reading of the rows.
+        Returns:
+            A ParsedFile, or None if the file is too large to be held in
+            memory or has no DATE column.
+        """
+        if Col.DATE not in iconfig:
+            return None
+        identity = file_identity(file.name)
+        if identity[1] > PARSED_CACHE_MAX_BYTES:
+            return None
+        columns = self._row_columns(iconfig)
+        key = (identity, self.skip_lines, has_header, self.csv_dialect,
+               iconfig[Col.DATE], columns, repr(self.dateutil_kwds))
+        try:
+            _PARSED_CACHE.move_to_end(key)
+            return _PARSED_CACHE[key]
+        except KeyError:
+            pass
+
+        parsed = ParsedFile()
+        date_parser = DateParser(self.dateutil_kwds)
+        if profiler is not None:
+            date_parser.parse = profiler.timed('parse_date', date_parser.parse)
+        rows = self._data_rows(file, has_header, parsed, profiler, columns)
+        try:
+            for index, row in rows:
+                parsed.rows.append((index, row, date_parser.parse(row[iconfig[Col.DATE]])))
+        finally:
+            rows.close()
+        dates = [date for _, _, date in parsed.rows]
+        parsed.min_date = min(dates, default=None)
+        parsed.max_date = max(dates, default=None)
+
+        _PARSED_CACHE[key] = parsed
+        while len(_PARSED_CACHE) > PARSED_CACHE_SIZE:
+            _PARSED_CACHE.popitem(last=False)
+        return parsed
+
+    def _row_columns(self, iconfig):
+        """The indexes of the columns of the rows to decode, or None for all.
+
+        Only the configured columns are used, and the first one to find the
+        comments, unless the rows are printed or fingerprinted entirely.
+        """
+        if self.debug or (self.fingerprint_index and Col.TXN_ID not in iconfig):
+            return None
+        return frozenset(iconfig.values()) | {0}
+
+    def _data_rows(self, file, has_header, parsed, profiler=None, columns=None):
+        """Read the data rows of a file, skipping the garbage lines and header.
+
+        Args:
+            file: A cache.FileMemo instance.
+            has_header: A boolean, true if the file has a header.
+            parsed: A ParsedFile, whose counters of skipped rows and last
+                line number are updated. The rows are not added to it.
+            profiler: An optional Profiler timing the reading of the rows.
+            columns: An optional set of the indexes of the only columns to
+                decode, the others being None. The rows are read from a
+                memory map of the file then, see open_mapped_rows().
+        Yields:
+            Pairs of the line number of a row, counted from the header, and
+            the row.
+        """
+        with open_mapped_rows(file.name, columns, self.csv_dialect) as rows:
+            reader = iter(rows)
+            if profiler is not None:
+                reader = profiler.timed_iter('read_rows', reader)
+
+            # Skip garbage lines
             for _ in range(self.skip_lines):
                 next(reader)
+
+            # Skip header, if one was detected.
             if has_header:
                 next(reader)
-            max_date = None
-            for row in reader:
+
+            for index, row in enumerate(reader, 1):
+                parsed.last_index = index
                 if not row:
+                    parsed.skipped['skipped_empty_row'] += 1
                     continue
                 if row[0].startswith('#'):
+                    parsed.skipped['skipped_comment'] += 1
                     continue
-                date_str = row[iconfig[Col.DATE]]
-                date = parse_date_liberally(date_str, self.dateutil_kwds)
-                if max_date is None or date > max_date:
-                    max_date = date
-            return max_date
+                yield index, row
 
     def extract(self, file):
         """Parse and extract Beanount contents from the given file.
@@ -327,177 +618,780 @@ class Importer(importer.ImporterProtocol):
             A list of beancount.core.data object, and each of them can be
             converted into a command-line accounting.
         """
-        entries = []
+        return list(self.iter_extract(file))
+
+    def iter_extract(self, file):
+        """Parse and extract Beanount contents from the given file, lazily.
+
+        This is the streaming form of extract(): directives are yielded in
+        ascending date order as the rows are parsed. For a file in descending
+        order, the parsed rows are kept in a ReverseSpool, which spills them
+        to a temporary file chunk by chunk, so memory stays bounded whatever
+        the size of the file. The balance entry, if any, comes last, and the
+        BALANCE column is checked by a RunningBalance on the way. Files
+        small enough are parsed once by parse_file(), whose cached rows and
+        dates are shared with file_date().
+
+        Yields:
+            beancount.core.data objects, each of which can be converted into a
+            command-line accounting.
+        """
+        # Time the stages if profiling, leaving them untouched otherwise.
+        if self.profile:
+            from profiling import Profiler
+            profiler = Profiler()
+        else:
+            profiler = None
+        timed = profiler.timed if profiler is not None else lambda name, function: function
 
         # Normalize the configuration to fetch by index.
-        iconfig, has_header = normalize_config(self.config, file.head(-1))
+        iconfig, has_header = timed('normalize_config', normalize_file_config)(self.config, file)
 
-        reader = iter(csv.reader(open(file.name), dialect=self.csv_dialect))
+        get = row_getter(iconfig)
+        date_parsers, stages = self._extract_stages(timed)
 
-        # Skip garbage lines
-        for _ in range(self.skip_lines):
-            next(reader)
+        # Read the rows parsed by file_date() if cached, or stream them.
+        parsed = self.parse_file(file, iconfig, has_header, profiler)
+        if parsed is not None:
+            stats, data_rows = parsed, None
+            rows = iter(parsed.rows)
+        else:
+            stats = ParsedFile()
+            data_rows = self._data_rows(file, has_header, stats, profiler)
+            rows = ((index, row, None) for index, row in data_rows)
 
-        # Skip header, if one was detected.
-        if has_header:
-            next(reader)
+        if self.fingerprint_index:
+            from fingerprint import FingerprintIndex
+            seen = FingerprintIndex(self.fingerprint_index)
+        else:
+            seen = None
+        try:
+            # Figure out if the file is in ascending or descending order,
+            # from its first row and the last row at the end of the file.
+            first = next(rows, None)
+            if first is not None:
+                if parsed is not None:
+                    first_date, last_date = parsed.rows[0][2], parsed.rows[-1][2]
+                else:
+                    last_row = read_last_row(file.name, self.csv_dialect)
+                    first_date = date_parsers[Col.DATE].parse(get(first[1], Col.DATE))
+                    last_date = date_parsers[Col.DATE].parse(get(last_row, Col.DATE))
+
+                # Parse all the transactions.
+                records = self._iter_records(iconfig, get, date_parsers, stages, profiler,
+                                             seen, itertools.chain([first], rows))
+                yield from self._ordered_entries(
+                    file, iconfig, records, first_date < last_date,
+                    functools.partial(self._build_transaction, file, stages, profiler),
+                    lambda: stats.last_index, profiler)
+
+            # The whole file went through: remember its rows.
+            if seen is not None:
+                seen.commit()
+
+            self.report_unresolved_transfers(file, profiler)
+            if profiler is not None:
+                profiler.counters.update(stats.skipped)
+                profiler.emit(self.profile, importer=self.name(), file=file.name)
+        finally:
+            if data_rows is not None:
+                data_rows.close()
+            if seen is not None:
+                seen.close()
+
+    def _iter_records(self, iconfig, get, date_parsers, stages, profiler, seen, rows):
+        """Filter and parse the data rows of a file, in the order of the file.
 
-        def get(row, ftype):
-            try:
-                return row[iconfig[ftype]] if ftype in iconfig else None
-            except IndexError:  # FIXME: this should not happen
-                return None
-
-        # Parse all the transactions.
-        first_row = last_row = None
-        for index, row in enumerate(reader, 1):
-            if not row:
-                continue
-            if row[0].startswith('#'):
-                continue
+        Args:
+            seen: An optional FingerprintIndex. The rows it contains are
+                skipped, and the others are claimed in it.
+            rows: An iterator of triples of the line number of a data row,
+                the row, and its parsed DATE or None.
+        Yields:
+            RowRecords, and None in place of the rows skipped by the
+            fingerprint index, as the balance of the next row does not follow.
+        """
+        for index, row, date in rows:
+            if profiler is not None:
+                profiler.count('rows')
 
             # If debugging, print out the rows.
             if self.debug:
                 print(row)
 
-            if first_row is None:
-                first_row = row
-            last_row = row
+            # Skip the rows imported by a previous run.
+            if seen is not None and not seen.claim(self._fingerprint(iconfig, get, row)):
+                if profiler is not None:
+                    profiler.count('skipped_duplicate')
+                yield None
+                continue
+
+            record = self._parse_row(iconfig, get, date_parsers, stages,
+                                     profiler, index, row, date)
+            if record is not None:
+                yield record
 
-            # Extract the data we need from the row, based on the configuration.
-            status = get(row, Col.STATUS)
-            # When the status is CLOSED, the transaction where money had not been paid should be ignored.
-            if isinstance(status,str) and status == self.close_flag:
+    def _ordered_entries(self, file, iconfig, records, is_ascending, build, last_lineno,
+                         profiler=None):
+        """Build the transactions of the records of a file, in date order.
+
+        All the extraction backends go through this. The records of a file in
+        descending order are reversed, through a ReverseSpool unless they are
+        a list already. The BALANCE column, if any, is checked by a
+        RunningBalance on the way, and its balance entries are added, the one
+        after the last row coming last.
+
+        Args:
+            file: A cache.FileMemo instance.
+            iconfig: A dict of Col types to integer indexes of the fields.
+            records: An iterable of RowRecords in the order of the file, with
+                None after the rows skipped by the fingerprint index.
+            is_ascending: Whether the file is in ascending date order.
+            build: A function making the transaction of a RowRecord.
+            last_lineno: A function giving the line number of the balance
+                entry after the last row, called once the records are
+                exhausted.
+            profiler: An optional Profiler counting the balances which do not
+                add up.
+        Yields:
+            The transactions and the balance entries, in date order.
+        """
+        balances = (RunningBalance(file.name, self.default_account, self.currency,
+                                   self.balance_interval)
+                    if Col.BALANCE in iconfig else None)
+        spool = None
+        try:
+            if not is_ascending:
+                if isinstance(records, list):
+                    records = reversed(records)
+                else:
+                    spool = ReverseSpool()
+                    for record in records:
+                        spool.append(record)
+                    records = spool
+
+            for record in records:
+                if record is None:
+                    if balances is not None:
+                        balances.reset()
+                    continue
+                txn = build(record)
+                if balances is not None:
+                    balance_entry = balances.add(record.index, txn.date, record.balance,
+                                                 record.amount_debit, record.amount_credit)
+                    if balance_entry is not None:
+                        yield balance_entry
+                yield txn
+
+            # Add a balance entry if possible
+            if balances is not None:
+                balance_entry = balances.finish(last_lineno())
+                if balance_entry is not None:
+                    yield balance_entry
+                balances.report(profiler)
+        finally:
+            if spool is not None:
+                spool.close()
+
+    def _extract_stages(self, timed):
+        """Create the date parsers and the stage functions of an extraction.
+
+        Args:
+            timed: A function wrapping a stage function, given its name.
+        Returns:
+            A pair of a dict of Col to DateParser, and a dict of the stage
+            functions, as used by _parse_row() and _build_transaction().
+        """
+        date_parsers = {Col.DATE: DateParser(self.dateutil_kwds),
+                        Col.TXN_DATE: DateParser(self.dateutil_kwds),
+                        Col.TXN_TIME: DateParser(want_time=True)}
+        for date_parser in date_parsers.values():
+            date_parser.parse = timed('parse_date', date_parser.parse)
+        categorizer = self.categorizer if isinstance(self.categorizer, collections.abc.Callable) else None
+        stages = {'get_amounts': timed('get_amounts', get_amounts),
+                  'posting_accounts': timed('mapping_account', self._posting_accounts),
+                  'categorizer': timed('categorizer', categorizer) if categorizer else None}
+        return date_parsers, stages
+
+    def _fingerprint(self, iconfig, get, row):
+        """Compute the fingerprint of a row, for the FingerprintIndex."""
+        from fingerprint import row_fingerprint
+        if Col.TXN_ID in iconfig:
+            fields = [get(row, field) for field in (Col.TXN_ID, Col.DATE, Col.AMOUNT,
+                                                    Col.AMOUNT_DEBIT, Col.AMOUNT_CREDIT)]
+        else:
+            fields = row
+        return row_fingerprint([self.default_account] + list(fields))
+
+    def _parse_row(self, iconfig, get, date_parsers, stages, profiler, index, row,
+                   date=None):
+        """Filter a row, and parse the fields its transaction is made of.
+
+        Args:
+            stages: A dict of the stage functions used, possibly timed.
+            profiler: A Profiler counting the skipped rows, or None.
+            date: The parsed DATE of the row, if already known.
+        Returns:
+            A RowRecord, or None if the row should be skipped.
+        """
+        # Extract the data we need from the row, based on the configuration.
+        status = get(row, Col.STATUS)
+        # When the status is CLOSED, the transaction where money had not been paid should be ignored.
+        if isinstance(status,str) and status == self.close_flag:
+            if profiler is not None:
+                profiler.count('skipped_closed')
+            return None
+
+        # Distinguish debit or credit
+        DRCR_status = get_debit_or_credit_status(iconfig, row, self.DRCR_dict)
+        amount_debit, amount_credit = stages['get_amounts'](iconfig, row, DRCR_status)
+
+        # Skip empty transactions
+        if amount_debit is None and amount_credit is None:
+            if profiler is not None:
+                profiler.count('skipped_empty_amount')
+            return None
+
+        record = RowRecord()
+        record.index = index
+        record.DRCR_status = DRCR_status
+        record.amount_debit = amount_debit
+        record.amount_credit = amount_credit
+
+        if date is None:
+            date = date_parsers[Col.DATE].parse(get(row, Col.DATE))
+        record.date = date
+        txn_date = get(row, Col.TXN_DATE)
+        record.txn_date = date_parsers[Col.TXN_DATE].parse(txn_date) if txn_date is not None else None
+        txn_time = get(row, Col.TXN_TIME)
+        record.txn_time = date_parsers[Col.TXN_TIME].parse(txn_time) if txn_time is not None else None
+
+        payee = get(row, Col.PAYEE)
+        record.payee = payee.strip() if payee else payee
+
+        fields = filter(None, [get(row, field)
+                               for field in (Col.NARRATION1,
+                                             Col.NARRATION2)])
+        record.narration = self.narration_sep.join(field.strip() for field in fields)
+
+        record.remark = get(row, Col.REMARK)
+        record.tag = get(row, Col.TAG)
+        record.last4 = get(row, Col.LAST4)
+        balance = get(row, Col.BALANCE)
+        record.balance = parse_balance(balance)
+        return record
+
+    def _build_transaction(self, file, stages, profiler, record):
+        """Create the transaction of a row which survived the filters.
+
+        Args:
+            file: A cache.FileMemo instance.
+            stages: A dict of the stage functions used, possibly timed.
+            profiler: A Profiler counting the transactions, or None.
+            record: A RowRecord, from _parse_row().
+        Returns:
+            A beancount.core.data.Transaction.
+        """
+        meta = data.new_metadata(file.name, record.index)
+        if record.txn_date is not None:
+            meta['date'] = record.txn_date
+        if record.txn_time is not None:
+            meta['time'] = record.txn_time
+        if record.last4:
+            last4_friendly = self.last4_map.get(record.last4.strip())
+            meta['card'] = last4_friendly if last4_friendly else record.last4
+        tags = {record.tag} if record.tag is not None else data.EMPTY_SET
+        #flag = flags.FLAG_WARNING if DRCR_status == Debit_or_credit.UNCERTAINTY else self.FLAG
+        txn = data.Transaction(meta, record.date, self.FLAG, record.payee,
+                               "{}({})".format(record.narration, record.remark),
+                               tags, data.EMPTY_SET, [])
+
+        # Attach one posting to the transaction
+        accounts = stages['posting_accounts'](record.DRCR_status, record.remark,
+                                              record.payee, record.narration)
+        for amount in [record.amount_debit, record.amount_credit]:
+            if amount is None:
                 continue
+            add_postings(txn, Amount(amount, self.currency), accounts)
+
+        # Attach the other posting(s) to the transaction.
+        if stages['categorizer'] is not None:
+            txn = stages['categorizer'](txn)
+
+        if profiler is not None:
+            profiler.count('transactions')
+        return txn
 
-            # Distinguish debit or credit
-            DRCR_status = get_debit_or_credit_status(iconfig, row, self.DRCR_dict)
+    def _posting_accounts(self, DRCR_status, remark, payee, narration):
+        """Find the accounts to post the amounts of a row to.
 
+        Returns:
+            A triple of the primary account, whether the units are negated on
+            it, and the secondary account, which is None when the units are
+            posted alone.
+        """
+        # Uncertain transaction, maybe capital turnover
+        if DRCR_status == Debit_or_credit.UNCERTAINTY:
+            return self.transfer_resolver.resolve(remark)
+
+        # Debit or Credit transaction
+        else:
+            # Primary posting
+            # Rename primary account if remark field matches one of assets account
+            primary_account = self.assets_classifier.classify(remark)
+
+            # Secondary posting
+            # Rename secondary account by credit account or debit account based on DRCR status
+            payee_narration = payee + narration
+            _classifier = self.credit_classifier if DRCR_status == Debit_or_credit.CREDIT else self.debit_classifier
+            secondary_account = _classifier.classify(payee_narration)
+            return primary_account, False, secondary_account
+
+
+def row_getter(iconfig):
+    """Create a function getting the value of a column in a row.
+
+    Args:
+      iconfig: A dict of Col types to integer indexes of the fields.
+    Returns:
+      A function of a row and a Col type, giving the value of the column or
+      None if it is not configured.
+    """
+    def get(row, ftype):
+        try:
+            return row[iconfig[ftype]] if ftype in iconfig else None
+        except IndexError:  # FIXME: this should not happen
+            return None
+    return get
 
-            date = get(row, Col.DATE)
-            txn_date = get(row, Col.TXN_DATE)
-            txn_time = get(row, Col.TXN_TIME)
 
-            payee = get(row, Col.PAYEE)
-            if payee:
-                payee = payee.strip()
+def add_postings(txn, units, accounts):
+    """Attach the postings of an amount to a transaction.
 
-            fields = filter(None, [get(row, field)
-                                   for field in (Col.NARRATION1,
-                                                 Col.NARRATION2)])
-            narration = self.narration_sep.join(field.strip() for field in fields)
+    Args:
+      txn: A data.Transaction instance.
+      units: An Amount instance.
+      accounts: A triple of (primary account, negated, secondary account), as
+        returned by Importer._posting_accounts().
+    """
+    primary_account, negated, secondary_account = accounts
+    txn.postings.append(
+        data.Posting(primary_account, -units if negated else units, None, None, None, None))
+    if secondary_account is not None:
+        txn.postings.append(
+            data.Posting(secondary_account, None, None, None, None, None))
 
-            remark = get(row, Col.REMARK)
 
-            tag = get(row, Col.TAG)
-            tags = {tag} if tag is not None else data.EMPTY_SET
+# A cache of the parsed rows of the files, least recently used first.
+_PARSED_CACHE = collections.OrderedDict()
 
-            last4 = get(row, Col.LAST4)
 
-            balance = get(row, Col.BALANCE)
+def clear_parsed_cache():
+    """Drop the parsed rows of the files, once their extraction is done.
 
-            # Create a transaction
-            meta = data.new_metadata(file.name, index)
-            if txn_date is not None:
-                meta['date'] = parse_date_liberally(txn_date,
-                                                    self.dateutil_kwds)
-            if txn_time is not None:
-                meta['time'] = str(dateutil.parser.parse(txn_time).time())
-            if balance is not None:
-                meta['balance'] = D(balance)
-            if last4:
-                last4_friendly = self.last4_map.get(last4.strip())
-                meta['card'] = last4_friendly if last4_friendly else last4
-            date = parse_date_liberally(date, self.dateutil_kwds)
-            #flag = flags.FLAG_WARNING if DRCR_status == Debit_or_credit.UNCERTAINTY else self.FLAG
-            txn = data.Transaction(meta, date, self.FLAG, payee, "{}({})".format(narration,remark),
-                                   tags, data.EMPTY_SET, [])
+    Long-running processes call this after each file, not to keep up to
+    PARSED_CACHE_SIZE files of rows alive for good.
+    """
+    _PARSED_CACHE.clear()
 
-            # Attach one posting to the transaction
-            amount_debit, amount_credit = get_amounts(iconfig, row, DRCR_status)
 
-            # Skip empty transactions
-            if amount_debit is None and amount_credit is None:
-                continue
+class ParsedFile:
+    """The data rows of a file, with their dates, parsed once.
 
-            for amount in [amount_debit, amount_credit]:
-                if amount is None:
-                    continue
-                units = Amount(amount, self.currency)
-
-                # Uncertain transaction, maybe capital turnover
-                if DRCR_status == Debit_or_credit.UNCERTAINTY:
-                    if remark and len(remark.split("-")) == 2:
-                        remarks = remark.split("-")
-                        primary_account = mapping_account(self.assets_account, remarks[1])
-                        secondary_account = mapping_account(self.assets_account, remarks[0])
-                        txn.postings.append(
-                            data.Posting(primary_account, -units, None, None, None, None))
-                        txn.postings.append(
-                            data.Posting(secondary_account, None, None, None, None, None))
-                    else:
-                        txn.postings.append(
-                            data.Posting(self.default_account, units, None, None, None, None))
-                        
-
-                # Debit or Credit transaction
+    Attributes:
+      rows: A list of triples of the line number of a data row, the row, and
+        its parsed DATE.
+      skipped: A Counter of the rows skipped, by reason.
+      last_index: The line number of the last line of the file.
+      min_date: The earliest date of the rows, or None.
+      max_date: The latest date of the rows, or None.
+    """
+
+    def __init__(self):
+        self.rows = []
+        self.skipped = collections.Counter()
+        self.last_index = 0
+        self.min_date = self.max_date = None
+
+
+class RowRecord:
+    """The parsed fields of a data row, which its transaction is built from.
+
+    Rows are filtered and spooled as records, much smaller than the beancount
+    objects, which are only created for the rows which are output.
+    """
+    __slots__ = ('index', 'date', 'txn_date', 'txn_time', 'payee', 'narration',
+                 'remark', 'tag', 'last4', 'balance', 'DRCR_status',
+                 'amount_debit', 'amount_credit')
+
+
+class ReverseSpool:
+    """A bounded-memory buffer which gives back its entries in reverse order.
+
+    Entries are grouped in chunks of chunk_size, and the memory_chunks most
+    recent full chunks are kept in memory. Beyond that, the oldest chunks are
+    pickled into an anonymous temporary file, which is read back from the last
+    chunk to the first, so small files never touch the disk.
+    """
+
+    def __init__(self, chunk_size: int=SPOOL_CHUNK_SIZE,
+                 memory_chunks: int=SPOOL_MEMORY_CHUNKS):
+        self.chunk_size = chunk_size
+        self.memory_chunks = memory_chunks
+        self.chunk = []
+        self.chunks = collections.deque()
+        self.offsets = []
+        self.spill_file = None
+
+    def append(self, entry):
+        """Add an entry, spilling the oldest chunk to disk if memory is full."""
+        self.chunk.append(entry)
+        if len(self.chunk) >= self.chunk_size:
+            self.chunks.append(self.chunk)
+            self.chunk = []
+            if len(self.chunks) > self.memory_chunks:
+                if self.spill_file is None:
+                    import tempfile
+                    self.spill_file = tempfile.TemporaryFile()
+                self.offsets.append(self.spill_file.tell())
+                import pickle
+                pickle.dump(self.chunks.popleft(), self.spill_file, pickle.HIGHEST_PROTOCOL)
+
+    def __iter__(self):
+        """Iterate over the entries, from the last appended to the first."""
+        import pickle
+        yield from reversed(self.chunk)
+        for chunk in reversed(self.chunks):
+            yield from reversed(chunk)
+        for offset in reversed(self.offsets):
+            self.spill_file.seek(offset)
+            yield from reversed(pickle.load(self.spill_file))
+
+    def close(self):
+        """Release the temporary file, if any."""
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+
+
+class RunningBalance:
+    """Check the BALANCE column of a statement, row after row.
+
+    The rows are added in date order, with their amounts. The balance of each
+    row must be the balance of the row before plus its amounts; the first row
+    which does not add up is kept, and the others are counted, so memory is
+    constant whatever the size of the file. The balance of a row after rows
+    which were skipped, or without a balance, is not checked.
+
+    The balance entries are made from the balances of the rows: one after
+    the last row, and with an interval, one at the start of every day or
+    month after the last row before it.
+    """
+
+    def __init__(self, filename, account, currency, interval: Optional[str]=None):
+        """Constructor.
+
+        Args:
+          filename: A path string, the statement.
+          account: An account string, the account of the balance entries.
+          currency: A currency string.
+          interval: One of BALANCE_INTERVALS.
+        """
+        self.filename = filename
+        self.account = account
+        self.currency = currency
+        self.interval = interval
+
+        # The balance, date and line number of the last row added, and
+        # whether the balance of the next row follows from it.
+        self.balance = None
+        self.date = None
+        self.lineno = None
+        self.follows = False
+
+        # The (line number, reported, expected balance) of the first row
+        # which does not add up, and the number of them.
+        self.divergence = None
+        self.divergences = 0
+
+    def _period(self, date):
+        return date if self.interval == 'daily' else (date.year, date.month)
+
+    def _next_period(self, date):
+        if self.interval == 'daily':
+            return date + datetime.timedelta(days=1)
+        return (date.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+
+    def _balance_entry(self, lineno, date):
+        if self.balance is None:
+            return None
+        meta = data.new_metadata(self.filename, lineno)
+        return data.Balance(meta, date, self.account, Amount(self.balance, self.currency),
+                            None, None)
+
+    def reset(self):
+        """Do not check the balance of the next row, after rows skipped."""
+        self.follows = False
+
+    def add(self, lineno, date, balance, *amounts):
+        """Check the balance of the next row.
+
+        Args:
+          lineno: The line number of the row.
+          date: The date of the row, not before the ones of the rows added.
+          balance: A Decimal, the balance of the row, or None.
+          amounts: Decimals, the amounts of the row, or None.
+        Returns:
+          The balance entry of the period ending before the row, if any.
+        """
+        entry = None
+        if (self.interval and self.date is not None and
+                self._period(date) > self._period(self.date)):
+            entry = self._balance_entry(self.lineno, self._next_period(self.date))
+
+        if balance is not None and self.follows:
+            expected = self.balance + sum(amount for amount in amounts if amount is not None)
+            if expected != balance:
+                self.divergences += 1
+                if self.divergence is None:
+                    self.divergence = (lineno, balance, expected)
+        self.follows = balance is not None
+        self.balance, self.date, self.lineno = balance, date, lineno
+        return entry
+
+    def finish(self, lineno):
+        """Make the balance entry after the last row.
+
+        Args:
+          lineno: The line number of the balance entry.
+        Returns:
+          A data.Balance instance, or None without a balance on the last row.
+        """
+        if self.date is None:
+            return None
+        return self._balance_entry(lineno, self.date + datetime.timedelta(days=1))
+
+    def report(self, profiler=None):
+        """Log the first row whose balance does not add up, if any.
+
+        Args:
+          profiler: An optional Profiler counting the rows which do not.
+        """
+        if profiler is not None and self.divergences:
+            profiler.count('balance_divergences', self.divergences)
+        if self.divergence is not None:
+            lineno, balance, expected = self.divergence
+            logging.warning("%s:%d: balance %s does not follow from the previous row, "
+                            "%s expected (%d rows do not add up)", self.filename, lineno,
+                            balance, expected, self.divergences)
+
+
+# A time of day, which may follow a date or stand alone in a time column.
+_TIME_FORMAT = r'(?P<hour>\d{1,2}):(?P<minute>\d{2})(?::(?P<second>\d{2}))?'
+
+# The fixed date formats of the fast path of DateParser, by field order.
+_DATE_FORMATS = {
+    'YMD': r'(?P<year>\d{4})(?P<sep>[-/.])(?P<month>\d{1,2})(?P=sep)(?P<day>\d{1,2})',
+    'YMD_COMPACT': r'(?P<year>\d{4})(?P<month>\d{2})(?P<day>\d{2})',
+    'MDY': r'(?P<month>\d{1,2})(?P<sep>[-/.])(?P<day>\d{1,2})(?P=sep)(?P<year>\d{4})',
+    'DMY': r'(?P<day>\d{1,2})(?P<sep>[-/.])(?P<month>\d{1,2})(?P=sep)(?P<year>\d{4})',
+}
+
+
+class DateParser:
+    """A memoizing parser for a column of dates or times in a fixed format.
+
+    The first values of the column are parsed by dateutil, and are used to
+    infer which one of the fixed formats the column uses: only the formats
+    giving the very same results as dateutil are kept. The following values
+    go through the precompiled regular expression of that format, and fall
+    back to dateutil only when they do not match it. Dates whose month and day
+    could be swapped are ordered by dateutil by rules of its own, like
+    dayfirst, rather than by the samples: the first one is checked against
+    dateutil, and if they disagree, all of them go through dateutil. Results
+    are memoized in an LRU cache, since statements repeat the same timestamps
+    a lot.
+    """
+
+    def __init__(self, dateutil_kwds: Optional[Dict]=None,
+                 want_time: bool=False,
+                 samples: int=DATE_INFER_SAMPLES,
+                 cache_size: int=DATE_CACHE_SIZE):
+        """Constructor.
+
+        Args:
+          dateutil_kwds: An optional dict defining the dateutil parser kwargs.
+          want_time: If true, parse the time of day as a string like
+            '14:17:00', instead of the date.
+          samples: The number of values used to infer the format.
+          cache_size: The maximum number of memoized values.
+        """
+        self.dateutil_kwds = dateutil_kwds or {}
+        self.want_time = want_time
+        self.samples = samples
+
+        order = ['YMD', 'YMD_COMPACT', 'MDY', 'DMY']
+        if self.dateutil_kwds.get('dayfirst'):
+            order = ['YMD', 'YMD_COMPACT', 'DMY', 'MDY']
+        formats = [_DATE_FORMATS[name] + '(?:[ T]' + _TIME_FORMAT + ')?'
+                   for name in order]
+        if want_time:
+            formats.append(_TIME_FORMAT)
+        self.candidates = [re.compile(r'\s*' + fmt + r'\s*') for fmt in formats]
+        self.pattern = None
+        # Whether dateutil orders the ambiguous dates like the pattern does,
+        # or None until one was checked.
+        self.ambiguous_ok = None
+
+        self.parse = functools.lru_cache(maxsize=cache_size)(self._parse)
+
+    def _parse(self, string):
+        if self.pattern is not None:
+            match = self.pattern.fullmatch(string)
+            if match:
+                try:
+                    value = self._convert(match)
+                except ValueError:
+                    pass
                 else:
-                    # Primary posting
-                    # Rename primary account if remark field matches one of assets account
-                    primary_account = mapping_account(self.assets_account, remark)
-                    txn.postings.append(
-                        data.Posting(primary_account, units, None, None, None, None))
-                    
-                    # Secondary posting
-                    # Rename secondary account by credit account or debit account based on DRCR status
-                    payee_narration = payee + narration
-                    _account = self.credit_account if DRCR_status == Debit_or_credit.CREDIT else self.debit_account
-                    secondary_account = mapping_account(_account, payee_narration)
-#                    secondary_account = _account[DEFAULT]
-#                    for key in _account.keys():
-#                        if key == DEFAULT:
-#                            continue
-#                        if re.search(key, payee_narration):
-#                            secondary_account = _account[key]
-#                            break
-                    txn.postings.append(
-                        data.Posting(secondary_account, None, None, None, None, None))
-
-            # Attach the other posting(s) to the transaction.
-            if isinstance(self.categorizer, collections.Callable):
-                txn = self.categorizer(txn)
-
-            # Add the transaction to the output list
-            entries.append(txn)
-
-        # Figure out if the file is in ascending or descending order.
-        first_date = parse_date_liberally(get(first_row, Col.DATE),
-                                          self.dateutil_kwds)
-        last_date = parse_date_liberally(get(last_row, Col.DATE),
-                                         self.dateutil_kwds)
-        is_ascending = first_date < last_date
-
-        # Reverse the list if the file is in descending order
-        if not is_ascending:
-            entries = list(reversed(entries))
-
-        # Add a balance entry if possible
-        if Col.BALANCE in iconfig and entries:
-            entry = entries[-1]
-            date = entry.date + datetime.timedelta(days=1)
-            balance = entry.meta.get('balance', None)
-            if balance:
-                meta = data.new_metadata(file.name, index)
-                entries.append(
-                    data.Balance(meta, date,
-                                 self.default_account, Amount(balance, self.currency),
-                                 None, None))
-
-        # Remove the 'balance' metadta.
-        for entry in entries:
-            entry.meta.pop('balance', None)
-
-        return entries
+                    if self.ambiguous_ok or not self._is_ambiguous(match):
+                        return value
+                    liberal_value = self._parse_liberally(string)
+                    if self.ambiguous_ok is None:
+                        self.ambiguous_ok = liberal_value == value
+                    return liberal_value
+            return self._parse_liberally(string)
+
+        # Still inferring: keep the formats which agree with dateutil.
+        value = self._parse_liberally(string)
+        if self.candidates:
+            candidates = []
+            for candidate in self.candidates:
+                match = candidate.fullmatch(string)
+                try:
+                    if match and self._convert(match) == value:
+                        candidates.append(candidate)
+                except ValueError:
+                    pass
+            self.candidates = candidates
+            self.samples -= 1
+            if self.samples <= 0 and candidates:
+                self.pattern = candidates[0]
+        return value
+
+    def _is_ambiguous(self, match):
+        """Tell if the month and the day of a matched date could be swapped."""
+        if self.want_time:
+            return False
+        month, day = int(match.group('month')), int(match.group('day'))
+        return month != day and month <= 12 and day <= 12
+
+    def _convert(self, match):
+        if self.want_time:
+            hour, minute, second = match.group('hour', 'minute', 'second')
+            return str(datetime.time(int(hour or 0), int(minute or 0), int(second or 0)))
+        year, month, day = match.group('year', 'month', 'day')
+        return datetime.date(int(year), int(month), int(day))
+
+    def _parse_liberally(self, string):
+        # Imported here, dateutil is only loaded by the first extraction.
+        if self.want_time:
+            import dateutil.parser
+            return str(dateutil.parser.parse(string, **self.dateutil_kwds).time())
+        from beancount.utils.date_utils import parse_date_liberally
+        return parse_date_liberally(string, self.dateutil_kwds)
+
+
+def _quote_parity(tail, quote, delimiter):
+    """Find the parity of the number of quotes before a piece of a CSV file.
+
+    A quote followed by a character other than a quote, the delimiter or a
+    line ending leaves a quoted field open, and a quote after such a character
+    closes one, so either tells the parity from the quotes before it.
+
+    Args:
+      tail: A bytes object, the piece of the file.
+      quote: A bytes object, the quote character.
+      delimiter: A bytes object, the delimiter character.
+    Returns:
+      0 or 1, or None if the piece has no such quote.
+    """
+    other = b'[^' + re.escape(quote + delimiter) + b'\r\n]'
+    match = re.search(re.escape(quote) + other + b'|' + other + re.escape(quote), tail)
+    if match is None:
+        return None
+    if match.group().startswith(quote):
+        return (tail.count(quote, 0, match.start() + 1) + 1) % 2
+    return tail.count(quote, 0, match.end()) % 2
+
+
+def read_last_row(filename, dialect: Union[str, csv.Dialect]='excel'):
+    """Read the last row of a CSV file without parsing the rows before it.
+
+    A line ending ends a record only if the number of quotes before it is
+    even, as quoted fields may span several lines. The file is read backwards
+    block by block from its end, and only the records looked at are decoded.
+    As a file ends out of quotes, the parity of the quotes before the blocks
+    read is the one of the quotes within them. It is checked against the
+    quotes opening or closing a field, and only if they disagree, like in a
+    file ending in an unterminated field, are the quotes of the whole file
+    counted. Empty rows and comment rows are skipped, like in
+    Importer.extract().
+
+    Args:
+      filename: A path string.
+      dialect: A `csv` dialect given either as string or as instance or
+        subclass of `csv.Dialect`.
+    Returns:
+      A list of the stripped fields of the last row, or None.
+    """
+    encoding = file_encoding(filename)
+    dialect_instance = csv.get_dialect(dialect) if isinstance(dialect, str) else dialect
+    quote = (dialect_instance.quotechar or '"').encode('ascii')
+    delimiter = dialect_instance.delimiter.encode('ascii')
+    with open(filename, 'rb') as infile:
+        # The number of quotes of the file, if they had to be counted.
+        quotes = None
+        position = infile.seek(0, os.SEEK_END)
+        tail = b''
+        while position > 0:
+            size = min(TAIL_BLOCK_SIZE, position)
+            position -= size
+            infile.seek(position)
+            tail = infile.read(size) + tail
+
+            # The parity of the quotes before the tail.
+            if position == 0:
+                parity = 0
+            elif quotes is not None:
+                parity = (quotes - tail.count(quote)) % 2
+            else:
+                parity = tail.count(quote) % 2
+                if _quote_parity(tail, quote, delimiter) not in (None, parity):
+                    infile.seek(0)
+                    quotes = sum(block.count(quote) for block in
+                                 iter(lambda: infile.read(TAIL_BLOCK_SIZE * 128), b''))
+                    parity = (quotes - tail.count(quote)) % 2
+
+            # Find the starts of the records of the tail: the start of the
+            # file, and the line endings after an even number of quotes.
+            starts = [0] if position == 0 else []
+            count = parity
+            start = 0
+            while True:
+                newline = tail.find(b'\n', start)
+                if newline < 0:
+                    break
+                count += tail.count(quote, start, newline + 1)
+                start = newline + 1
+                if count % 2 == 0:
+                    starts.append(start)
+            ends = starts[1:] + [len(tail)]
+            for start, end in reversed(list(zip(starts, ends))):
+                row = decode_row(tail[start:end].rstrip(b'\r\n'), encoding, dialect)
+                if row and not row[0].startswith('#'):
+                    return row
+    return None
 
 
 def normalize_config(config, head):
@@ -515,25 +1409,101 @@ def normalize_config(config, head):
         entirely of integer indexes.
     """
     has_header = csv.Sniffer().has_header(head)
+    header = next(csv.reader(io.StringIO(head))) if has_header else None
+    return index_config(config, has_header, header), has_header
+
+
+def index_config(config, has_header, header):
+    """Convert the configuration field name lookups to int indexes of a header.
+
+    Args:
+      config: A dict of Col types to string or indexes.
+      has_header: A boolean, true if the file has a header.
+      header: A list of the field names of the header line, or None.
+    Returns:
+      A dict of Col types to integer indexes of the fields.
+    Raises:
+      ValueError: If there is no header and the configuration does not consist
+        entirely of integer indexes.
+    """
     if has_header:
-        header = next(csv.reader(io.StringIO(head)))
         field_map = {field_name.strip(): index
                      for index, field_name in enumerate(header)}
-        index_config = {}
+        iconfig = {}
         for field_type, field in config.items():
             if isinstance(field, str):
                 try:
                     field = field_map[field]
                 except KeyError:
                     break
-            index_config[field_type] = field
+            iconfig[field_type] = field
     else:
         if any(not isinstance(field, int)
                for field_type, field in config.items()):
             raise ValueError("CSV config without header has non-index fields: "
                              "{}".format(config))
-        index_config = config
-    return index_config, has_header
+        iconfig = config
+    return iconfig
+
+
+# A cache of file identity (name, size, mtime) to its sniffed header, and of
+# (header, config) to the normalized configuration, of the last files used.
+_HEADER_CACHE = LRUCache()
+_INDEX_CONFIG_CACHE = LRUCache()
+
+
+def sniff_header(file):
+    """Detect the header of a file, sniffing only a bounded prefix of it.
+
+    The result is cached by file identity, so the file is sniffed once however
+    many importers and methods ask for it.
+
+    Args:
+      file: A cache.FileMemo instance.
+    Returns:
+      A pair of
+        a boolean, true if the file has a header, and
+        a tuple of the field names of the header line, or None.
+    """
+    key = file_identity(file.name)
+    try:
+        return _HEADER_CACHE[key]
+    except KeyError:
+        pass
+    head = read_head(file.name, SNIFF_MAX_BYTES)
+    # Do not let a truncated last line confuse the sniffer.
+    if key[1] > SNIFF_MAX_BYTES and '\n' in head:
+        head = head[:head.rindex('\n') + 1]
+    has_header = csv.Sniffer().has_header(head)
+    header = tuple(next(csv.reader(io.StringIO(head)))) if has_header else None
+    _HEADER_CACHE[key] = has_header, header
+    return has_header, header
+
+
+def normalize_file_config(config, file):
+    """Like normalize_config(), but from a file whose header is sniffed once.
+
+    Importers sharing the same configuration and header share the result.
+
+    Args:
+      config: A dict of Col types to string or indexes.
+      file: A cache.FileMemo instance.
+    Returns:
+      A pair of
+        A dict of Col types to integer indexes of the fields, and
+        a boolean, true if the file has a header.
+    Raises:
+      ValueError: If there is no header and the configuration does not consist
+        entirely of integer indexes.
+    """
+    has_header, header = sniff_header(file)
+    key = (header, tuple(config.items()))
+    try:
+        return _INDEX_CONFIG_CACHE[key], has_header
+    except KeyError:
+        pass
+    iconfig = _INDEX_CONFIG_CACHE[key] = index_config(config, has_header, header)
+    return iconfig, has_header
 
 
 def mapping_account(account_map, keyword):
@@ -556,4 +1526,233 @@ def mapping_account(account_map, keyword):
         if re.search(account_keywords, keyword):
             account_name = account_map[account_keywords]
             break
-    return account_name
\ No newline at end of file
+    return account_name
+
+
+# The characters which make an account keyword a regular expression rather
+# than a plain literal.
+_REGEX_METACHARACTERS = frozenset('.^$*+?{}[]\\|()')
+
+# The group references and global inline flags of a regular expression key,
+# which would change meaning once the key is merged with other keys.
+_UNMERGEABLE_RE = re.compile(r'\\[1-9]|\\g<|\(\?P=|\(\?\(|\(\?[aiLmsux]+\)')
+
+
+class AccountClassifier:
+    """A compiled equivalent of mapping_account() for a fixed account map.
+
+    The plain literal keywords of all the keys are merged into one Aho-Corasick
+    automaton, so the text is scanned once whatever the number of keys. Keys
+    which are real regular expressions are merged into a single compiled
+    regex, one lookahead branch per key tried in insertion order. The keys
+    which cannot be merged, because they refer to their own groups, set
+    global flags or name the same groups as other keys, are tried one by one.
+    Either way, the first key in insertion order which occurs in the text
+    wins, exactly like the linear scan of mapping_account().
+    """
+
+    def __init__(self, account_map):
+        """Constructor.
+
+        Args:
+          account_map: A dict of account keywords string (each keyword
+            separated by "|") to account name.
+        Raises:
+          KeyError: If "DEFAULT" keyword is not in account_map.
+          re.error: If a key is not a valid regular expression.
+        """
+        if DEFAULT not in account_map:
+            raise KeyError("DEFAULT is not in {}".format(account_map))
+        self.default = account_map[DEFAULT]
+        self.accounts = []
+
+        # The automaton: goto transitions, failure links and, for each state,
+        # the lowest key index of all the keywords ending at that state.
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [None]
+
+        regexps = []
+        for account_keywords, account_name in account_map.items():
+            if account_keywords == DEFAULT:
+                continue
+            index = len(self.accounts)
+            self.accounts.append(account_name)
+            literals = account_keywords.split('|')
+            if all(literal and _REGEX_METACHARACTERS.isdisjoint(literal)
+                   for literal in literals):
+                for literal in literals:
+                    self._add_literal(literal, index)
+            else:
+                regexps.append((index, account_keywords))
+        self._build_failure_links()
+
+        # The merged regex, and the (index, compiled regex) pairs of the keys
+        # tried one by one, in insertion order.
+        self.regexp = None
+        self.merge_error = None
+        merged = [(index, account_keywords) for index, account_keywords in regexps
+                  if not _UNMERGEABLE_RE.search(account_keywords)]
+        if merged:
+            try:
+                self.regexp = re.compile('|'.join(
+                    r'(?P<_{}>(?=[\s\S]*?(?:{})))'.format(index, account_keywords)
+                    for index, account_keywords in merged))
+            except re.error as exc:
+                self.merge_error = str(exc)
+                merged = []
+        merged_indexes = set(index for index, _ in merged)
+        self.patterns = [(index, re.compile(account_keywords))
+                         for index, account_keywords in regexps
+                         if index not in merged_indexes]
+
+    def _add_literal(self, literal, index):
+        state = 0
+        for char in literal:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = self._goto[state][char] = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(None)
+            state = next_state
+        if self._output[state] is None or index < self._output[state]:
+            self._output[state] = index
+
+    def _build_failure_links(self):
+        no_match = len(self.accounts)
+        self._output[0] = no_match
+        queue = collections.deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            fail_output = self._output[self._fail[state]]
+            if self._output[state] is None or fail_output < self._output[state]:
+                self._output[state] = fail_output
+            for char, next_state in self._goto[state].items():
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                queue.append(next_state)
+
+    def classify(self, keyword):
+        """Return the account of the first key which occurs in the keyword.
+
+        Args:
+          keyword: A keyword string.
+        Return:
+          An account name string, the default account if no key matches.
+        """
+        account = self.find(keyword)
+        return self.default if account is None else account
+
+    def find(self, keyword):
+        """Like classify(), but return None if no key matches."""
+        if keyword is None:
+            return None
+        goto, fail, output = self._goto, self._fail, self._output
+        best = output[0]
+        state = 0
+        for char in keyword:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state] < best:
+                best = output[state]
+                if best == 0:
+                    break
+        if self.regexp is not None and best:
+            match = self.regexp.match(keyword)
+            if match:
+                best = min(best, int(match.lastgroup[1:]))
+        for index, pattern in self.patterns:
+            if index >= best:
+                break
+            if pattern.search(keyword):
+                best = index
+                break
+        return self.accounts[best] if best < len(self.accounts) else None
+
+
+class TransferResolver:
+    """Resolve the remarks of uncertain rows into transfers between accounts.
+
+    A transfer remark names the account the money comes from and the one it
+    goes to, separated by a dash, like "余额宝-招行储蓄卡". All the pairs of
+    the literal keywords of the assets accounts are resolved in advance into a
+    lookup table. Other remarks are resolved by the classifier the first time
+    they are seen, then added to the table, up to TRANSFER_CACHE_SIZE of them.
+
+    Remarks which are not a pair, or with a side matching no keyword, go to
+    the default accounts as before, and are counted in `unresolved` so that
+    they can be reported all together once the file is extracted.
+    """
+
+    def __init__(self, classifier, account_map, default_account):
+        """Constructor.
+
+        Args:
+          classifier: The AccountClassifier of account_map.
+          account_map: A dict of account keywords string (each keyword
+            separated by "|") to account name, the assets accounts.
+          default_account: The account of the remarks which are not a pair.
+        """
+        self.classifier = classifier
+        self.default_account = default_account
+        self.unresolved = collections.Counter()
+        keywords = [literal
+                    for account_keywords in account_map
+                    if account_keywords != DEFAULT
+                    for literal in account_keywords.split('|')
+                    if literal and '-' not in literal
+                    and _REGEX_METACHARACTERS.isdisjoint(literal)]
+        # A dict of remark to the triple of _posting_accounts(), and whether
+        # both of its sides match a keyword.
+        self.table = {}
+        for source, target in itertools.product(keywords, repeat=2):
+            remark = '{}-{}'.format(source, target)
+            self.table[remark] = self._resolve(remark)
+        self.max_size = len(self.table) + TRANSFER_CACHE_SIZE
+
+    def _resolve(self, remark):
+        remarks = remark.split("-")
+        if len(remarks) != 2:
+            return (self.default_account, False, None), False
+        primary_account = self.classifier.find(remarks[1])
+        secondary_account = self.classifier.find(remarks[0])
+        resolved = primary_account is not None and secondary_account is not None
+        if primary_account is None:
+            primary_account = self.classifier.default
+        if secondary_account is None:
+            secondary_account = self.classifier.default
+        return (primary_account, True, secondary_account), resolved
+
+    def resolve(self, remark):
+        """Find the accounts of a transfer remark.
+
+        Args:
+          remark: A remark string, or None.
+        Returns:
+          A triple of the primary account, whether the units are negated on
+          it, and the secondary account, like Importer._posting_accounts().
+        """
+        if not remark:
+            return self.default_account, False, None
+        try:
+            accounts, resolved = self.table[remark]
+        except KeyError:
+            accounts, resolved = self._resolve(remark)
+            if len(self.table) < self.max_size:
+                self.table[remark] = accounts, resolved
+        if not resolved:
+            self.unresolved[remark] += 1
+        return accounts
+
+    def drain(self):
+        """Return the unresolved remarks counted so far, and forget them.
+
+        Returns:
+          A Counter of remark strings, in the order they were first seen.
+        """
+        unresolved, self.unresolved = self.unresolved, collections.Counter()
+        return unresolved
@@ -0,0 +1,298 @@
+"""A columnar extraction backend for very large statements.
+
+Importer.extract() works row by row: every row goes through the status
+filter, the debit/credit mapping, the amount parsing and the account
+classification on its own. For bulk back-fills, extract() here loads the
+configured columns of the statement into lists instead, and computes each of
+those steps as a batch over whole columns. Statements repeat the same
+statuses, amounts, dates, remarks and payees a lot, so every batch step is
+evaluated once per distinct value (or tuple of values) of its columns. The
+columns of the surviving rows are gathered into RowRecords at the very end,
+and their beancount objects are built by Importer._build_transaction(), like
+the ones of the row-wise path.
+
+The output is the same as the one of Importer.extract().
+"""
+__copyright__ = "Copyright (C) 2018 Dongchao Li"
+__license__ = "GNU GPLv2"
+
+import functools
+
+from beanmaker import (Col, Debit_or_credit, RowRecord, convert_amounts,
+                       normalize_file_config, open_mapped_rows, parse_balance)
+from fingerprint import FingerprintIndex
+
+
+def map_distinct(function, *columns):
+    """Apply a function to the rows of some columns, once per distinct value.
+
+    Args:
+      function: A callable, taking one argument per column.
+      columns: Lists of values, of the same length.
+    Returns:
+      A list of the results, one per row.
+    """
+    keys = list(zip(*columns))
+    results = {key: function(*key) for key in dict.fromkeys(keys)}
+    return [results[key] for key in keys]
+
+
+class Table:
+    """The configured columns of the data rows of a statement.
+
+    Attributes:
+      indexes: A list of the line numbers of the rows, as in extract().
+      segments: A list of the number of runs of rows skipped before each
+        row, so that the balances of two rows only follow each other if
+        their segments are the same.
+      columns: A dict of Col to the list of values of the column.
+      first_row: The first data row of the statement, or None.
+      last_row: The last data row of the statement, or None.
+    """
+
+    def __init__(self, iconfig):
+        self.iconfig = iconfig
+        self.indexes = []
+        self.segments = []
+        self.skipped = 0
+        self.columns = {ftype: [] for ftype in iconfig}
+        self.first_row = self.last_row = None
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def append(self, index, row):
+        """Add a row, keeping only its configured columns."""
+        self.indexes.append(index)
+        self.segments.append(self.skipped)
+        for ftype, column in self.columns.items():
+            try:
+                column.append(row[self.iconfig[ftype]])
+            except IndexError:  # FIXME: this should not happen
+                column.append(None)
+
+    def column(self, ftype):
+        """Get a column, all None if it is not configured."""
+        column = self.columns.get(ftype)
+        return column if column is not None else [None] * len(self.indexes)
+
+    def get(self, position, ftype):
+        """Get the value of a column in a row, like Importer.extract()."""
+        column = self.columns.get(ftype)
+        return column[position] if column is not None else None
+
+    def get_row(self, row, ftype):
+        """Get the value of a column in a raw row, like Importer.extract()."""
+        try:
+            return row[self.iconfig[ftype]] if ftype in self.iconfig else None
+        except IndexError:  # FIXME: this should not happen
+            return None
+
+
+def load_table(importer, file, iconfig, has_header, seen=None):
+    """Read the data rows of a statement into a Table.
+
+    Args:
+      importer: A beanmaker.Importer instance.
+      file: A cache.FileMemo instance.
+      iconfig: A dict of Col to row index.
+      has_header: A boolean, true if the file has a header.
+      seen: An optional FingerprintIndex. If given, the rows it contains are
+        skipped and the others are claimed in it.
+    Returns:
+      A pair of the Table, and the line number of the last line read.
+    """
+    table = Table(iconfig)
+    index = 0
+    columns = importer._row_columns(iconfig)
+    with open_mapped_rows(file.name, columns, importer.csv_dialect) as rows:
+        reader = iter(rows)
+        for _ in range(importer.skip_lines):
+            next(reader)
+        if has_header:
+            next(reader)
+        for index, row in enumerate(reader, 1):
+            if not row:
+                continue
+            if row[0].startswith('#'):
+                continue
+            if importer.debug:
+                print(row)
+
+            # Remember the first row and the last, to find the sort order.
+            if table.first_row is None:
+                table.first_row = row
+            table.last_row = row
+
+            # Skip the rows imported by a previous run.
+            if seen is not None:
+                fingerprint = importer._fingerprint(iconfig, table.get_row, row)
+                if not seen.claim(fingerprint):
+                    table.skipped += 1
+                    continue
+            table.append(index, row)
+    return table, index
+
+
+def debit_or_credit_statuses(importer, iconfig, table, positions):
+    """Batch equivalent of get_debit_or_credit_status() over a Table."""
+    if Col.AMOUNT in iconfig:
+        if Col.DRCR not in iconfig:
+            return [Debit_or_credit.UNCERTAINTY] * len(positions)
+        column = table.column(Col.DRCR)
+        return map_distinct(
+            lambda value: importer.DRCR_dict.get(value, Debit_or_credit.UNCERTAINTY),
+            [column[position] for position in positions])
+    credit = table.column(Col.AMOUNT_CREDIT)
+    debit = table.column(Col.AMOUNT_DEBIT)
+    has_credit = Col.AMOUNT_CREDIT in iconfig
+    has_debit = Col.AMOUNT_DEBIT in iconfig
+
+    def status(credit, debit):
+        if has_credit and credit:
+            return Debit_or_credit.CREDIT
+        elif has_debit and debit:
+            return Debit_or_credit.DEBIT
+        return Debit_or_credit.UNCERTAINTY
+    return map_distinct(status,
+                        [credit[position] for position in positions],
+                        [debit[position] for position in positions])
+
+
+def amounts(iconfig, table, positions, statuses):
+    """Batch equivalent of get_amounts() over a Table."""
+    if Col.AMOUNT in iconfig:
+        column = table.column(Col.AMOUNT)
+        values = [column[position] for position in positions]
+        credits = [value if status == Debit_or_credit.CREDIT else None
+                   for value, status in zip(values, statuses)]
+        debits = [None if status == Debit_or_credit.CREDIT else value
+                  for value, status in zip(values, statuses)]
+    else:
+        debit = table.column(Col.AMOUNT_DEBIT)
+        credit = table.column(Col.AMOUNT_CREDIT)
+        debits = [debit[position] for position in positions]
+        credits = [credit[position] for position in positions]
+    return map_distinct(convert_amounts, debits, credits)
+
+
+def narrations(importer, table, positions):
+    """Compute the payee and narration columns, like Importer.extract()."""
+    payee = table.column(Col.PAYEE)
+    narration1 = table.column(Col.NARRATION1)
+    narration2 = table.column(Col.NARRATION2)
+
+    def narration(first, second):
+        fields = filter(None, [first, second])
+        return importer.narration_sep.join(field.strip() for field in fields)
+    payees = [payee[position].strip() if payee[position] else payee[position]
+              for position in positions]
+    return payees, map_distinct(narration,
+                                [narration1[position] for position in positions],
+                                [narration2[position] for position in positions])
+
+
+def extract(importer, file):
+    """Extract the directives of a statement through the columnar backend.
+
+    Args:
+      importer: A beanmaker.Importer instance.
+      file: A cache.FileMemo instance.
+    Returns:
+      A list of beancount.core.data objects, the same as importer.extract().
+    """
+    iconfig, has_header = normalize_file_config(importer.config, file)
+    seen = FingerprintIndex(importer.fingerprint_index) if importer.fingerprint_index else None
+    try:
+        entries = _extract(importer, file, iconfig, has_header, seen)
+        if seen is not None:
+            seen.commit()
+    finally:
+        if seen is not None:
+            seen.close()
+    return entries
+
+
+def _extract(importer, file, iconfig, has_header, seen):
+    table, index = load_table(importer, file, iconfig, has_header, seen)
+    if table.first_row is None:
+        return []
+    date_parsers, stages = importer._extract_stages(lambda name, function: function)
+
+    # Figure out if the file is in ascending or descending order.
+    first_date = date_parsers[Col.DATE].parse(table.get_row(table.first_row, Col.DATE))
+    last_date = date_parsers[Col.DATE].parse(table.get_row(table.last_row, Col.DATE))
+    is_ascending = first_date < last_date
+
+    # Filter out the closed transactions.
+    close_flag = importer.close_flag
+    closed = map_distinct(lambda status: isinstance(status, str) and status == close_flag,
+                          table.column(Col.STATUS))
+    positions = [position for position, is_closed in enumerate(closed) if not is_closed]
+
+    # Distinguish debit or credit, and parse the amounts.
+    statuses = debit_or_credit_statuses(importer, iconfig, table, positions)
+    amount_pairs = amounts(iconfig, table, positions, statuses)
+
+    # Parse the dates, and the other columns of the metadata.
+    def parsed(ftype):
+        column = table.column(ftype)
+        parse = date_parsers[ftype].parse
+        return [parse(column[position]) if column[position] is not None else None
+                for position in positions]
+    txn_dates = parsed(Col.TXN_DATE)
+    txn_times = parsed(Col.TXN_TIME)
+    dates = parsed(Col.DATE)
+    balance_column = table.column(Col.BALANCE)
+    balances = map_distinct(parse_balance, [balance_column[position] for position in positions])
+    payees, narration_column = narrations(importer, table, positions)
+    remark_column = table.column(Col.REMARK)
+
+    # Classify the accounts once per distinct status, remark, payee and
+    # narration, as the transactions are built. The transfers of uncertain
+    # rows are resolved row by row, for their unresolved remarks to be counted
+    # per row like in the row-wise path; the resolver memoizes them anyway.
+    classify = functools.lru_cache(maxsize=None)(importer._posting_accounts)
+    resolve = importer.transfer_resolver.resolve
+
+    def posting_accounts(DRCR_status, remark, payee, narration):
+        if DRCR_status == Debit_or_credit.UNCERTAINTY:
+            return resolve(remark)
+        return classify(DRCR_status, remark, payee, narration)
+    stages['posting_accounts'] = posting_accounts
+
+    # Gather the rows which survived into records, with None between the rows
+    # around a run of rows skipped by the fingerprint index.
+    records = []
+    segment = 0
+    for number, position in enumerate(positions):
+        amount_debit, amount_credit = amount_pairs[number]
+        if amount_debit is None and amount_credit is None:
+            continue
+        if table.segments[position] != segment:
+            segment = table.segments[position]
+            records.append(None)
+        record = RowRecord()
+        record.index = table.indexes[position]
+        record.DRCR_status = statuses[number]
+        record.amount_debit = amount_debit
+        record.amount_credit = amount_credit
+        record.date = dates[number]
+        record.txn_date = txn_dates[number]
+        record.txn_time = txn_times[number]
+        record.payee = payees[number]
+        record.narration = narration_column[number]
+        record.remark = remark_column[position]
+        record.tag = table.get(position, Col.TAG)
+        record.last4 = table.get(position, Col.LAST4)
+        record.balance = balances[number]
+        records.append(record)
+
+    # Build their transactions in date order, like Importer.extract().
+    entries = list(importer._ordered_entries(
+        file, iconfig, records, is_ascending,
+        functools.partial(importer._build_transaction, file, stages, None),
+        lambda: index))
+
+    importer.report_unresolved_transfers(file)
+    return entries
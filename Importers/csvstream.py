@@ -0,0 +1,303 @@
+"""Streaming access to the CSV statements, decoded and normalized on the fly.
+
+Statements are exported either in GBK (Alipay, banks) or in UTF-8, possibly
+with a BOM, with DOS line endings and blanks around the fields. Instead of
+converting them to temporary files with iconv, dos2unix and strip_blank.py,
+the encoding is detected from a prefix of the file, and the file is decoded
+incrementally while the rows are read, with universal newlines and stripped
+fields.
+
+For large statements, open_mapped_rows() reads the rows from a memory map of
+the file instead, and only decodes the columns asked for.
+"""
+__copyright__ = "Copyright (C) 2018 Dongchao Li"
+__license__ = "GNU GPLv2"
+
+import codecs
+import collections
+import contextlib
+import csv
+import functools
+import mmap
+import os
+from typing import Union
+
+# Maximum number of bytes of the head of a file used to detect its encoding.
+DETECT_MAX_BYTES = 64 * 1024
+
+# The encoding of statements which are not UTF-8. GB18030 is a superset of
+# GBK, so it decodes GBK exports as well.
+FALLBACK_ENCODING = 'gb18030'
+
+# Delimiters which never occur inside a multibyte character of UTF-8 or
+# GB18030, so that the rows can be split before being decoded.
+MAPPED_DELIMITERS = ',;\t'
+
+# Number of files whose encoding, header and importers are cached, so that
+# the caches of a long-running process do not grow without bound.
+FILE_CACHE_SIZE = 256
+
+
+class LRUCache(collections.OrderedDict):
+    """A dict which only keeps its maxsize most recently used items."""
+
+    def __init__(self, maxsize: int=FILE_CACHE_SIZE):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        while len(self) > self.maxsize:
+            self.popitem(last=False)
+
+
+# A cache of file identity to its detected encoding.
+_ENCODING_CACHE = LRUCache()
+
+
+def file_identity(filename):
+    """Get a key which changes whenever the given file is modified.
+
+    Args:
+      filename: A path string.
+    Returns:
+      A tuple of the file name, size and modification time.
+    """
+    stat = os.stat(filename)
+    return (filename, stat.st_size, stat.st_mtime_ns)
+
+
+def detect_encoding(prefix):
+    """Detect the encoding of a statement from the first bytes of it.
+
+    Args:
+      prefix: A bytes object, the head of the file.
+    Returns:
+      A codec name string: 'utf-8-sig' if the file starts with a UTF-8 BOM,
+      'utf-8' if the prefix is valid UTF-8, FALLBACK_ENCODING otherwise.
+    """
+    if prefix.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    try:
+        # The prefix may end in the middle of a character: not final.
+        codecs.getincrementaldecoder('utf-8')().decode(prefix, final=False)
+    except UnicodeDecodeError:
+        return FALLBACK_ENCODING
+    return 'utf-8'
+
+
+def file_encoding(filename):
+    """Detect the encoding of a file, once per file identity.
+
+    Args:
+      filename: A path string.
+    Returns:
+      A codec name string.
+    """
+    key = file_identity(filename)
+    try:
+        return _ENCODING_CACHE[key]
+    except KeyError:
+        pass
+    with open(filename, 'rb') as infile:
+        prefix = infile.read(DETECT_MAX_BYTES)
+    encoding = _ENCODING_CACHE[key] = detect_encoding(prefix)
+    return encoding
+
+
+def read_head(filename, num_bytes):
+    """Read and decode the head of a file, with normalized line endings.
+
+    Args:
+      filename: A path string.
+      num_bytes: The maximum number of bytes to read.
+    Returns:
+      A string. An incomplete character at the end of the bytes read is
+      dropped.
+    """
+    with open(filename, 'rb') as infile:
+        prefix = infile.read(num_bytes)
+    decoder = codecs.getincrementaldecoder(file_encoding(filename))(errors='replace')
+    return decoder.decode(prefix, final=False).replace('\r\n', '\n').replace('\r', '\n')
+
+
+def open_text(filename):
+    """Open a statement as a text file, decoded incrementally.
+
+    Line endings are translated to '\\n' by the universal newlines mode.
+
+    Args:
+      filename: A path string.
+    Returns:
+      A text file object.
+    """
+    return open(filename, encoding=file_encoding(filename))
+
+
+def strip_row(row):
+    """Strip the blanks around each field of a row.
+
+    Args:
+      row: A list of strings.
+    Returns:
+      A new list of strings.
+    """
+    return list(map(str.strip, row))
+
+
+def decode_row(line, encoding, dialect: Union[str, csv.Dialect]='excel'):
+    """Parse a single encoded line of a statement into a stripped row.
+
+    Args:
+      line: A bytes object, without its line ending.
+      encoding: A codec name string.
+      dialect: A `csv` dialect given either as string or as instance or
+        subclass of `csv.Dialect`.
+    Returns:
+      A list of strings, empty for an empty line.
+    """
+    row = next(csv.reader([line.decode(encoding, errors='replace')], dialect=dialect), [])
+    return strip_row(row)
+
+
+@contextlib.contextmanager
+def open_rows(filename, dialect: Union[str, csv.Dialect]='excel'):
+    """Read the rows of a statement, decoded and stripped as they are read.
+
+    Args:
+      filename: A path string.
+      dialect: A `csv` dialect given either as string or as instance or
+        subclass of `csv.Dialect`.
+    Yields:
+      An iterator of rows, lists of stripped strings.
+    """
+    with open_text(filename) as infile:
+        yield map(strip_row, csv.reader(infile, dialect=dialect))
+
+
+def normalize(filename, outfile):
+    """Write a statement as UTF-8 CSV with every field stripped and quoted.
+
+    This is what iconv, dos2unix and strip_blank.py used to do, in a single
+    streaming pass.
+
+    Args:
+      filename: A path string, the statement to read.
+      outfile: A text file object to write to.
+    """
+    with open_rows(filename) as rows:
+        for row in rows:
+            outfile.write(','.join('"{}"'.format(field) for field in row))
+            outfile.write('\n')
+
+
+def supports_mapping(dialect: Union[str, csv.Dialect]='excel'):
+    """Whether the rows of a dialect can be split before being decoded.
+
+    Args:
+      dialect: A `csv` dialect given either as string or as instance or
+        subclass of `csv.Dialect`.
+    Returns:
+      A boolean.
+    """
+    dialect = csv.get_dialect(dialect) if isinstance(dialect, str) else dialect
+    return (dialect.delimiter in MAPPED_DELIMITERS and dialect.quotechar == '"' and
+            dialect.doublequote and not dialect.escapechar and
+            not dialect.skipinitialspace and dialect.quoting != csv.QUOTE_NONE)
+
+
+@contextlib.contextmanager
+def open_mapped_rows(filename, columns=None, dialect: Union[str, csv.Dialect]='excel'):
+    """Read the rows of a statement from a memory map, decoding only some columns.
+
+    Row boundaries and fields are found on the encoded bytes of the mapped
+    file. The fields of the columns not asked for are never decoded, and are
+    None in the rows. Rows which are not plainly delimited (quoted delimiters,
+    escaped quotes, partially quoted rows) are decoded entirely and parsed by
+    the csv module, so the rows are the same as the ones of open_rows().
+
+    Args:
+      filename: A path string.
+      columns: A set of the indexes of the columns to decode, or None to
+        decode them all, through open_rows().
+      dialect: A `csv` dialect given either as string or as instance or
+        subclass of `csv.Dialect`. Dialects not supported by
+        supports_mapping() are read through open_rows().
+    Yields:
+      An iterator of rows, lists of stripped strings or None.
+    """
+    if columns is None or not supports_mapping(dialect):
+        with open_rows(filename, dialect) as rows:
+            yield rows
+        return
+    with open(filename, 'rb') as infile:
+        if os.fstat(infile.fileno()).st_size == 0:
+            yield iter(())
+            return
+        with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            rows = _mapped_rows(buffer, file_encoding(filename), columns, dialect)
+            try:
+                yield rows
+            finally:
+                rows.close()
+
+
+def _mapped_rows(buffer, encoding, columns, dialect):
+    delimiter = (csv.get_dialect(dialect) if isinstance(dialect, str) else dialect).delimiter
+    delimiter = delimiter.encode('ascii')
+    separator = b'"' + delimiter + b'"'
+    columns = sorted(columns)
+    last_column = columns[-1] if columns else -1
+    if encoding == 'utf-8-sig':
+        buffer.seek(len(codecs.BOM_UTF8))
+        encoding = 'utf-8'
+    # bytes.decode() has a fast path for UTF-8 only, use the codec otherwise.
+    if encoding == 'utf-8':
+        decode = bytes.decode
+    else:
+        decode = functools.partial(_decode_field, codecs.getdecoder(encoding))
+
+    for line in iter(buffer.readline, b''):
+        line = line.rstrip(b'\r\n')
+        quotes = line.count(b'"')
+        # A quoted field goes on over the following lines.
+        while quotes % 2:
+            next_line = buffer.readline()
+            if not next_line:
+                break
+            next_line = next_line.rstrip(b'\r\n')
+            line += b'\n' + next_line
+            quotes += next_line.count(b'"')
+
+        if not line:
+            yield []
+            continue
+        if not quotes:
+            fields = line.split(delimiter)
+        elif (line[:1] == b'"' and line[-1:] == b'"' and
+              quotes == 2 * (line.count(delimiter) + 1) and
+              quotes == 2 * (line.count(separator) + 1)):
+            # Every field is quoted, and holds neither quotes nor delimiters.
+            fields = line[1:-1].split(separator)
+        else:
+            fields = None
+        if fields is None or len(fields) <= last_column:
+            # Parse the lines as the csv module does, from their text.
+            lines = [part + '\n' for part in line.decode(encoding).split('\n')]
+            yield from map(strip_row, csv.reader(lines, dialect=dialect))
+            continue
+
+        row = [None] * len(fields)
+        for column in columns:
+            row[column] = decode(fields[column]).strip()
+        yield row
+
+
+def _decode_field(decoder, field):
+    return decoder(field)[0]
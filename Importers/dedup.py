@@ -0,0 +1,258 @@
+"""Cross-file deduplication of the transactions of a batch of statements.
+
+The same payment often shows up in several statements: paid with a bank card
+through Alipay or WeChat, it is in their export and in the one of the bank.
+Two transactions of different files are duplicates if they have the same
+amount, dates at most DATE_WINDOW_DAYS apart, and enough tokens of their
+counterparty in common. The transactions of a single file are never
+duplicates of each other: a statement may well list two identical payments.
+
+Transactions are indexed in hashed buckets keyed by their amount, their date
+and one token of their counterparty. A transaction only looks up the buckets
+of its amount, of the days of its date window and of its tokens, so it is only
+ever compared to the transactions sharing a token with it, and the work grows
+linearly with the number of transactions instead of quadratically.
+
+The hooks can be given to the beancount ingest tools, from a config calling
+ingest() itself:
+
+  scripts_utils.ingest(CONFIG, hooks=[extract.find_duplicate_entries,
+                                      dedup.flag_duplicates])
+
+and batch.py applies them with --dedup.
+"""
+__copyright__ = "Copyright (C) 2018 Dongchao Li"
+__license__ = "GNU GPLv2"
+
+import collections
+import functools
+import re
+
+from beancount.core import data
+
+# Maximum number of days between the dates of two duplicate transactions, as
+# banks post card payments a day or two after the payment.
+DATE_WINDOW_DAYS = 2
+
+# Minimum share of the tokens of the counterparty with fewer tokens which are
+# in the other one.
+MIN_TOKEN_OVERLAP = 0.5
+
+# Maximum number of tokens of a counterparty, to bound the buckets looked up.
+MAX_TOKENS = 16
+
+# Number of counterparties whose tokens are memoized.
+TOKENS_CACHE_SIZE = 4096
+
+# The metadata flagging a duplicate, which bean-extract prints commented out;
+# the same as beancount.ingest.extract.DUPLICATE_META, which is not imported
+# not to load beancount.ingest.
+DUPLICATE_META = '__duplicate__'
+
+# The metadata of a transaction recording the location of the duplicates
+# merged into it.
+MERGED_META = 'duplicate'
+
+# Runs of letters or digits, and ideographs.
+_WORD_RE = re.compile(r'[^\W_]+')
+_CJK_RE = re.compile('[\u3400-\u9fff\uf900-\ufaff]+')
+
+
+def counterparty_tokens(entry):
+    """Split the counterparty of a transaction into tokens.
+
+    The counterparty is the payee, or the narration if there is no payee.
+    Latin words are tokens by themselves, and runs of Chinese characters are
+    split into their character bigrams, since the exports of the banks and
+    of the payment services spell the names of the merchants differently.
+
+    Args:
+      entry: A data.Transaction instance.
+    Returns:
+      A frozenset of token strings, of at most MAX_TOKENS of them.
+    """
+    return _tokenize(entry.payee or entry.narration or '')
+
+
+@functools.lru_cache(maxsize=TOKENS_CACHE_SIZE)
+def _tokenize(text):
+    tokens = []
+    for word in _WORD_RE.findall(text.lower()):
+        position = 0
+        for run in _CJK_RE.finditer(word):
+            if run.start() > position:
+                tokens.append(word[position:run.start()])
+            ideographs = run.group()
+            if len(ideographs) == 1:
+                tokens.append(ideographs)
+            else:
+                tokens.extend(ideographs[i:i + 2] for i in range(len(ideographs) - 1))
+            position = run.end()
+        if position < len(word):
+            tokens.append(word[position:])
+    return frozenset(list(dict.fromkeys(tokens))[:MAX_TOKENS])
+
+
+def transaction_signature(entry):
+    """Get what two duplicate transactions have in common.
+
+    Args:
+      entry: A directive.
+    Returns:
+      A triple of the (currency, absolute number) of the first posting with
+      units, the ordinal of the date and the counterparty tokens, or None if
+      the entry is not a transaction, has no amount, or is already flagged as
+      a duplicate.
+    """
+    if not isinstance(entry, data.Transaction) or DUPLICATE_META in entry.meta:
+        return None
+    for posting in entry.postings:
+        if posting.units is not None and posting.units.number is not None:
+            units = posting.units
+            break
+    else:
+        return None
+    tokens = counterparty_tokens(entry)
+    if not tokens:
+        return None
+    return (units.currency, abs(units.number)), entry.date.toordinal(), tokens
+
+
+def find_duplicates(entries_lists,
+                    window_days: int=DATE_WINDOW_DAYS,
+                    min_overlap: float=MIN_TOKEN_OVERLAP):
+    """Find the transactions which another file of a batch reports already.
+
+    The files are processed in order: a transaction is a duplicate of the most
+    similar transaction of a previous file not matched by its file yet, so the
+    first file reporting a payment keeps it.
+
+    Args:
+      entries_lists: A list of (key, entries) pairs, one per file, like the
+        hooks of the beancount ingest tools get.
+      window_days: The maximum number of days between duplicates.
+      min_overlap: The minimum share of the tokens of the counterparty with
+        fewer tokens which are in the other one.
+    Returns:
+      A list of pairs of the (file number, entry number) positions of a
+      duplicate and of the transaction it duplicates.
+    """
+    # A dict of (amount, date ordinal, token) to the positions of the
+    # transactions indexed, and a dict of their positions to their number of
+    # tokens and date ordinal.
+    buckets = collections.defaultdict(list)
+    indexed = {}
+    # The (position, file number) pairs of the transactions already matched
+    # by a duplicate of the file.
+    matched = set()
+    duplicates = []
+
+    for file_number, (_, entries) in enumerate(entries_lists):
+        originals = []
+        for entry_number, entry in enumerate(entries):
+            signature = transaction_signature(entry)
+            if signature is None:
+                continue
+            amount, ordinal, tokens = signature
+
+            # Count the tokens shared with the transactions of the window.
+            shared = {}
+            for day in range(ordinal - window_days, ordinal + window_days + 1):
+                for token in tokens:
+                    bucket = buckets.get((amount, day, token))
+                    if bucket:
+                        for position in bucket:
+                            shared[position] = shared.get(position, 0) + 1
+
+            best = best_key = None
+            for position, count in shared.items():
+                if (position, file_number) in matched:
+                    continue
+                overlap = count / min(len(tokens), indexed[position][0])
+                if overlap < min_overlap:
+                    continue
+                key = (overlap, -abs(indexed[position][1] - ordinal))
+                if best_key is None or key > best_key:
+                    best, best_key = position, key
+            if best is not None:
+                matched.add((best, file_number))
+                duplicates.append(((file_number, entry_number), best))
+            else:
+                originals.append(((file_number, entry_number), signature))
+
+        # Index the transactions of the file once it is done, so that they are
+        # not matched with each other.
+        for position, (amount, ordinal, tokens) in originals:
+            indexed[position] = len(tokens), ordinal
+            for token in tokens:
+                buckets[(amount, ordinal, token)].append(position)
+    return duplicates
+
+
+def flag_duplicates(new_entries_list, existing_entries=None):
+    """Flag the transactions reported by several files of a batch.
+
+    The duplicates get the metadata of the duplicates of bean-extract, which
+    prints them commented out.
+
+    Args:
+      new_entries_list: A list of (key, entries) pairs, one per file.
+      existing_entries: Unused, for the signature of the ingest hooks.
+    Returns:
+      A list of (key, entries) pairs like new_entries_list.
+    """
+    flagged = collections.defaultdict(set)
+    for (file_number, entry_number), _ in find_duplicates(new_entries_list):
+        flagged[file_number].add(entry_number)
+    result = []
+    for file_number, (key, entries) in enumerate(new_entries_list):
+        numbers = flagged.get(file_number)
+        if numbers:
+            entries = [entry._replace(meta=dict(entry.meta, **{DUPLICATE_META: True}))
+                       if entry_number in numbers else entry
+                       for entry_number, entry in enumerate(entries)]
+        result.append((key, entries))
+    return result
+
+
+def merge_duplicates(new_entries_list, existing_entries=None):
+    """Remove the transactions reported by several files of a batch.
+
+    The first transaction reporting a payment is kept, and records the
+    locations of its duplicates in its metadata. It also gets the metadata
+    of its duplicates it does not have, like the time of the payment only
+    one of the statements reports.
+
+    Args:
+      new_entries_list: A list of (key, entries) pairs, one per file.
+      existing_entries: Unused, for the signature of the ingest hooks.
+    Returns:
+      A list of (key, entries) pairs like new_entries_list.
+    """
+    removed = collections.defaultdict(set)
+    locations = collections.defaultdict(list)
+    metas = collections.defaultdict(dict)
+    for (file_number, entry_number), original in find_duplicates(new_entries_list):
+        removed[file_number].add(entry_number)
+        meta = new_entries_list[file_number][1][entry_number].meta
+        locations[original].append('{}:{}'.format(meta.get('filename'), meta.get('lineno')))
+        for name, value in meta.items():
+            if name not in ('filename', 'lineno') and not name.startswith('__'):
+                metas[original].setdefault(name, value)
+    result = []
+    for file_number, (key, entries) in enumerate(new_entries_list):
+        numbers = removed.get(file_number, ())
+        merged = []
+        for entry_number, entry in enumerate(entries):
+            if entry_number in numbers:
+                continue
+            merged_locations = locations.get((file_number, entry_number))
+            if merged_locations:
+                meta = dict(entry.meta)
+                for name, value in metas[(file_number, entry_number)].items():
+                    meta.setdefault(name, value)
+                meta[MERGED_META] = ', '.join(merged_locations)
+                entry = entry._replace(meta=meta)
+            merged.append(entry)
+        result.append((key, merged))
+    return result
@@ -0,0 +1,200 @@
+"""A persistent index of the fingerprints of the rows already imported.
+
+Banks re-export overlapping date ranges. The importers look up the
+fingerprint of each row in this index before building its transaction, and
+skip the rows already imported by a previous run. The fingerprints of the new
+rows are claimed as they are looked up, each in a short transaction, so that
+another import of the same index, like the one of an overlapping export
+extracted by another process of batch.py, skips them without waiting for the
+first one to finish. The claims are committed once the whole file has been
+imported, and released if the import fails.
+
+The importers commit their claims once they have extracted a file, which is
+all bean-extract can tell. Callers which write the entries themselves, like
+batch.py and watch.py, extract within deferred_commits() instead, and commit
+the claims with commit_claims() only once the entries are written, so that
+rows are never recorded as imported without being written.
+"""
+__copyright__ = "Copyright (C) 2018 Dongchao Li"
+__license__ = "GNU GPLv2"
+
+import contextlib
+import hashlib
+import os
+import sqlite3
+import time
+
+# Number of bytes of the fingerprint digests.
+FINGERPRINT_SIZE = 16
+
+# Seconds an import waits for the short transaction of another import of the
+# same index.
+LOCK_TIMEOUT = 60.0
+
+# Seconds after which the claims of an import neither committed nor released,
+# like the ones of a process killed, are given to other imports.
+CLAIM_TIMEOUT = 24 * 3600.0
+
+# Separator of the fields hashed into a fingerprint.
+_FIELD_SEPARATOR = '\x1f'
+
+# The lists collecting the claims of the imports whose commits are deferred,
+# the innermost one last, see deferred_commits().
+_DEFERRED = []
+
+
+def row_fingerprint(fields):
+    """Compute the fingerprint of a row.
+
+    Args:
+      fields: A sequence of strings (or None), the identifying fields of the
+        row, e.g. the transaction number, amount and date.
+    Returns:
+      A bytes object of FINGERPRINT_SIZE bytes.
+    """
+    text = _FIELD_SEPARATOR.join('' if field is None else field for field in fields)
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=FINGERPRINT_SIZE).digest()
+
+
+@contextlib.contextmanager
+def deferred_commits():
+    """Collect the claims of the imports run within, instead of committing them.
+
+    Yields:
+      A list, filled with the claims of the imports which went through, as
+      (index file name, token) pairs. Give it to commit_claims() once their
+      entries are written, or to release_claims() if they could not be.
+    """
+    claims = []
+    _DEFERRED.append(claims)
+    try:
+        yield claims
+    finally:
+        _DEFERRED.remove(claims)
+
+
+def commit_claims(claims):
+    """Commit the claims collected by deferred_commits().
+
+    Args:
+      claims: A list of (index file name, token) pairs.
+    """
+    for filename, token in claims:
+        index = FingerprintIndex(filename, token)
+        try:
+            index._commit()
+        finally:
+            index.close()
+
+
+def release_claims(claims):
+    """Release the claims collected by deferred_commits(), for other imports.
+
+    Args:
+      claims: A list of (index file name, token) pairs.
+    """
+    for filename, token in claims:
+        index = FingerprintIndex(filename, token)
+        try:
+            index.release()
+        finally:
+            index.close()
+
+
+class FingerprintIndex:
+    """A set of row fingerprints stored in an SQLite database.
+
+    Each fingerprint is claimed in a short write transaction, so that two
+    imports never both claim the same one. The claims of an import carry its
+    token until commit(), and are released by close() if it did not commit.
+    """
+
+    def __init__(self, filename, token: str=None, timeout: float=LOCK_TIMEOUT):
+        """Constructor.
+
+        Args:
+          filename: A path string, the database file, created if missing.
+          token: An optional string, the token of the claims of an import
+            to resume, a new one by default.
+          timeout: Seconds to wait for the lock of another importing process.
+        """
+        self.filename = filename
+        self.token = token or os.urandom(16).hex()
+        self.connection = sqlite3.connect(filename, timeout=timeout, isolation_level=None)
+        # The claims need not survive a crash, only the commits do.
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS fingerprints '
+                                '(fingerprint BLOB PRIMARY KEY, token TEXT, claimed REAL) '
+                                'WITHOUT ROWID')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS fingerprints_token '
+                                'ON fingerprints (token) WHERE token IS NOT NULL')
+        # The fingerprints claimed since the last commit, and whether some
+        # of them are in the database.
+        self.claimed = set()
+        self.pending = False
+
+    def claim(self, fingerprint):
+        """Claim a fingerprint for the import in progress.
+
+        Args:
+          fingerprint: A bytes object, from row_fingerprint().
+        Returns:
+          True if the fingerprint is new, False if another import committed
+          or claimed it. A fingerprint claimed twice by the same import is new
+          both times, as a statement may well list two identical rows.
+        """
+        if fingerprint in self.claimed:
+            return True
+        now = time.time()
+        with self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+            row = self.connection.execute(
+                'SELECT token, claimed FROM fingerprints WHERE fingerprint = ?',
+                (fingerprint,)).fetchone()
+            if row is None:
+                self.connection.execute('INSERT INTO fingerprints VALUES (?, ?, ?)',
+                                        (fingerprint, self.token, now))
+            elif row[0] is None or row[1] > now - CLAIM_TIMEOUT:
+                return False
+            else:  # Abandoned by an import which never finished.
+                self.connection.execute('UPDATE fingerprints SET token = ?, claimed = ? '
+                                        'WHERE fingerprint = ?',
+                                        (self.token, now, fingerprint))
+        self.claimed.add(fingerprint)
+        self.pending = True
+        return True
+
+    def commit(self):
+        """Commit the claimed fingerprints, or collect them if deferred."""
+        if not _DEFERRED:
+            self._commit()
+        elif self.pending and (self.filename, self.token) not in _DEFERRED[-1]:
+            _DEFERRED[-1].append((self.filename, self.token))
+        self.pending = False
+        self.claimed.clear()
+
+    def _commit(self):
+        self.connection.execute('PRAGMA synchronous=FULL')
+        with self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+            self.connection.execute('UPDATE fingerprints SET token = NULL, claimed = NULL '
+                                    'WHERE token = ?', (self.token,))
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+
+    def release(self):
+        """Release the fingerprints claimed and not committed, for other imports."""
+        with self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+            self.connection.execute('DELETE FROM fingerprints WHERE token = ?', (self.token,))
+        self.pending = False
+        self.claimed.clear()
+
+    def close(self):
+        """Close the database, releasing the fingerprints not committed."""
+        try:
+            if self.pending:
+                self.release()
+        finally:
+            self.claimed.clear()
+            self.connection.close()
@@ -0,0 +1,338 @@
+"""Writing ledger files: atomic replacement, include lists and shards.
+
+A ShardedLedger splits extracted entries into one file per account and month,
+like Data/Assets/MoneyFund/Yuebao/2018-01.beancount. New directives are
+appended to the shards, and the directives already written are skipped,
+recognized by a FingerprintIndex of their contents kept at the root of the
+shards (see entry_fingerprint()). The appends are fsynced in batches. Each
+shard has a small JSON sidecar with its date range and number of entries, so
+that a loader can skip the shards out of the range it wants (see
+select_shards()), and the top-level include list only gets the shards it
+misses added.
+"""
+__copyright__ = "Copyright (C) 2018 Dongchao Li"
+__license__ = "GNU GPLv2"
+
+import collections
+import datetime
+import json
+import os
+import re
+import stat
+import tempfile
+from os import path
+
+from beancount.parser import printer
+
+from fingerprint import FingerprintIndex, row_fingerprint
+
+# The include directive of a ledger file.
+INCLUDE_RE = re.compile(r'^include\s+"(?P<filename>[^"]*)"', re.MULTILINE)
+
+# The name of the FingerprintIndex of the written entries, at the root of the
+# shards, and the suffix of the sidecar of a shard.
+SHARD_INDEX_NAME = '.fingerprints.sqlite'
+SIDECAR_SUFFIX = '.json'
+
+# Number of appended entries after which the shards are fsynced.
+FSYNC_ENTRIES = 1000
+
+# The account of the shard of the entries without one.
+OTHER_ACCOUNT = 'Other'
+
+# The mode of the new files, like open() would create them: the umask is read
+# once, as reading it means setting it, which is not thread-safe.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+NEW_FILE_MODE = 0o666 & ~_UMASK
+
+
+def write_atomically(filename, contents):
+    """Replace the contents of a file, so that readers never see it partial.
+
+    The file keeps its mode, or gets the default mode of new files if it does
+    not exist yet, instead of the private mode of the temporary file.
+
+    Args:
+      filename: A path string.
+      contents: A string, or a bytes object, the new contents of the file.
+    """
+    dirname = path.dirname(path.abspath(filename))
+    try:
+        mode = stat.S_IMODE(os.stat(filename).st_mode)
+    except FileNotFoundError:
+        mode = NEW_FILE_MODE
+    fd, tmp_filename = tempfile.mkstemp(dir=dirname, prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb' if isinstance(contents, bytes) else 'w') as tmp_file:
+            tmp_file.write(contents)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.chmod(tmp_filename, mode)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.unlink(tmp_filename)
+        raise
+
+
+def update_include_file(include_filename, filenames):
+    """Add include directives for the given files to a top-level ledger.
+
+    Existing directives are kept in place, and the missing ones are appended
+    in the order given. The file is replaced atomically.
+
+    Args:
+      include_filename: A path string, the ledger with the include list, like
+        'Data/2018.beancount'.
+      filenames: A list of path strings of the files to include.
+    Returns:
+      The list of the names of the newly included files.
+    """
+    contents = ''
+    if path.exists(include_filename):
+        with open(include_filename) as infile:
+            contents = infile.read()
+    included = set(match.group('filename') for match in INCLUDE_RE.finditer(contents))
+    dirname = path.dirname(path.abspath(include_filename))
+    new_includes = []
+    for filename in filenames:
+        relative = path.relpath(path.abspath(filename), dirname)
+        if relative not in included:
+            included.add(relative)
+            new_includes.append(relative)
+    if new_includes:
+        if contents and not contents.endswith('\n'):
+            contents += '\n'
+        contents += ''.join('include "{}"\n'.format(relative)
+                            for relative in new_includes)
+        write_atomically(include_filename, contents)
+    return new_includes
+
+
+def entry_account(entry):
+    """Get the account an entry is sharded under.
+
+    Args:
+      entry: A directive.
+    Returns:
+      The account of the directive, or of the first posting of a
+      transaction, which is the account of the statement.
+    """
+    account = getattr(entry, 'account', None)
+    if account is None:
+        postings = getattr(entry, 'postings', None)
+        account = postings[0].account if postings else OTHER_ACCOUNT
+    return account
+
+
+def entry_fingerprint(text, occurrence):
+    """Get the fingerprint an entry is recognized by in the shards.
+
+    Entries are recognized by their contents, without the statement and the
+    line they come from, so that a statement downloaded again with new rows
+    only has its new entries written. As a statement may well list two
+    identical payments, the identical entries of a batch are told apart by
+    the number of identical entries before them.
+
+    Args:
+      text: A string, the directive as written to its shard, which has no
+        'filename' and 'lineno' metadata.
+      occurrence: The number of identical entries before it in its batch.
+    Returns:
+      A bytes object, from row_fingerprint().
+    """
+    return row_fingerprint([text, str(occurrence)])
+
+
+def shard_name(root, account, date):
+    """Get the file name of the shard of an account and month.
+
+    Args:
+      root: A path string, the directory of the shards.
+      account: An account string.
+      date: A datetime.date instance.
+    Returns:
+      A path string, like 'Data/Assets/Cash/2018-01.beancount'.
+    """
+    return path.join(root, *account.split(':'), '{:%Y-%m}.beancount'.format(date))
+
+
+def read_sidecar(filename):
+    """Read the sidecar of a shard.
+
+    Args:
+      filename: A path string, the shard.
+    Returns:
+      A dict of 'min_date' and 'max_date', datetime.date instances or None,
+      and 'count', the number of entries of the shard.
+    """
+    try:
+        with open(filename + SIDECAR_SUFFIX) as infile:
+            sidecar = json.load(infile)
+    except FileNotFoundError:
+        return {'min_date': None, 'max_date': None, 'count': 0}
+    return {'min_date': datetime.date.fromisoformat(sidecar['min_date']),
+            'max_date': datetime.date.fromisoformat(sidecar['max_date']),
+            'count': sidecar['count']}
+
+
+def select_shards(root, start=None, end=None):
+    """Find the shards having entries in a range of dates, from their sidecars.
+
+    Args:
+      root: A path string, the directory of the shards.
+      start: An optional datetime.date, the first date of the range.
+      end: An optional datetime.date, the last date of the range, included.
+    Returns:
+      A sorted list of the path strings of the shards.
+    """
+    filenames = []
+    for dirpath, _, names in os.walk(root):
+        for name in names:
+            if not name.endswith('.beancount' + SIDECAR_SUFFIX):
+                continue
+            filename = path.join(dirpath, name[:-len(SIDECAR_SUFFIX)])
+            sidecar = read_sidecar(filename)
+            if start is not None and sidecar['max_date'] < start:
+                continue
+            if end is not None and sidecar['min_date'] > end:
+                continue
+            filenames.append(filename)
+    return sorted(filenames)
+
+
+class Shard:
+    """An append-only ledger file of the entries of an account in a month."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        sidecar = read_sidecar(filename)
+        self.min_date = sidecar['min_date']
+        self.max_date = sidecar['max_date']
+        self.count = sidecar['count']
+        self.file = None
+        self.dirty = False
+
+    def append(self, entry, text):
+        """Append the text of an entry, to be made durable by sync()."""
+        if self.file is None:
+            os.makedirs(path.dirname(self.filename), exist_ok=True)
+            self.file = open(self.filename, 'a')
+        self.file.write(text)
+        self.file.write('\n')
+        if self.min_date is None or entry.date < self.min_date:
+            self.min_date = entry.date
+        if self.max_date is None or entry.date > self.max_date:
+            self.max_date = entry.date
+        self.count += 1
+        self.dirty = True
+
+    def sync(self):
+        """Fsync the appended entries, then update the sidecar."""
+        if not self.dirty:
+            return
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        write_atomically(self.filename + SIDECAR_SUFFIX, json.dumps({
+            'min_date': self.min_date.isoformat(),
+            'max_date': self.max_date.isoformat(),
+            'count': self.count,
+        }))
+        self.dirty = False
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class ShardedLedger:
+    """A writer of entries into per-account, per-month shards.
+
+    Entries already written by this or a previous run are skipped. Use it as
+    a context manager, or call close(), so that the last entries are synced.
+    """
+
+    def __init__(self, root, include_filename=None,
+                 fsync_entries: int=FSYNC_ENTRIES):
+        """Constructor.
+
+        Args:
+          root: A path string, the directory of the shards, created if missing.
+          include_filename: An optional path string, a ledger whose include
+            list is updated with the shards written to.
+          fsync_entries: The number of appended entries after which the shards
+            are fsynced.
+        """
+        self.root = root
+        self.include_filename = include_filename
+        self.fsync_entries = fsync_entries
+        os.makedirs(root, exist_ok=True)
+        self.index = FingerprintIndex(path.join(root, SHARD_INDEX_NAME))
+        self.shards = {}
+        # The shards known to be in the include list.
+        self.included = set()
+        self.unsynced = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, entries):
+        """Append the entries not written yet to their shards.
+
+        Args:
+          entries: A list of directives, like the entries of a statement.
+            Identical entries are only written once per occurrence in a
+            single batch.
+        Returns:
+          The number of entries appended.
+        """
+        count = 0
+        occurrences = collections.Counter()
+        for entry in entries:
+            text = printer.format_entry(entry)
+            occurrence = occurrences[text]
+            occurrences[text] += 1
+            if not self.index.claim(entry_fingerprint(text, occurrence)):
+                continue
+            filename = shard_name(self.root, entry_account(entry), entry.date)
+            shard = self.shards.get(filename)
+            if shard is None:
+                shard = self.shards[filename] = Shard(filename)
+            shard.append(entry, text)
+            count += 1
+            self.unsynced += 1
+            if self.unsynced >= self.fsync_entries:
+                self.sync()
+        return count
+
+    def sync(self):
+        """Make the appended entries durable, and include their shards.
+
+        The fingerprints of the entries are only committed once the entries
+        themselves are synced and their shards included: a crash may have an
+        entry written twice, but never lost. The entries not committed are
+        written again by the next run, and their shards included then, even
+        if a crashed run created them.
+        """
+        for shard in self.shards.values():
+            shard.sync()
+        if self.include_filename:
+            missing = sorted(set(self.shards) - self.included)
+            if missing:
+                update_include_file(self.include_filename, missing)
+                self.included.update(missing)
+        self.index.commit()
+        self.unsynced = 0
+
+    def close(self):
+        """Sync the last entries and close the shards."""
+        try:
+            self.sync()
+        finally:
+            for shard in self.shards.values():
+                shard.close()
+            self.index.close()
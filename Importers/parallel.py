@@ -0,0 +1,248 @@
+"""Parallel extraction of a single huge statement, in chunks of rows.
+
+Usage: python Importers/parallel.py my.config big.csv -j 8 > big.beancount
+
+The data rows of the statement are split into chunks of about CHUNK_BYTES at
+record boundaries: a chunk only ends at a line ending outside of a quoted
+field. The chunks are parsed by the importer in a process pool, with the
+same configuration, debit/credit mapping and account maps, and their
+transactions are merged back in the order of the rows. Line numbers are
+made global again from the number of records of the chunks before, and the
+order of the file and the balance entry are found like Importer.extract()
+does, so that the output is the same.
+"""
+__copyright__ = "Copyright (C) 2018 Dongchao Li"
+__license__ = "GNU GPLv2"
+
+import argparse
+import concurrent.futures
+import csv
+import io
+import itertools
+import mmap
+import os
+import sys
+from os import path
+
+from beancount.core import data
+from beancount.ingest import cache
+
+import batch
+from beanmaker import Col, normalize_file_config, row_getter
+from csvstream import file_encoding, strip_row
+from fingerprint import FingerprintIndex
+
+# Approximate number of bytes of the chunks of rows parsed by each task.
+CHUNK_BYTES = 8 * 1024 * 1024
+
+# The importer of the file, set once in each worker process.
+_IMPORTER = None
+
+
+def _record_end(buffer, position):
+    """Find the end of the CSV record starting at a position of a buffer."""
+    parity = 0
+    while position < len(buffer):
+        newline = buffer.find(b'\n', position)
+        if newline < 0:
+            return len(buffer)
+        parity = (parity + buffer[position:newline].count(b'"')) % 2
+        position = newline + 1
+        if not parity:
+            break
+    return position
+
+
+def record_boundaries(filename, skip_records, chunk_bytes: int=CHUNK_BYTES):
+    """Split the records of a CSV file into chunks of about the same size.
+
+    A position ends a record if it follows a line ending and an even number
+    of quotes since the start of the record. This holds for UTF-8 and GB18030
+    files, where quotes and line endings never occur inside characters.
+
+    Args:
+      filename: A path string.
+      skip_records: The number of leading records not to include, like the
+        garbage lines and the header.
+      chunk_bytes: The approximate size of the chunks.
+    Returns:
+      A list of the byte offsets of the chunk boundaries; the first one is
+      the start of the first record included, the last one the end of file.
+    """
+    with open(filename, 'rb') as infile:
+        if os.fstat(infile.fileno()).st_size == 0:
+            return [0]
+        with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            position = 0
+            for _ in range(skip_records):
+                position = _record_end(buffer, position)
+            boundaries = [position]
+            while position < len(buffer):
+                chunk_start = position
+                position = min(position + chunk_bytes, len(buffer))
+                parity = buffer[chunk_start:position].count(b'"') % 2
+                # Go on to the first line ending outside of a quoted field.
+                while position < len(buffer):
+                    newline = buffer.find(b'\n', position)
+                    if newline < 0:
+                        position = len(buffer)
+                        break
+                    parity = (parity + buffer[position:newline].count(b'"')) % 2
+                    position = newline + 1
+                    if not parity:
+                        break
+                boundaries.append(position)
+    return boundaries
+
+
+def _init_worker(importer):
+    global _IMPORTER
+    _IMPORTER = importer
+
+
+def _extract_chunk(filename, start, end, iconfig):
+    """Parse the records of a chunk of a file.
+
+    Returns:
+      A tuple of
+        the number of records of the chunk,
+        the first and the last data rows of the chunk, or None,
+        a list of (local line number, fingerprint, RowRecord, transaction)
+        of the data rows, where the fingerprint is None without a
+        fingerprint index, and the record and transaction None for the rows
+        skipped,
+        a Counter of the transfer remarks not resolved.
+    """
+    importer = _IMPORTER
+    file = cache.get_file(filename)
+    with open(filename, 'rb') as infile:
+        infile.seek(start)
+        text = infile.read(end - start).decode(file_encoding(filename))
+    rows = map(strip_row, csv.reader(io.StringIO(text, newline=None),
+                                     dialect=importer.csv_dialect))
+
+    get = row_getter(iconfig)
+    date_parsers, stages = importer._extract_stages(lambda name, function: function)
+    first_row = last_row = None
+    results = []
+    index = 0
+    for index, row in enumerate(rows, 1):
+        if not row:
+            continue
+        if row[0].startswith('#'):
+            continue
+        if importer.debug:
+            print(row)
+        if first_row is None:
+            first_row = row
+        last_row = row
+
+        fingerprint = (importer._fingerprint(iconfig, get, row)
+                       if importer.fingerprint_index else None)
+        record = importer._parse_row(iconfig, get, date_parsers, stages, None, index, row)
+        if record is None:
+            results.append((index, fingerprint, None, None))
+        else:
+            txn = importer._build_transaction(file, stages, None, record)
+            results.append((index, fingerprint, record, txn))
+    return index, first_row, last_row, results, importer.transfer_resolver.drain()
+
+
+def extract(importer, file, jobs=None, chunk_bytes: int=CHUNK_BYTES):
+    """Extract the directives of a statement, parsing its chunks in parallel.
+
+    Files of a single chunk are extracted by the importer directly.
+
+    Args:
+      importer: A beanmaker.Importer instance.
+      file: A cache.FileMemo instance.
+      jobs: The number of worker processes, the number of CPUs by default.
+      chunk_bytes: The approximate size of the chunks.
+    Returns:
+      A list of beancount.core.data objects, the same as importer.extract().
+    """
+    iconfig, has_header = normalize_file_config(importer.config, file)
+    boundaries = record_boundaries(file.name, importer.skip_lines + has_header, chunk_bytes)
+    if len(boundaries) <= 2 or jobs == 1:
+        return importer.extract(file)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs,
+                                                initializer=_init_worker,
+                                                initargs=(importer,)) as executor:
+        chunks = list(executor.map(_extract_chunk, itertools.repeat(file.name),
+                                   boundaries[:-1], boundaries[1:],
+                                   itertools.repeat(iconfig)))
+
+    # Skip the rows imported by a previous run, in the order of the file.
+    seen = FingerprintIndex(importer.fingerprint_index) if importer.fingerprint_index else None
+    try:
+        entries = _merge(importer, file, iconfig, chunks, seen)
+        if seen is not None:
+            seen.commit()
+    finally:
+        if seen is not None:
+            seen.close()
+    return entries
+
+
+def _merge(importer, file, iconfig, chunks, seen):
+    get = row_getter(iconfig)
+    date_parsers, _ = importer._extract_stages(lambda name, function: function)
+    # The records of the rows in the order of the file, with None after the
+    # rows skipped, and their transactions by line number.
+    records = []
+    transactions = {}
+    first_row = last_row = None
+    offset = 0
+    for count, chunk_first_row, chunk_last_row, results, unresolved in chunks:
+        importer.transfer_resolver.unresolved.update(unresolved)
+        if chunk_first_row is not None:
+            first_row = first_row or chunk_first_row
+            last_row = chunk_last_row
+        for index, fingerprint, record, txn in results:
+            if seen is not None and not seen.claim(fingerprint):
+                records.append(None)
+                continue
+            if record is None:
+                continue
+            record.index = txn.meta['lineno'] = offset + index
+            records.append(record)
+            transactions[record.index] = txn
+        offset += count
+    if first_row is None:
+        return []
+
+    # Figure out if the file is in ascending or descending order.
+    first_date = date_parsers[Col.DATE].parse(get(first_row, Col.DATE))
+    last_date = date_parsers[Col.DATE].parse(get(last_row, Col.DATE))
+    entries = list(importer._ordered_entries(
+        file, iconfig, records, first_date < last_date,
+        lambda record: transactions.pop(record.index), lambda: offset))
+
+    importer.report_unresolved_transfers(file)
+    return entries
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('config', help="Importers config file, like my.config")
+    parser.add_argument('filename', help="The statement to extract")
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help="Number of worker processes (default: number of CPUs)")
+    parser.add_argument('--chunk-bytes', type=int, default=CHUNK_BYTES,
+                        help="Approximate size of the chunks of rows")
+    args = parser.parse_args()
+
+    filename = path.abspath(args.filename)
+    file = cache.get_file(filename)
+    importers = [importer for importer in batch.load_importers(args.config)
+                 if importer.identify(file)]
+    entries = []
+    for importer in importers:
+        entries.extend(extract(importer, file, args.jobs, args.chunk_bytes))
+    entries.sort(key=data.entry_sortkey)
+    sys.stdout.write(batch.format_entries(filename, entries))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""Per-stage timers and counters of an extraction, reported as JSON.
+
+A Profiler wraps the stage functions of Importer.extract() (header sniffing,
+row reading, date parsing, amount parsing, account classification, the
+categorizer) into timing wrappers, and counts the rows and the reasons rows
+were skipped for. The report is a single JSON object, written to stderr or
+appended as a line to a file, so it never mixes with the beancount output.
+"""
+__copyright__ = "Copyright (C) 2018 Dongchao Li"
+__license__ = "GNU GPLv2"
+
+import collections
+import json
+import sys
+import time
+
+
+class Profiler:
+    """Timers and counters of the stages of an extraction."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.seconds = collections.defaultdict(float)
+        self.calls = collections.Counter()
+        self.counters = collections.Counter()
+
+    def timed(self, name, function):
+        """Wrap a function to accumulate its calls and run time under a name.
+
+        Args:
+          name: A string, the name of the stage.
+          function: A callable.
+        Returns:
+          A callable with the same signature.
+        """
+        seconds, calls, clock = self.seconds, self.calls, time.perf_counter
+
+        def timed_function(*args, **kwargs):
+            start = clock()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                seconds[name] += clock() - start
+                calls[name] += 1
+        return timed_function
+
+    def timed_iter(self, name, iterator):
+        """Wrap an iterator to accumulate the time spent getting its items.
+
+        Args:
+          name: A string, the name of the stage.
+          iterator: An iterator.
+        Yields:
+          The items of the iterator.
+        """
+        seconds, calls, clock = self.seconds, self.calls, time.perf_counter
+        iterator = iter(iterator)
+        while True:
+            start = clock()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                seconds[name] += clock() - start
+            calls[name] += 1
+            yield item
+
+    def count(self, name, value=1):
+        """Increment a counter, e.g. of rows skipped for some reason."""
+        self.counters[name] += value
+
+    def report(self, **info):
+        """Build the report of the extraction.
+
+        Args:
+          info: Extra items to put in the report, like the file name.
+        Returns:
+          A dict, serializable to JSON.
+        """
+        elapsed = time.perf_counter() - self.start
+        rows = self.counters.get('rows', 0)
+        report = dict(info)
+        report.update({
+            'elapsed': elapsed,
+            'rows_per_sec': rows / elapsed if elapsed else None,
+            'counters': dict(self.counters),
+            'stages': {name: {'calls': self.calls[name], 'seconds': seconds}
+                       for name, seconds in self.seconds.items()},
+        })
+        return report
+
+    def emit(self, destination, **info):
+        """Write the report as one line of JSON.
+
+        Args:
+          destination: True for stderr, or a path string of a file to append to.
+          info: Extra items to put in the report, like the file name.
+        """
+        line = json.dumps(self.report(**info), ensure_ascii=False)
+        if destination is True:
+            print(line, file=sys.stderr)
+        else:
+            with open(destination, 'a') as outfile:
+                print(line, file=outfile)
@@ -0,0 +1,124 @@
+"""A registry dispatching statements to their importers by header signature.
+
+The signature of an importer is the set of the column names of its config:
+it identifies a file exactly when all of them are in the header of the file.
+The registry indexes the importers by one column name of their signature,
+the one shared by the fewest importers, so that identifying a file only
+looks up the names of its header, whatever the number of importers, and only
+checks the signatures of the few importers found.
+
+A registry is a list of importers, and can be used as the CONFIG of the
+beancount ingest tools, the identify() of its importers going through it.
+"""
+__copyright__ = "Copyright (C) 2018 Dongchao Li"
+__license__ = "GNU GPLv2"
+
+import collections
+import csv
+import logging
+
+from beanmaker import sniff_header
+from csvstream import LRUCache, file_identity
+
+
+def header_signature(config):
+    """Get the column names an importer requires in the header of a file.
+
+    Args:
+      config: A dict of Col types to the names or indexes of the columns.
+    Returns:
+      A frozenset of the column name strings; empty if the config consists
+      of indexes only.
+    """
+    return frozenset(field for field in config.values() if isinstance(field, str))
+
+
+class ImporterRegistry(list):
+    """A list of importers, with an index of their header signatures.
+
+    Importers without a config, which are not beanmaker importers, are not
+    indexed: their own identify() is called for every file.
+    """
+
+    def __init__(self, importers=()):
+        super().__init__(importers)
+        self.signatures = {}
+        self.anchors = collections.defaultdict(list)
+        self.headerless = []
+        self.probed = []
+        self.matches = LRUCache()
+
+        for position, importer in enumerate(self):
+            config = getattr(importer, 'config', None)
+            if not isinstance(config, dict):
+                self.probed.append(position)
+                continue
+            self.signatures[position] = header_signature(config)
+            importer.registry = self
+
+        # Anchor every signature on its most selective column name.
+        usage = collections.Counter(name
+                                    for signature in self.signatures.values()
+                                    for name in signature)
+        for position, signature in self.signatures.items():
+            if signature:
+                anchor = min(signature, key=lambda name: (usage[name], name))
+                self.anchors[anchor].append(position)
+            else:
+                self.headerless.append(position)
+
+    def match(self, file):
+        """Find the importers which identify a file.
+
+        The result is cached by file identity, for the FILE_CACHE_SIZE files
+        used last.
+
+        Args:
+          file: A cache.FileMemo instance.
+        Returns:
+          A list of the matching importers, in the order of the registry.
+        """
+        key = file_identity(file.name)
+        try:
+            positions = self.matches[key]
+        except KeyError:
+            positions = self.matches[key] = self._match(file)
+        return [self[position] for position in positions]
+
+    def _match(self, file):
+        # An importer whose identify() raises an error does not identify the
+        # file, as in beancount.ingest.identify, and does not keep the others
+        # from identifying it.
+        positions = []
+        if self.signatures and file.mimetype() == 'text/csv':
+            try:
+                has_header, header = sniff_header(file)
+            except csv.Error as exc:
+                logging.warning("Cannot sniff the header of '%s': %s", file.name, exc)
+            else:
+                names = {name.strip() for name in header} if has_header else set()
+                positions.extend(self.headerless)
+                for name in names:
+                    for position in self.anchors.get(name, ()):
+                        if self.signatures[position] <= names:
+                            positions.append(position)
+        for position in self.probed:
+            importer = self[position]
+            try:
+                if importer.identify(file):
+                    positions.append(position)
+            except Exception as exc:
+                logging.exception("Importer %s.identify() raised an unexpected error: %s",
+                                  importer.name(), exc)
+        return sorted(positions)
+
+    def identify(self, importer, file):
+        """Whether an importer of the registry identifies a file.
+
+        Args:
+          importer: An importer of the registry.
+          file: A cache.FileMemo instance.
+        Returns:
+          A boolean.
+        """
+        return any(matched is importer for matched in self.match(file))
@@ -0,0 +1,272 @@
+"""Validated, compiled snapshots of the importers of a config.
+
+Usage: python Importers/snapshot.py my.config
+
+A config like my.config is Python, run on every start, and its importers
+derive their state from it: the reversed DRCR_dict, the account maps patched
+with DEFAULT, their classifiers and the header-signature index of the
+registry. compile_config() runs the config once, validates the importers
+(see validate_importer()), builds all of that state, and pickles the
+importers next to the config, like my.config -> .my.config.snapshot.
+
+load_config() loads the snapshot instead of running the config as long as
+neither the config nor the modules of the importers changed since, and
+compiles it again otherwise. Configs whose importers cannot be pickled, like
+those with categorizer functions defined in the config, are simply run every
+time.
+
+Only batch.py, parallel.py and watch.py load the snapshots. The beancount
+ingest tools run the config themselves, so bean-extract my.config, and
+processing.sh with it, still run the config every time.
+"""
+__copyright__ = "Copyright (C) 2018 Dongchao Li"
+__license__ = "GNU GPLv2"
+
+import argparse
+import logging
+import pickle
+import re
+import runpy
+import sys
+from os import path
+
+from beancount.core import account
+
+import beanmaker
+import registry
+from beanmaker import Col, DEFAULT, Debit_or_credit, _REGEX_METACHARACTERS
+from csvstream import file_identity
+from registry import ImporterRegistry
+
+# The version of the format of the snapshots, to bump whenever the state of
+# the importers changes in an incompatible way.
+SNAPSHOT_VERSION = 1
+
+# The modules whose classes are pickled in a snapshot.
+SNAPSHOT_MODULES = [beanmaker, registry]
+
+
+class ConfigError(ValueError):
+    """A config whose importers are invalid."""
+
+
+def snapshot_name(config_filename):
+    """Get the name of the snapshot of a config.
+
+    Args:
+      config_filename: A path string, like 'my.config'.
+    Returns:
+      A path string, like '.my.config.snapshot', in the same directory.
+    """
+    dirname, basename = path.split(path.abspath(config_filename))
+    return path.join(dirname, '.{}.snapshot'.format(basename))
+
+
+def _sources(config_filename):
+    """Get the identities of the files a snapshot depends on."""
+    filenames = [path.abspath(config_filename)]
+    filenames.extend(module.__file__ for module in SNAPSHOT_MODULES)
+    return [file_identity(filename) for filename in filenames]
+
+
+def _header(config_filename):
+    return {'version': SNAPSHOT_VERSION,
+            'python': sys.version_info[:2],
+            'sources': _sources(config_filename)}
+
+
+def validate_account_map(name, account_map, default_account):
+    """Check a map of account keywords to account names.
+
+    Importer.__init__ gives every map a DEFAULT key, the default account of
+    the importer if the config has none, so there is no missing DEFAULT key
+    to check.
+
+    Args:
+      name: A string, the name of the map in the messages.
+      account_map: A dict of account keywords string (each keyword separated
+        by "|") to account name.
+      default_account: The default account of the importer.
+    Returns:
+      A list of (level, message) pairs, where level is 'error' or 'warning'.
+    """
+    problems = []
+    if name != 'assets_account' and account_map.get(DEFAULT) == default_account:
+        problems.append(('warning', '{} has no {} account of its own: unmatched rows '
+                         'are posted twice to {}'.format(name, DEFAULT, default_account)))
+
+    # The literal keywords and compiled regular expressions of the keys seen
+    # so far, which win over the following ones.
+    previous = []
+    for account_keywords, account_name in account_map.items():
+        if not account.is_valid(account_name):
+            problems.append(('error', '{}["{}"]: invalid account name "{}"'.format(
+                name, account_keywords, account_name)))
+        if account_keywords == DEFAULT:
+            continue
+        literals = account_keywords.split('|')
+        if not all(literals):
+            problems.append(('error', '{}["{}"]: an empty keyword matches every text'.format(
+                name, account_keywords)))
+            continue
+        if not all(_REGEX_METACHARACTERS.isdisjoint(literal) for literal in literals):
+            try:
+                regexp = re.compile(account_keywords)
+            except re.error as exc:
+                problems.append(('error', '{}["{}"]: bad regular expression: {}'.format(
+                    name, account_keywords, exc)))
+                continue
+            previous.append((account_keywords, None, regexp))
+            continue
+
+        for literal in literals:
+            for previous_keywords, previous_literal, previous_regexp in previous:
+                if (previous_regexp.search(literal) if previous_regexp is not None
+                        else previous_literal in literal):
+                    problems.append(('warning', '{}["{}"]: keyword "{}" is shadowed by '
+                                     'the earlier key "{}"'.format(
+                                         name, account_keywords, literal,
+                                         previous_keywords)))
+                    break
+        previous.extend((account_keywords, literal, None) for literal in literals)
+
+    # The keys valid on their own may still not merge into the single regex
+    # of the AccountClassifier, which then tries them one by one.
+    if not any(level == 'error' for level, _ in problems):
+        try:
+            classifier = beanmaker.AccountClassifier(account_map)
+        except re.error as exc:
+            problems.append(('error', '{}: bad regular expressions: {}'.format(name, exc)))
+        else:
+            if classifier.merge_error is not None:
+                problems.append(('warning', '{}: the regular expression keys cannot be '
+                                 'merged ({}), they are tried one by one'.format(
+                                     name, classifier.merge_error)))
+    return problems
+
+
+def validate_importer(importer):
+    """Check the config and the account maps of a beanmaker importer.
+
+    Args:
+      importer: A beanmaker.Importer instance.
+    Returns:
+      A list of (level, message) pairs, where level is 'error' or 'warning',
+      and the messages are prefixed with the name of the importer.
+    """
+    problems = []
+    config = importer.config
+    for ftype, field in config.items():
+        if not isinstance(ftype, Col):
+            problems.append(('error', 'config key {!r} is not a Col'.format(ftype)))
+        elif not isinstance(field, (str, int)):
+            problems.append(('error', 'config[{}] is neither a column name nor an '
+                             'index: {!r}'.format(ftype, field)))
+    if Col.DATE not in config:
+        problems.append(('error', 'config has no {} column'.format(Col.DATE)))
+    if Col.AMOUNT not in config and not (Col.AMOUNT_DEBIT in config and
+                                         Col.AMOUNT_CREDIT in config):
+        problems.append(('error', 'config has neither {} nor {} and {} columns'.format(
+            Col.AMOUNT, Col.AMOUNT_DEBIT, Col.AMOUNT_CREDIT)))
+    if Col.DRCR in config:
+        missing = {Debit_or_credit.DEBIT, Debit_or_credit.CREDIT} - set(
+            importer.DRCR_dict.values())
+        if missing:
+            problems.append(('warning', 'DRCR_dict has no text for {}: those rows are '
+                             'uncertain'.format(', '.join(sorted(status.name
+                                                                 for status in missing)))))
+
+    if not account.is_valid(importer.default_account):
+        problems.append(('error', 'invalid default account "{}"'.format(
+            importer.default_account)))
+    for name in ['assets_account', 'debit_account', 'credit_account']:
+        problems.extend(validate_account_map(name, getattr(importer, name),
+                                             importer.default_account))
+    return [(level, '{}: {}'.format(importer.name(), message))
+            for level, message in problems]
+
+
+def compile_config(config_filename):
+    """Run a config, validate its importers and write their snapshot.
+
+    Warnings are logged. The snapshot is not written if the importers cannot
+    be pickled.
+
+    Args:
+      config_filename: A path string, the name of a config like my.config.
+    Returns:
+      An ImporterRegistry of the importers of the config, with their state
+      built.
+    Raises:
+      ConfigError: If the importers have errors.
+    """
+    importers = runpy.run_path(config_filename)['CONFIG']
+    if not isinstance(importers, ImporterRegistry):
+        importers = ImporterRegistry(importers)
+
+    compiled = [importer for importer in importers
+                if isinstance(importer, beanmaker.Importer)]
+    errors = []
+    for importer in compiled:
+        for level, message in validate_importer(importer):
+            if level == 'error':
+                errors.append(message)
+            else:
+                logging.warning("%s: %s", config_filename, message)
+    if errors:
+        raise ConfigError('{}:\n  {}'.format(config_filename, '\n  '.join(errors)))
+
+    # Build the state the importers otherwise build on first use.
+    for importer in compiled:
+        for attribute in ['assets_classifier', 'debit_classifier', 'credit_classifier',
+                          'transfer_resolver']:
+            getattr(importer, attribute)
+
+    try:
+        contents = (pickle.dumps(_header(config_filename), pickle.HIGHEST_PROTOCOL) +
+                    pickle.dumps(importers, pickle.HIGHEST_PROTOCOL))
+    except (pickle.PicklingError, AttributeError, TypeError) as exc:
+        logging.info("%s: no snapshot, the importers cannot be pickled: %s",
+                     config_filename, exc)
+        return importers
+    # Imported here, not to load the printer of beancount with the snapshots.
+    from ledger import write_atomically
+    write_atomically(snapshot_name(config_filename), contents)
+    return importers
+
+
+def load_config(config_filename):
+    """Get the importers of a config, from its snapshot if it is up to date.
+
+    Args:
+      config_filename: A path string, the name of a config like my.config.
+    Returns:
+      An ImporterRegistry of the importers of the config.
+    Raises:
+      ConfigError: If the config changed and its importers have errors.
+    """
+    try:
+        with open(snapshot_name(config_filename), 'rb') as infile:
+            if pickle.load(infile) == _header(config_filename):
+                return pickle.load(infile)
+    except FileNotFoundError:
+        pass
+    except Exception as exc:  # A corrupted snapshot: compile it again.
+        logging.info("%s: ignoring its snapshot: %s", config_filename, exc)
+    return compile_config(config_filename)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('config', help="Importers config file, like my.config")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s %(message)s')
+    try:
+        importers = compile_config(args.config)
+    except ConfigError as exc:
+        sys.exit(str(exc))
+    print('{}: {} importers'.format(snapshot_name(args.config), len(importers)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,335 @@
+"""A daemon importing the statements dropped into an inbox directory.
+
+Usage: python Importers/watch.py my.config Inbox -o Data -i Data/2018.beancount
+
+The inbox is watched with inotify on Linux, or by polling it otherwise. A new
+or modified CSV file is queued once its size and modification time have not
+changed for a settle delay, so that files still being downloaded are not
+read half written. Queued files are identified and extracted in a bounded
+process pool, like batch.py does, and their .beancount files are written to
+the output directory and added to the include list atomically, so the ledger
+is up to date a few seconds after a download.
+"""
+__copyright__ = "Copyright (C) 2018 Dongchao Li"
+__license__ = "GNU GPLv2"
+
+import argparse
+import asyncio
+import concurrent.futures
+import ctypes
+import ctypes.util
+import logging
+import os
+import signal
+import struct
+from os import path
+
+import batch
+from csvstream import file_identity
+from fingerprint import commit_claims, release_claims
+
+# Seconds a file must stay unchanged before being imported.
+SETTLE_SECONDS = 2.0
+
+# Seconds between two scans of the inbox, when polling.
+POLL_SECONDS = 1.0
+
+# The inotify events of a file being written or moved into the inbox.
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+# The header of an inotify event: wd, mask, cookie and length of the name.
+_INOTIFY_EVENT = struct.Struct('iIII')
+
+# Size of the buffer the inotify events are read into.
+_INOTIFY_BUFFER_SIZE = 64 * 1024
+
+
+def is_statement(filename):
+    """Whether a file of the inbox is a statement to import."""
+    basename = path.basename(filename)
+    return basename.lower().endswith('.csv') and not basename.startswith('.')
+
+
+class InotifyWatcher:
+    """Report the files written into a directory, through Linux inotify."""
+
+    def __init__(self, directory):
+        """Constructor.
+
+        Args:
+          directory: A path string, the directory to watch.
+        Raises:
+          OSError: If inotify is not available.
+        """
+        self.directory = directory
+        libc_name = ctypes.util.find_library('c')
+        libc = ctypes.CDLL(libc_name, use_errno=True) if libc_name else None
+        if libc is None or not hasattr(libc, 'inotify_init1'):
+            raise OSError("inotify is not available")
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), IN_WATCH_MASK) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, "inotify_add_watch failed", directory)
+
+    def start(self, loop, callback):
+        """Call back with the path of every file written, from the event loop."""
+        loop.add_reader(self.fd, self._read, callback)
+
+    def _read(self, callback):
+        try:
+            buffer = os.read(self.fd, _INOTIFY_BUFFER_SIZE)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(buffer):
+            _, _, _, length = _INOTIFY_EVENT.unpack_from(buffer, offset)
+            offset += _INOTIFY_EVENT.size
+            name = buffer[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if name:
+                callback(path.join(self.directory, os.fsdecode(name)))
+
+    def close(self, loop):
+        loop.remove_reader(self.fd)
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """Report the files written into a directory, by scanning it periodically."""
+
+    def __init__(self, directory, interval: float=POLL_SECONDS):
+        """Constructor.
+
+        Args:
+          directory: A path string, the directory to watch.
+          interval: Seconds between two scans.
+        """
+        self.directory = directory
+        self.interval = interval
+        self.identities = self._scan()
+        self.task = None
+
+    def _scan(self):
+        identities = {}
+        for name in os.listdir(self.directory):
+            filename = path.join(self.directory, name)
+            try:
+                identities[filename] = file_identity(filename)
+            except OSError:  # Removed in the meantime.
+                continue
+        return identities
+
+    def start(self, loop, callback):
+        """Call back with the path of every file written, from the event loop."""
+        self.task = loop.create_task(self._poll(callback))
+
+    async def _poll(self, callback):
+        while True:
+            await asyncio.sleep(self.interval)
+            identities = self._scan()
+            for filename, identity in identities.items():
+                if self.identities.get(filename) != identity:
+                    callback(filename)
+            self.identities = identities
+
+    def close(self, loop):
+        if self.task is not None:
+            self.task.cancel()
+
+
+class WatchDaemon:
+    """Import the statements of an inbox directory as they arrive."""
+
+    def __init__(self, config_filename, inbox, output_dir, include_filename=None,
+                 jobs: int=2,
+                 settle: float=SETTLE_SECONDS,
+                 poll_interval: float=POLL_SECONDS,
+                 polling: bool=False,
+                 columnar: bool=False):
+        """Constructor.
+
+        Args:
+          config_filename: A path string, the name of a config like my.config.
+          inbox: A path string, the directory to watch.
+          output_dir: A path string, the directory of the .beancount files.
+          include_filename: An optional path string, a ledger whose include
+            list is updated with the written files.
+          jobs: The number of files extracted at once, in worker processes.
+          settle: Seconds a file must stay unchanged before being imported.
+          poll_interval: Seconds between two scans of the inbox, if polling.
+          polling: Whether to poll the inbox even if inotify is available.
+          columnar: Whether to extract through the columnar backend.
+        """
+        self.config_filename = config_filename
+        self.inbox = inbox
+        self.output_dir = output_dir
+        self.include_filename = include_filename
+        self.jobs = jobs
+        self.settle = settle
+        self.poll_interval = poll_interval
+        self.polling = polling
+        self.columnar = columnar
+
+        # The settle timers of the files being written, and the identities of
+        # the files imported, not to import them twice.
+        self.timers = {}
+        self.imported = {}
+        self.queue = None
+        self.write_lock = None
+
+    def make_watcher(self):
+        """Create an inotify watcher of the inbox, or a polling one."""
+        if not self.polling:
+            try:
+                return InotifyWatcher(self.inbox)
+            except OSError as exc:
+                logging.info("Polling %s: %s", self.inbox, exc)
+        return PollingWatcher(self.inbox, self.poll_interval)
+
+    def pending_files(self):
+        """List the statements of the inbox not imported yet, or since modified."""
+        filenames = []
+        for name in sorted(os.listdir(self.inbox)):
+            filename = path.join(self.inbox, name)
+            if not is_statement(filename):
+                continue
+            outname = batch.output_name(filename, self.output_dir)
+            if (not path.exists(outname) or
+                    path.getmtime(outname) < path.getmtime(filename)):
+                filenames.append(filename)
+        return filenames
+
+    def changed(self, filename):
+        """Restart the settle delay of a file which was written to."""
+        if not is_statement(filename):
+            return
+        filename = path.abspath(filename)
+        timer = self.timers.pop(filename, None)
+        if timer is not None:
+            timer.cancel()
+        try:
+            identity = file_identity(filename)
+        except OSError:  # Removed, or moved out of the inbox.
+            return
+        loop = asyncio.get_running_loop()
+        self.timers[filename] = loop.call_later(self.settle, self._settled, filename, identity)
+
+    def _settled(self, filename, identity):
+        del self.timers[filename]
+        try:
+            current = file_identity(filename)
+        except OSError:
+            return
+        if current != identity:
+            self.changed(filename)
+        elif self.imported.get(filename) != identity:
+            self.queue.put_nowait(filename)
+
+    async def _worker(self, executor):
+        loop = asyncio.get_running_loop()
+        while True:
+            filename = await self.queue.get()
+            try:
+                identity = file_identity(filename)
+                _, entries, claims = await loop.run_in_executor(
+                    executor, batch.extract_file, filename)
+                if entries is None:
+                    logging.warning("No importer identified %s", filename)
+                else:
+                    outname = batch.output_name(filename, self.output_dir)
+                    async with self.write_lock:
+                        await loop.run_in_executor(None, self._write, filename, outname,
+                                                   entries, claims)
+                    logging.info("%s: %d entries", outname, len(entries))
+                self.imported[filename] = identity
+            except Exception:
+                logging.exception("Importing %s failed", filename)
+            finally:
+                self.queue.task_done()
+
+    def _write(self, filename, outname, entries, claims=()):
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            batch.write_entries(outname, filename, entries)
+            if self.include_filename:
+                batch.update_include_file(self.include_filename, [outname])
+        except BaseException:
+            release_claims(claims)
+            raise
+        commit_claims(claims)
+
+    async def run(self, stop=None):
+        """Watch the inbox and import its statements, until stopped.
+
+        The statements already in the inbox and not imported are queued first.
+
+        Args:
+          stop: An optional asyncio.Event, to stop the daemon. SIGINT and
+            SIGTERM stop it too, when set up by main().
+        """
+        loop = asyncio.get_running_loop()
+        stop = stop or asyncio.Event()
+        self.queue = asyncio.Queue()
+        self.write_lock = asyncio.Lock()
+        watcher = self.make_watcher()
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.jobs, initializer=batch._init_worker,
+                initargs=(self.config_filename, self.columnar)) as executor:
+            workers = [loop.create_task(self._worker(executor)) for _ in range(self.jobs)]
+            watcher.start(loop, self.changed)
+            try:
+                for filename in self.pending_files():
+                    self.queue.put_nowait(path.abspath(filename))
+                await stop.wait()
+            finally:
+                watcher.close(loop)
+                for timer in self.timers.values():
+                    timer.cancel()
+                for worker in workers:
+                    worker.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('config', help="Importers config file, like my.config")
+    parser.add_argument('inbox', help="Directory the statements are downloaded to")
+    parser.add_argument('-o', '--output-dir', default='Data',
+                        help="Directory of the .beancount files")
+    parser.add_argument('-i', '--include-file',
+                        help="Ledger whose include list to update, like Data/2018.beancount")
+    parser.add_argument('-j', '--jobs', type=int, default=2,
+                        help="Number of files extracted at once")
+    parser.add_argument('--settle', type=float, default=SETTLE_SECONDS,
+                        help="Seconds a file must stay unchanged before being imported")
+    parser.add_argument('--poll-interval', type=float, default=POLL_SECONDS,
+                        help="Seconds between two scans of the inbox, when polling")
+    parser.add_argument('--polling', action='store_true',
+                        help="Poll the inbox instead of using inotify")
+    parser.add_argument('--columnar', action='store_true',
+                        help="Use the columnar backend, for very large statements")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    daemon = WatchDaemon(args.config, args.inbox, args.output_dir, args.include_file,
+                         args.jobs, args.settle, args.poll_interval, args.polling,
+                         args.columnar)
+
+    async def serve():
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+        await daemon.run(stop)
+    asyncio.run(serve())
+
+
+if __name__ == '__main__':
+    main()
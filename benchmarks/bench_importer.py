@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""Benchmark the hot paths of the importers on synthetic statements.
+
+Usage: python benchmarks/bench_importer.py --rows 100000 --output bench.json
+       python benchmarks/bench_importer.py --rows 100000 --compare bench.json
+
+A statement is generated with benchmarks/generate.py, then every stage is
+timed separately with the importers of my.config: header sniffing
+(normalize_config), account classification (mapping_account and the compiled
+classifiers), amount parsing (cast_to_decimal), date parsing, file_date and
+the full extract, row-wise and columnar. Results are written as JSON so that
+runs can be compared.
+"""
+__copyright__ = "Copyright (C) 2018 Dongchao Li"
+__license__ = "GNU GPLv2"
+
+import argparse
+import json
+import os
+import platform
+import runpy
+import sys
+import tempfile
+import time
+from os import path
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.append(path.join(ROOT, 'Importers'))
+sys.path.append(path.dirname(path.abspath(__file__)))
+
+from beancount.ingest import cache
+from beancount.utils.date_utils import parse_date_liberally
+
+import beanmaker
+import columnar
+import csvstream
+import generate
+from beanmaker import Col
+
+
+def clear_caches():
+    """Forget everything memoized across calls, for cold measurements."""
+    beanmaker._HEADER_CACHE.clear()
+    beanmaker._INDEX_CONFIG_CACHE.clear()
+    beanmaker._PARSED_CACHE.clear()
+    beanmaker.parse_amount.cache_clear()
+    csvstream._ENCODING_CACHE.clear()
+
+
+def timeit(function, repeat):
+    """Time a function, cold.
+
+    Args:
+      function: A callable without arguments.
+      repeat: The number of runs.
+    Returns:
+      A dict of the best and mean run times, in seconds.
+    """
+    times = []
+    for _ in range(repeat):
+        clear_caches()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return {'best': min(times), 'mean': sum(times) / len(times)}
+
+
+def read_columns(importer, file):
+    """Read the configured columns of a statement, as lists of strings."""
+    iconfig, has_header = beanmaker.normalize_file_config(importer.config, file)
+    table, _ = columnar.load_table(importer, file, iconfig, has_header)
+    return table
+
+
+def parse_dates(importer, dates):
+    """Parse a column of dates with a new DateParser."""
+    parser = beanmaker.DateParser(importer.dateutil_kwds)
+    return [parser.parse(date) for date in dates]
+
+
+def run_benchmarks(filename, importer, repeat):
+    """Time every stage of the import of a statement.
+
+    Args:
+      filename: A path string, the statement.
+      importer: The beanmaker.Importer of the statement.
+      repeat: The number of runs of each stage.
+    Returns:
+      A dict of stage name to its timings.
+    """
+    file = cache.get_file(filename)
+    table = read_columns(importer, file)
+    payee_narrations = [(payee or '') + (narration or '')
+                        for payee, narration in zip(table.column(Col.PAYEE),
+                                                    table.column(Col.NARRATION))]
+    amounts = table.column(Col.AMOUNT)
+    dates = table.column(Col.DATE)
+    head = csvstream.read_head(filename, beanmaker.SNIFF_MAX_BYTES)
+
+    stages = {
+        'normalize_config': lambda: beanmaker.normalize_config(importer.config, head),
+        'normalize_file_config': lambda: beanmaker.normalize_file_config(importer.config, file),
+        'mapping_account': lambda: [beanmaker.mapping_account(importer.debit_account, text)
+                                    for text in payee_narrations],
+        'AccountClassifier.classify': lambda: [importer.debit_classifier.classify(text)
+                                               for text in payee_narrations],
+        'cast_to_decimal': lambda: [beanmaker.cast_to_decimal(amount) for amount in amounts],
+        'parse_date_liberally': lambda: [parse_date_liberally(date, importer.dateutil_kwds)
+                                         for date in dates],
+        'DateParser.parse': lambda: parse_dates(importer, dates),
+        'Importer.file_date': lambda: importer.file_date(file),
+        'Importer.extract': lambda: importer.extract(file),
+        'columnar.extract': lambda: columnar.extract(importer, file),
+    }
+    results = {}
+    for name, function in stages.items():
+        timings = timeit(function, repeat)
+        timings['per_row_us'] = timings['best'] / max(len(table), 1) * 1e6
+        results[name] = timings
+        print('{:<28} best {:9.4f}s  mean {:9.4f}s  {:9.3f} us/row'.format(
+            name, timings['best'], timings['mean'], timings['per_row_us']), file=sys.stderr)
+    return results
+
+
+def compare(results, baseline):
+    """Print the ratio of the best times of two runs, stage by stage."""
+    for name, timings in results.items():
+        if name not in baseline:
+            continue
+        ratio = timings['best'] / baseline[name]['best'] if baseline[name]['best'] else 0
+        print('{:<28} {:7.2f}x {}'.format(name, ratio,
+                                           'slower' if ratio > 1 else 'faster'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--config', default=path.join(ROOT, 'my.config'),
+                        help="Importers config file")
+    parser.add_argument('--source', choices=['alipay', 'wechat'], default='alipay')
+    parser.add_argument('--rows', type=int, default=10000, help="Number of data rows")
+    parser.add_argument('--encoding', choices=['utf-8', 'gbk'], default='utf-8')
+    parser.add_argument('--order', choices=['asc', 'desc'], default='asc')
+    parser.add_argument('--repeat', type=int, default=3, help="Runs of each stage")
+    parser.add_argument('--output', help="JSON file to write the results to")
+    parser.add_argument('--compare', help="JSON file of a previous run to compare to")
+    args = parser.parse_args()
+
+    cwd = os.getcwd()
+    os.chdir(ROOT)
+    try:
+        importers = runpy.run_path(args.config)['CONFIG']
+    finally:
+        os.chdir(cwd)
+    importer = importers[0 if args.source == 'alipay' else 1]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = path.join(tmpdir, '{}.csv'.format(args.source))
+        generate.generate(args.source, args.rows, filename, args.encoding, args.order)
+        results = run_benchmarks(filename, importer, args.repeat)
+
+    report = {
+        'meta': {'source': args.source, 'rows': args.rows, 'encoding': args.encoding,
+                 'order': args.order, 'repeat': args.repeat,
+                 'python': platform.python_version(), 'time': time.time()},
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(report, outfile, indent=2)
+    if args.compare:
+        with open(args.compare) as infile:
+            compare(results, json.load(infile)['results'])
+
+
+if __name__ == '__main__':
+    main()
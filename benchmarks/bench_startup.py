@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""Benchmark the startup of the importers, in fresh interpreters.
+
+Usage: python benchmarks/bench_startup.py --output startup.json
+       python benchmarks/bench_startup.py --compare startup.json
+
+Short runs of bean-extract, batch.py or the watch daemon spend a large part
+of their time loading the config and the modules of the importers. Every run
+starts a new interpreter which loads my.config, then identifies and extracts
+a statement, and reports the time of each phase and the heavy modules newly
+loaded by the config, which should be none: they are only needed by the first
+identify/extract. Results are written as JSON so that runs can be compared.
+"""
+__copyright__ = "Copyright (C) 2018 Dongchao Li"
+__license__ = "GNU GPLv2"
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from os import path
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.append(path.dirname(path.abspath(__file__)))
+
+import generate
+
+# Modules which the config should not load before the first identify/extract.
+# beancount.ingest, and the pytest and json it imports, are not among them:
+# the importers derive from its ImporterProtocol.
+HEAVY_MODULES = ['dateutil.parser', 'sqlite3', 'tempfile', 'pickle']
+
+# The program run by every interpreter: it loads the config, identifies and
+# extracts a statement, and prints the times of the phases as JSON.
+_CHILD = '''
+import os, runpy, sys, time
+preloaded = set(sys.modules)
+start = time.perf_counter()
+os.chdir({root!r})
+importers = runpy.run_path({config!r})['CONFIG']
+loaded = time.perf_counter()
+heavy = [name for name in {heavy!r}
+         if name in sys.modules and name not in preloaded]
+
+from beancount.ingest import cache
+file = cache.get_file({filename!r})
+matched = [importer for importer in importers if importer.identify(file)]
+identified = time.perf_counter()
+entries = [entry for importer in matched for entry in importer.extract(file)]
+extracted = time.perf_counter()
+
+import json
+print(json.dumps({{'load_config': loaded - start,
+                  'identify': identified - loaded,
+                  'extract': extracted - identified,
+                  'heavy_modules': heavy,
+                  'entries': len(entries)}}))
+'''
+
+
+def run_once(config, filename):
+    """Run the phases in a new interpreter.
+
+    Args:
+      config: A path string, the importers config file.
+      filename: A path string, the statement.
+    Returns:
+      A dict of the times of the phases, in seconds, including 'total', the
+      wall time of the interpreter from start to exit.
+    """
+    program = _CHILD.format(root=ROOT, config=config, filename=filename,
+                            heavy=HEAVY_MODULES)
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', program], check=True,
+                            stdout=subprocess.PIPE).stdout
+    total = time.perf_counter() - start
+    result = json.loads(output.decode('utf-8'))
+    result['total'] = total
+    return result
+
+
+def run_benchmarks(config, filename, repeat):
+    """Time the startup phases of repeated runs.
+
+    Args:
+      config: A path string, the importers config file.
+      filename: A path string, the statement.
+      repeat: The number of runs.
+    Returns:
+      A dict of phase name to its timings, and the heavy modules loaded by
+      the config under 'heavy_modules'.
+    """
+    runs = [run_once(config, filename) for _ in range(repeat)]
+    results = {}
+    for name in ['load_config', 'identify', 'extract', 'total']:
+        times = [run[name] for run in runs]
+        results[name] = {'best': min(times), 'mean': sum(times) / len(times)}
+        print('{:<12} best {:9.4f}s  mean {:9.4f}s'.format(
+            name, results[name]['best'], results[name]['mean']), file=sys.stderr)
+    heavy = sorted({name for run in runs for name in run['heavy_modules']})
+    print('heavy modules loaded by the config: {}'.format(', '.join(heavy) or 'none'),
+          file=sys.stderr)
+    return results, heavy
+
+
+def compare(results, baseline):
+    """Print the ratio of the best times of two runs, phase by phase."""
+    for name, timings in results.items():
+        if name not in baseline:
+            continue
+        ratio = timings['best'] / baseline[name]['best'] if baseline[name]['best'] else 0
+        print('{:<12} {:7.2f}x {}'.format(name, ratio,
+                                           'slower' if ratio > 1 else 'faster'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--config', default=path.join(ROOT, 'my.config'),
+                        help="Importers config file")
+    parser.add_argument('--source', choices=['alipay', 'wechat'], default='alipay')
+    parser.add_argument('--rows', type=int, default=100, help="Number of data rows")
+    parser.add_argument('--repeat', type=int, default=10, help="Number of runs")
+    parser.add_argument('--output', help="JSON file to write the results to")
+    parser.add_argument('--compare', help="JSON file of a previous run to compare to")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = path.join(tmpdir, '{}.csv'.format(args.source))
+        generate.generate(args.source, args.rows, filename)
+        results, heavy = run_benchmarks(path.abspath(args.config), filename, args.repeat)
+
+    report = {
+        'meta': {'source': args.source, 'rows': args.rows, 'repeat': args.repeat,
+                 'python': platform.python_version(), 'time': time.time()},
+        'results': results,
+        'heavy_modules': heavy,
+    }
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(report, outfile, indent=2)
+    if args.compare:
+        with open(args.compare) as infile:
+            compare(results, json.load(infile)['results'])
+
+
+if __name__ == '__main__':
+    main()
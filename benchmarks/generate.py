@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""Generate synthetic Alipay- and WeChat-shaped statements for benchmarking.
+
+Usage: python benchmarks/generate.py alipay 100000 /tmp/alipay.csv --encoding gbk --order desc
+
+The statements have the headers of the exports in Csv/, payees and goods
+drawn from the keywords of my.config, repeated timestamps and amounts, and a
+share of closed transactions. Rows are written as they are generated, so the
+size of the file is not limited by memory.
+"""
+__copyright__ = "Copyright (C) 2018 Dongchao Li"
+__license__ = "GNU GPLv2"
+
+import argparse
+import csv
+import datetime
+import random
+
+ALIPAY_HEADER = ["交易号", "商户订单号", "交易创建时间", "付款时间", "最近修改时间",
+                 "交易来源地", "类型", "交易对方", "商品名称", "金额（元）", "收/支",
+                 "交易状态", "服务费（元）", "成功退款（元）", "备注", "资金状态"]
+
+WECHAT_HEADER = ["交易时间", "交易类型", "交易对方", "商品", "收/支", "金额(元)",
+                 "支付方式", "当前状态", "交易单号", "商户单号", "备注"]
+
+PAYEES = ["App Store & Apple Music", "滴滴出行", "家乐福超市", "全家便利店", "中国移动",
+          "腾讯云", "北京地铁", "万达电影", "同仁堂药房", "如家酒店", "狗子", "蚂蚁财富",
+          "某某餐厅", "街边小店", "优步", "航空公司", "Steam", "永旺百货"]
+
+GOODS = ["于 01.01完成的购买", "快车订单", "日用品", "话费充值", "云服务器", "地铁票",
+         "电影票", "感冒药", "住宿", "转账备注:微信转账", "基金申购", "午餐", "衣服", "鞋"]
+
+REMARKS = ["花呗", "招行信用卡", "招行储蓄卡", "余额宝", "支付宝", "微信", "零钱通", "",
+           "余额宝-招行储蓄卡", "零钱通-微信"]
+
+# The date of the first transaction of the statements.
+START = datetime.datetime(2018, 1, 1, 8, 0)
+
+
+def row(source, number, seed=0, yen='¥'):
+    """Generate a data row of a statement.
+
+    Every row only depends on its number, so that statements can be written
+    in either order without holding them in memory.
+
+    Args:
+      source: 'alipay' or 'wechat'.
+      number: The number of the row, in ascending date order.
+      seed: The seed of the random generator.
+      yen: The currency symbol of WeChat amounts.
+    Returns:
+      A list of strings, the fields of the row.
+    """
+    rnd = random.Random(seed * 1000003 + number)
+    # Transactions come in pairs sharing the same minute.
+    timestamp = START + datetime.timedelta(minutes=(number // 2) * 23)
+    date = '{}/{}/{} {}:{:02d}'.format(timestamp.year, timestamp.month, timestamp.day,
+                                      timestamp.hour, timestamp.minute)
+    payee = rnd.choice(PAYEES)
+    goods = rnd.choice(GOODS)
+    amount = '{}.{:02d}'.format(rnd.randint(0, 200), rnd.choice([0, 50, 99]))
+    remark = rnd.choice(REMARKS)
+    drcr = "" if '-' in remark else rnd.choice(["支出", "支出", "支出", "收入", ""])
+    txn_id = '{:016d}'.format(number)
+    if source == 'alipay':
+        status = "" if rnd.random() < 0.05 else ("已收入" if drcr == "收入" else "已支出")
+        return [txn_id, "M{}".format(number), date, date, date, "其他", "即时到账交易",
+                payee, goods, amount, drcr, "交易成功", "0", "0", remark, status]
+    status = "已存入零钱" if drcr == "收入" else "支付成功"
+    return [date, "商户消费", payee, goods, drcr, yen + amount, remark or "零钱",
+            status, txn_id, "/", "/"]
+
+
+def generate(source, count, filename, encoding='utf-8', order='asc', seed=0):
+    """Write a synthetic statement.
+
+    Args:
+      source: 'alipay' or 'wechat'.
+      count: The number of data rows.
+      filename: A path string, the file to write.
+      encoding: 'utf-8' or 'gbk'.
+      order: 'asc' or 'desc', the date order of the rows.
+      seed: The seed of the random generator.
+    """
+    header = ALIPAY_HEADER if source == 'alipay' else WECHAT_HEADER
+    numbers = range(count) if order == 'asc' else reversed(range(count))
+    # GBK has no half-width yen sign, GBK exports use the full-width one.
+    yen = '￥' if encoding == 'gbk' else '¥'
+    with open(filename, 'w', encoding=encoding, newline='') as outfile:
+        writer = csv.writer(outfile, quoting=csv.QUOTE_ALL)
+        writer.writerow(header)
+        writer.writerows(row(source, number, seed, yen) for number in numbers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('source', choices=['alipay', 'wechat'])
+    parser.add_argument('rows', type=int, help="Number of data rows")
+    parser.add_argument('filename', help="Output CSV file")
+    parser.add_argument('--encoding', choices=['utf-8', 'gbk'], default='utf-8')
+    parser.add_argument('--order', choices=['asc', 'desc'], default='asc')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    generate(args.source, args.rows, args.filename, args.encoding, args.order, args.seed)
+
+
+if __name__ == '__main__':
+    main()
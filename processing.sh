@@ -27,23 +27,13 @@ if [ $filePostfix != ".csv" ]; then
     exit 4
 fi
 
-export fileCoding=$(file $2)
 export fileName=${var:0:len-4}
 export dataPrefix="Data/"
 export data=${dataPrefix}${fileName##*/}
 
 
-if [[ $fileCoding == *"ISO-8859"* || $fileCoding == *"Non-ISO"* ]]; then
-    iconv -f gbk -t UTF-8 $fileName.csv > ${fileName}_tmp.csv
-elif [[ $fileCoding == *"UTF-8"* ]]; then
-    cp $fileName.csv ${fileName}_tmp.csv
-else
-    echo "Unkown file coding of data file."
-    exit 5
-fi
-
-
-dos2unix ${fileName}_tmp.csv 2> /dev/null
-python strip_blank.py ${fileName}_tmp.csv > ${fileName}-utf8.csv
-rm ${fileName}_tmp.csv
-bean-extract $config ${fileName}-utf8.csv > ${data}.beancount
\ No newline at end of file
+# The importers detect the encoding (GBK or UTF-8), line endings and blanks
+# of the statement themselves, no need for a converted copy.
+bean-extract $config $2 > ${data}.beancount
+# To import the statements as they are downloaded instead, run the daemon:
+#   python Importers/watch.py my.config ~/Downloads -o Data -i Data/2018.beancount
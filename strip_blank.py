@@ -6,12 +6,11 @@ Created on Wed Apr 18 14:58:23 2018
 @author: lidongchao
 """
 
-import sys, csv
+import sys
+from os import path
 
-contents = []
-with open(sys.argv[1]) as csvfile:
-    csvreader = csv.reader(csvfile, delimiter=',', quotechar='"')
-    for row in csvreader:
-        contents.append(['"{}"'.format(x.strip()) for x in row])
-for content in contents:
-    print(','.join(content))
+sys.path.append(path.join(path.dirname(path.abspath(__file__)), "Importers"))
+from csvstream import normalize
+
+# Write the statement as UTF-8 with stripped fields, row by row.
+normalize(sys.argv[1], sys.stdout)
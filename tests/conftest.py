@@ -0,0 +1,9 @@
+"""Make the modules of Importers/ importable by their bare names, like
+my.config does."""
+__copyright__ = "Copyright (C) 2018 Dongchao Li"
+__license__ = "GNU GPLv2"
+
+import sys
+from os import path
+
+sys.path.insert(0, path.join(path.dirname(path.dirname(path.abspath(__file__))), 'Importers'))
@@ -0,0 +1,276 @@
+"""The extraction backends must give the same output as Importer.extract()."""
+__copyright__ = "Copyright (C) 2018 Dongchao Li"
+__license__ = "GNU GPLv2"
+
+import datetime
+import decimal
+import logging
+
+import pytest
+from beancount.ingest import cache
+from beancount.parser import printer
+
+import beanmaker
+import columnar
+import parallel
+from beanmaker import Col, Debit_or_credit, Importer
+
+BANK_CONFIG = {
+    Col.DATE: 'date',
+    Col.PAYEE: 'payee',
+    Col.NARRATION: 'narration',
+    Col.REMARK: 'remark',
+    Col.AMOUNT_DEBIT: 'debit',
+    Col.AMOUNT_CREDIT: 'credit',
+    Col.BALANCE: 'balance',
+}
+
+ALIPAY_CONFIG = {
+    Col.DATE: 'date',
+    Col.PAYEE: 'payee',
+    Col.NARRATION: 'narration',
+    Col.REMARK: 'remark',
+    Col.AMOUNT: 'amount',
+    Col.DRCR: 'drcr',
+    Col.STATUS: 'status',
+}
+
+ASSETS_ACCOUNT = {
+    '支付宝': 'Assets:VirtualCard:Alipay',
+    '余额宝': 'Assets:MoneyFund:Yuebao',
+    '招行储蓄卡|1111': 'Assets:DepositCard:CMB',
+}
+
+DEBIT_ACCOUNT = {
+    'DEFAULT': 'Expenses:Daily:Food',
+    '超市|Market': 'Expenses:Daily:Commodity',
+    '地铁': 'Expenses:Travelling:TransportCard',
+}
+
+
+def csv_field(value):
+    if any(char in value for char in ',"\n'):
+        return '"{}"'.format(value.replace('"', '""'))
+    return value
+
+
+def bank_rows(count=120, divergence=None):
+    """Make the rows of a bank statement, in ascending date order.
+
+    Some rows have the same date, narrations spanning several lines, and the
+    last one too. The balance of the row at the position divergence does not
+    add up.
+    """
+    balance = decimal.Decimal('1000.00')
+    date = datetime.date(2018, 1, 25)
+    rows = []
+    for number in range(count):
+        if number % 3 == 0:
+            date += datetime.timedelta(days=1 + number % 2)
+        payee = ['超市', 'Market, Inc.', '地铁', '工资'][number % 4]
+        narration = ('line one\nline "two"' if number % 7 == 0 or number == count - 1
+                     else '商品 {}'.format(number))
+        debit = credit = ''
+        if payee == '工资':
+            credit = '{}.00'.format(100 + number)
+            balance += decimal.Decimal(credit)
+        else:
+            debit = '{}.{:02d}'.format(number % 50 + 1, number % 100)
+            balance -= decimal.Decimal(debit)
+        reported = balance + 1 if number == divergence else balance
+        remark = '招行储蓄卡' if number % 5 == 0 else ''
+        rows.append([date.isoformat(), payee, narration, remark, debit, credit,
+                     str(reported)])
+    return rows
+
+
+def alipay_rows(count=90):
+    date = datetime.date(2018, 1, 28)
+    rows = []
+    for number in range(count):
+        if number % 2 == 0:
+            date += datetime.timedelta(days=1)
+        drcr = ['支出', '收入', ''][number % 3]
+        remark = ['', '余额宝-招行储蓄卡', '支付宝-花呗', '地铁卡'][number % 4]
+        status = '交易关闭' if number % 11 == 0 else '已支付'
+        rows.append([date.isoformat() + ' 12:{:02d}:00'.format(number % 60),
+                     ['超市', '地铁', '转账'][number % 3], '商品\n{}'.format(number),
+                     remark, '{}.50'.format(number + 1), drcr, status])
+    return rows
+
+
+def write_statement(filename, header, rows, encoding='utf-8', descending=False,
+                    line_ending='\n'):
+    if descending:
+        rows = list(reversed(rows))
+    lines = [','.join(header)] + [','.join(csv_field(field) for field in row)
+                                  for row in rows]
+    with open(filename, 'wb') as outfile:
+        outfile.write((line_ending.join(lines) + line_ending).encode(encoding))
+    return filename
+
+
+def bank_importer(**kwds):
+    return Importer(BANK_CONFIG, 'Assets:DepositCard:CMB', 'CNY',
+                    assets_account=dict(ASSETS_ACCOUNT),
+                    debit_account=dict(DEBIT_ACCOUNT), **kwds)
+
+
+def alipay_importer(**kwds):
+    return Importer(ALIPAY_CONFIG, 'Assets:MoneyFund:Yuebao', 'CNY',
+                    close_flag='交易关闭',
+                    DRCR_dict={Debit_or_credit.DEBIT: '支出', Debit_or_credit.CREDIT: '收入'},
+                    assets_account=dict(ASSETS_ACCOUNT),
+                    debit_account=dict(DEBIT_ACCOUNT), **kwds)
+
+
+def render(entries):
+    """Print the entries with their line numbers, to compare them."""
+    return ['{}:{}'.format(entry.meta['lineno'], printer.format_entry(entry))
+            for entry in entries]
+
+
+def extract_rowwise(importer, file):
+    return importer.extract(file)
+
+
+def extract_streaming(importer, file):
+    # Files larger than PARSED_CACHE_MAX_BYTES are streamed, and the order of
+    # the file is found from its last row read backwards.
+    max_bytes = beanmaker.PARSED_CACHE_MAX_BYTES
+    beanmaker.PARSED_CACHE_MAX_BYTES = 0
+    try:
+        return list(importer.iter_extract(file))
+    finally:
+        beanmaker.PARSED_CACHE_MAX_BYTES = max_bytes
+
+
+def extract_columnar(importer, file):
+    return columnar.extract(importer, file)
+
+
+def extract_parallel(importer, file):
+    # Chunks of a few rows, so that quoted line endings fall near their ends.
+    return parallel.extract(importer, file, jobs=2, chunk_bytes=256)
+
+
+BACKENDS = [extract_streaming, extract_columnar, extract_parallel]
+
+
+# The encodings and orders of the statements.
+STATEMENTS = [pytest.param(encoding, descending,
+                           id='{}-{}'.format(encoding, 'desc' if descending else 'asc'))
+              for encoding in ['utf-8', 'gbk'] for descending in [False, True]]
+
+
+@pytest.mark.parametrize('backend', BACKENDS, ids=lambda backend: backend.__name__)
+@pytest.mark.parametrize('encoding,descending', STATEMENTS)
+@pytest.mark.parametrize('interval', beanmaker.BALANCE_INTERVALS)
+def test_bank_statement(tmp_path, backend, encoding, descending, interval):
+    filename = write_statement(
+        str(tmp_path / 'bank.csv'),
+        ['date', 'payee', 'narration', 'remark', 'debit', 'credit', 'balance'],
+        bank_rows(), encoding, descending, '\r\n' if descending else '\n')
+    file = cache.get_file(filename)
+    expected = render(extract_rowwise(bank_importer(balance_interval=interval), file))
+    assert any(line.split(':', 1)[1].startswith('2018-') and ' balance ' in line
+               for line in expected)
+    assert render(backend(bank_importer(balance_interval=interval), file)) == expected
+
+
+@pytest.mark.parametrize('backend', BACKENDS, ids=lambda backend: backend.__name__)
+@pytest.mark.parametrize('encoding,descending', STATEMENTS)
+def test_alipay_statement(tmp_path, backend, encoding, descending):
+    filename = write_statement(
+        str(tmp_path / 'alipay.csv'),
+        ['date', 'payee', 'narration', 'remark', 'amount', 'drcr', 'status'],
+        alipay_rows(), encoding, descending)
+    file = cache.get_file(filename)
+    expected = render(extract_rowwise(alipay_importer(), file))
+    assert expected
+    assert render(backend(alipay_importer(), file)) == expected
+
+
+@pytest.mark.parametrize('backend', BACKENDS, ids=lambda backend: backend.__name__)
+@pytest.mark.parametrize('descending', [False, True], ids=['asc', 'desc'])
+def test_balance_divergence(tmp_path, caplog, backend, descending):
+    filename = write_statement(
+        str(tmp_path / 'bank.csv'),
+        ['date', 'payee', 'narration', 'remark', 'debit', 'credit', 'balance'],
+        bank_rows(divergence=50), descending=descending)
+    file = cache.get_file(filename)
+    with caplog.at_level(logging.WARNING):
+        extract_rowwise(bank_importer(), file)
+    expected = [record.getMessage() for record in caplog.records
+                if 'does not follow' in record.getMessage()]
+    assert len(expected) == 1
+    caplog.clear()
+    with caplog.at_level(logging.WARNING):
+        backend(bank_importer(), file)
+    assert [record.getMessage() for record in caplog.records
+            if 'does not follow' in record.getMessage()] == expected
+
+
+@pytest.mark.parametrize('backend', BACKENDS, ids=lambda backend: backend.__name__)
+def test_unresolved_transfers(tmp_path, caplog, backend):
+    # The same remarks, payees and narrations on many rows.
+    rows = [row[:2] + ['商品'] + row[3:] for row in alipay_rows()]
+    filename = write_statement(
+        str(tmp_path / 'alipay.csv'),
+        ['date', 'payee', 'narration', 'remark', 'amount', 'drcr', 'status'], rows)
+    file = cache.get_file(filename)
+    with caplog.at_level(logging.WARNING):
+        extract_rowwise(alipay_importer(), file)
+    expected = [record.getMessage() for record in caplog.records
+                if 'not resolved' in record.getMessage()]
+    assert len(expected) == 1
+    caplog.clear()
+    with caplog.at_level(logging.WARNING):
+        backend(alipay_importer(), file)
+    assert [record.getMessage() for record in caplog.records
+            if 'not resolved' in record.getMessage()] == expected
+
+
+@pytest.mark.parametrize('backend', BACKENDS, ids=lambda backend: backend.__name__)
+@pytest.mark.parametrize('descending', [False, True], ids=['asc', 'desc'])
+def test_fingerprint_gaps(tmp_path, caplog, backend, descending):
+    header = ['date', 'payee', 'narration', 'remark', 'debit', 'credit', 'balance']
+    rows = bank_rows()
+    previous = write_statement(str(tmp_path / 'previous.csv'), header, rows[20:60],
+                               descending=descending)
+    filename = write_statement(str(tmp_path / 'bank.csv'), header, rows,
+                               descending=descending)
+    index = str(tmp_path / 'fingerprints.sqlite')
+    bank_importer(fingerprint_index=index).extract(cache.get_file(previous))
+    with open(index, 'rb') as infile:
+        contents = infile.read()
+
+    outputs = []
+    for extract in [extract_rowwise, backend]:
+        with open(index, 'wb') as outfile:
+            outfile.write(contents)
+        with caplog.at_level(logging.WARNING):
+            outputs.append(render(extract(bank_importer(fingerprint_index=index,
+                                                        balance_interval='monthly'),
+                                          cache.get_file(filename))))
+    assert outputs[0] == outputs[1]
+    assert len([line for line in outputs[0] if ' balance ' not in line]) == len(rows) - 40
+    assert not [record for record in caplog.records
+                if 'does not follow' in record.getMessage()]
+
+
+@pytest.mark.parametrize('backend', BACKENDS, ids=lambda backend: backend.__name__)
+@pytest.mark.parametrize('blank', ['', ' '], ids=['empty', 'space'])
+def test_blank_balance(tmp_path, caplog, backend, blank):
+    rows = bank_rows()
+    rows[-1][-1] = blank
+    filename = write_statement(
+        str(tmp_path / 'bank.csv'),
+        ['date', 'payee', 'narration', 'remark', 'debit', 'credit', 'balance'], rows)
+    file = cache.get_file(filename)
+    with caplog.at_level(logging.WARNING):
+        expected = render(extract_rowwise(bank_importer(), file))
+    assert not [line for line in expected if ' balance ' in line]
+    assert not [record for record in caplog.records
+                if 'does not follow' in record.getMessage()]
+    assert render(backend(bank_importer(), file)) == expected
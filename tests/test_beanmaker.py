@@ -0,0 +1,184 @@
+__copyright__ = "Copyright (C) 2018 Dongchao Li"
+__license__ = "GNU GPLv2"
+
+import datetime
+import io
+from decimal import Decimal
+
+import pytest
+from beancount.ingest import importer
+
+import beanmaker
+
+
+def test_signed_amounts():
+    assert beanmaker.convert_amounts('-12.50', None) == (Decimal('-12.50'), None)
+    assert beanmaker.convert_amounts('12.50', None) == (Decimal('-12.50'), None)
+    assert beanmaker.convert_amounts(None, '－３.00') == (None, Decimal('3.00'))
+    assert beanmaker.convert_amounts('¥1,000.00', '+2') == (Decimal('-1000.00'),
+                                                            Decimal('2'))
+
+
+def test_importer_protocol():
+    csv_importer = beanmaker.Importer({beanmaker.Col.DATE: 'date', beanmaker.Col.AMOUNT: 'amount'},
+                                      'Assets:Cash', 'CNY')
+    assert isinstance(csv_importer, importer.ImporterProtocol)
+    assert csv_importer.name() == 'beanmaker.Importer: "Assets:Cash"'
+
+
+def test_running_balance_zero():
+    balances = beanmaker.RunningBalance('card.csv', 'Liabilities:CreditCard:CMB', 'CNY',
+                                        'monthly')
+    assert balances.add(1, datetime.date(2018, 1, 5), Decimal('-100.00'),
+                        Decimal('-100.00'), None) is None
+    assert balances.add(2, datetime.date(2018, 1, 20), Decimal('0.00'),
+                        None, Decimal('100.00')) is None
+    entry = balances.add(3, datetime.date(2018, 2, 3), Decimal('-5.00'), Decimal('-5.00'), None)
+    assert (entry.date, entry.amount.number) == (datetime.date(2018, 2, 1), Decimal('0.00'))
+    assert balances.add(4, datetime.date(2018, 2, 4), Decimal('0.00'),
+                        None, Decimal('5.00')) is None
+    entry = balances.finish(5)
+    assert (entry.date, entry.amount.number) == (datetime.date(2018, 2, 5), Decimal('0.00'))
+    assert balances.divergences == 0
+
+
+# Account maps, and texts matching none, one or several of their keys.
+ACCOUNT_MAPS = {
+    'literal': {
+        'DEFAULT': 'Expenses:Daily:Food',
+        '超市|Market': 'Expenses:Daily:Commodity',
+        '地铁': 'Expenses:Travelling:TransportCard',
+    },
+    'regex': {
+        'DEFAULT': 'Expenses:Daily:Food',
+        r'Steam.*Games?': 'Expenses:Entertainment:Games',
+        r'^\d{4}$': 'Expenses:Daily:Card',
+        '地铁': 'Expenses:Travelling:TransportCard',
+    },
+    'overlapping': {
+        'DEFAULT': 'Expenses:Daily:Food',
+        'Market': 'Expenses:Daily:Commodity',
+        'Super': 'Expenses:Daily:Super',
+        r'Super.*Market': 'Expenses:Daily:Supermarket',
+        'arke': 'Expenses:Daily:Other',
+    },
+    'backreference': {
+        'DEFAULT': 'Expenses:Daily:Food',
+        r'(ab)\1': 'Expenses:Daily:Repeated',
+        r'(x)(y)z': 'Expenses:Daily:Groups',
+        r'(?P<digit>\d)(?P=digit)': 'Expenses:Daily:Digits',
+    },
+    'named groups': {
+        'DEFAULT': 'Expenses:Daily:Food',
+        r'(?P<shop>超市)\d': 'Expenses:Daily:Commodity',
+        r'(?P<shop>Market)s?': 'Expenses:Daily:Market',
+    },
+    'inline flags': {
+        'DEFAULT': 'Expenses:Daily:Food',
+        'Game.': 'Expenses:Entertainment:Other',
+        '(?i)steam': 'Expenses:Entertainment:Games',
+        '(?i:metro)|地铁': 'Expenses:Travelling:TransportCard',
+    },
+}
+
+TEXTS = ['', '午餐', '超市购物', 'Market, Inc.', 'SuperMarket', 'Super', 'marketing',
+         'Steam Games', 'STEAM Game!', 'steam', 'Metro 地铁', '1234', '12345',
+         'ababc', 'abab', 'xyz', 'a11', 'a12', '超市1', 'Markets']
+
+
+@pytest.mark.parametrize('name', list(ACCOUNT_MAPS))
+def test_account_classifier(name):
+    account_map = ACCOUNT_MAPS[name]
+    classifier = beanmaker.AccountClassifier(account_map)
+    for text in TEXTS:
+        assert classifier.classify(text) == beanmaker.mapping_account(account_map, text), text
+    assert classifier.classify(None) == account_map['DEFAULT']
+
+
+def test_account_classifier_unmerged_keys():
+    # Keys which would change meaning or not compile once merged are tried
+    # one by one, the others are still merged.
+    classifier = beanmaker.AccountClassifier(ACCOUNT_MAPS['backreference'])
+    assert [index for index, _ in classifier.patterns] == [0, 2]
+    assert classifier.regexp is not None
+    classifier = beanmaker.AccountClassifier(ACCOUNT_MAPS['named groups'])
+    assert classifier.regexp is None and classifier.merge_error
+    assert [index for index, _ in classifier.patterns] == [0, 1]
+
+
+def liberal_dates(strings, dateutil_kwds=None):
+    from beancount.utils.date_utils import parse_date_liberally
+    return [parse_date_liberally(string, dateutil_kwds or {}) for string in strings]
+
+
+@pytest.mark.parametrize('dateutil_kwds,strings', [
+    ({'dayfirst': True}, ['2018/01/13', '2018/01/14', '2018/02/01', '2018/01/20', '2018/03/04']),
+    ({'dayfirst': True}, ['20180113', '20180114', '20180201', '20180304']),
+    ({}, ['13/01/2018', '14/01/2018', '02/01/2018', '15/01/2018', '03/04/2018']),
+    ({}, ['2018-01-13', '2018-01-14', '2018-02-01', '2018-03-04 10:00']),
+    ({'yearfirst': True}, ['01/13/2018', '01/14/2018', '02/01/2018']),
+], ids=['dayfirst-ymd', 'dayfirst-compact', 'dmy', 'ymd', 'yearfirst-mdy'])
+def test_date_parser_ambiguous(dateutil_kwds, strings):
+    parser = beanmaker.DateParser(dateutil_kwds, samples=2)
+    assert [parser.parse(string) for string in strings] == liberal_dates(strings, dateutil_kwds)
+    assert parser.pattern is not None
+
+
+def test_date_parser_fallback():
+    strings = ['2018-01-13', '2018-01-14', 'Feb 3, 2018', '2018-02-30x', '2018.2.5',
+               '2018-02-04']
+    parser = beanmaker.DateParser(samples=2)
+    assert [parser.parse(string) for string in strings[:2]] == liberal_dates(strings[:2])
+    assert parser.pattern is not None
+    assert [parser.parse(string) for string in strings[2:3] + strings[4:]] == liberal_dates(
+        strings[2:3] + strings[4:])
+    with pytest.raises(ValueError):
+        parser.parse(strings[3])
+
+    # No fixed format agrees with the samples: everything goes through dateutil.
+    parser = beanmaker.DateParser(samples=2)
+    strings = ['Jan 13 2018', 'Jan 14 2018', '2018-01-15']
+    assert [parser.parse(string) for string in strings] == liberal_dates(strings)
+    assert parser.pattern is None
+
+
+def test_date_parser_time():
+    parser = beanmaker.DateParser(want_time=True, samples=2)
+    strings = ['2018-01-13 14:17:00', '2018-01-14 9:05', '2018-02-01 23:59:59', '07:30',
+               '8pm']
+    assert [parser.parse(string) for string in strings] == [
+        '14:17:00', '09:05:00', '23:59:59', '07:30:00', '20:00:00']
+    assert parser.pattern is not None
+
+
+@pytest.mark.parametrize('contents,row', [
+    (b'date,narration\n2018-01-01,a\n2018-01-02,b\n', ['2018-01-02', 'b']),
+    (b'date,narration\r\n2018-01-01,a\r\n2018-01-02,"b\r\nc"\r\n\r\n# end\r\n',
+     ['2018-01-02', 'b\r\nc']),
+    (b'date,narration\n2018-01-01,"x\n2018-01-02,y\n""z"""\n', ['2018-01-01', 'x\n2018-01-02,y\n"z"']),
+    (b'date,narration\n2018-01-01,a\n2018-01-02,"b\n', ['2018-01-02', 'b']),
+    (b'date,narration\n', ['date', 'narration']),
+    (b'', None),
+], ids=['plain', 'quoted', 'quoted-lines', 'unterminated', 'header', 'empty'])
+def test_read_last_row(tmp_path, monkeypatch, contents, row):
+    monkeypatch.setattr(beanmaker, 'TAIL_BLOCK_SIZE', 4)
+    filename = tmp_path / 'statement.csv'
+    filename.write_bytes(contents)
+    assert beanmaker.read_last_row(str(filename)) == row
+
+
+def test_read_last_row_reads_tail(tmp_path, monkeypatch):
+    filename = tmp_path / 'statement.csv'
+    filename.write_text('date,narration\n' + ''.join(
+        '2018-01-01,"line {0}\n""quoted"" {0}"\n'.format(number) for number in range(20000)))
+    sizes = []
+
+    class CountingFile(io.FileIO):
+        def read(self, size=-1):
+            data = super().read(size)
+            sizes.append(len(data))
+            return data
+    monkeypatch.setattr(beanmaker, 'open', lambda name, mode: CountingFile(name, mode[0]),
+                        raising=False)
+    assert beanmaker.read_last_row(str(filename)) == ['2018-01-01', 'line 19999\n"quoted" 19999']
+    assert sum(sizes) <= beanmaker.TAIL_BLOCK_SIZE
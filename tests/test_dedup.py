@@ -0,0 +1,113 @@
+__copyright__ = "Copyright (C) 2018 Dongchao Li"
+__license__ = "GNU GPLv2"
+
+import datetime
+
+from beancount.core import data
+from beancount.core.amount import Amount
+from beancount.core.number import D
+
+import dedup
+
+
+def transaction(filename, lineno, date, payee, narration, number, account, **meta):
+    txn = data.Transaction(dict(data.new_metadata(filename, lineno), **meta), date, '*',
+                           payee, narration, data.EMPTY_SET, data.EMPTY_SET, [])
+    txn.postings.append(data.Posting(account, Amount(D(number), 'CNY'),
+                                     None, None, None, None))
+    return txn
+
+
+def bank(lineno, date, narration, number, **meta):
+    return transaction('bank.csv', lineno, date, None, narration, number,
+                       'Assets:DepositCard:CMB', **meta)
+
+
+def alipay(lineno, date, payee, number, **meta):
+    return transaction('alipay.csv', lineno, date, payee, '商品', number,
+                       'Assets:VirtualCard:Alipay', **meta)
+
+
+def test_differing_counterparties():
+    day = datetime.date(2018, 3, 5)
+    entries_lists = [
+        ('alipay.csv', [alipay(2, day, '北京三快在线科技有限公司', '-35.00'),
+                        alipay(3, day, 'Starbucks Coffee', '-30.00'),
+                        alipay(4, day, '滴滴出行', '-12.00')]),
+        # The bank spells the merchants its own way, and one transaction has
+        # the same amount but another counterparty.
+        ('bank.csv', [bank(2, day, '支付宝-三快在线科技', '35.00'),
+                      bank(3, day, 'STARBUCKS COFFEE SHANGHAI', '30.00'),
+                      bank(4, day, '中国移动话费', '12.00')]),
+    ]
+    assert sorted(dedup.find_duplicates(entries_lists)) == [((1, 0), (0, 0)),
+                                                            ((1, 1), (0, 1))]
+
+
+def test_same_file_not_duplicates():
+    day = datetime.date(2018, 3, 5)
+    entries_lists = [('bank.csv', [bank(2, day, '地铁', '-3.00'),
+                                   bank(3, day, '地铁', '-3.00')])]
+    assert dedup.find_duplicates(entries_lists) == []
+
+
+def test_date_window_across_boundaries():
+    # Buckets are keyed by day: the window spans months and years.
+    pairs = [(datetime.date(2017, 12, 31), datetime.date(2018, 1, 2), True),
+             (datetime.date(2018, 2, 27), datetime.date(2018, 3, 1), True),
+             (datetime.date(2018, 3, 1), datetime.date(2018, 2, 28), True),
+             (datetime.date(2018, 1, 30), datetime.date(2018, 2, 2), False)]
+    for alipay_date, bank_date, duplicate in pairs:
+        entries_lists = [('alipay.csv', [alipay(2, alipay_date, '滴滴出行', '-12.00')]),
+                         ('bank.csv', [bank(2, bank_date, '滴滴出行', '-12.00')])]
+        assert bool(dedup.find_duplicates(entries_lists)) == duplicate, (alipay_date,
+                                                                          bank_date)
+    entries_lists = [('alipay.csv', [alipay(2, datetime.date(2018, 1, 30), '滴滴出行', '-12.00')]),
+                     ('bank.csv', [bank(2, datetime.date(2018, 2, 2), '滴滴出行', '-12.00')])]
+    assert dedup.find_duplicates(entries_lists, window_days=3) == [((1, 0), (0, 0))]
+
+
+def test_closest_date_wins():
+    entries_lists = [
+        ('alipay.csv', [alipay(2, datetime.date(2018, 3, 3), '滴滴出行', '-12.00'),
+                        alipay(3, datetime.date(2018, 3, 5), '滴滴出行', '-12.00')]),
+        ('bank.csv', [bank(2, datetime.date(2018, 3, 5), '滴滴出行', '-12.00'),
+                      bank(3, datetime.date(2018, 3, 4), '滴滴出行', '-12.00')]),
+    ]
+    # Each transaction of the alipay file is matched once.
+    assert dedup.find_duplicates(entries_lists) == [((1, 0), (0, 1)), ((1, 1), (0, 0))]
+
+
+def three_way():
+    day = datetime.date(2018, 3, 5)
+    return [
+        ('alipay.csv', [alipay(2, day, '北京三快在线科技有限公司', '-35.00',
+                               time='12:30:00')]),
+        ('wechat.csv', [transaction('wechat.csv', 7, day, '三快在线', '美团', '-35.00',
+                                    'Assets:VirtualCard:WeChat', tag='food')]),
+        ('bank.csv', [bank(4, day + datetime.timedelta(days=1), '三快在线科技', '35.00',
+                           last4='1111', time='12:31:00')]),
+    ]
+
+
+def test_three_way_duplicates():
+    entries_lists = three_way()
+    assert dedup.find_duplicates(entries_lists) == [((1, 0), (0, 0)), ((2, 0), (0, 0))]
+
+    flagged = dedup.flag_duplicates(entries_lists)
+    assert [[dedup.DUPLICATE_META in entry.meta for entry in entries]
+            for _, entries in flagged] == [[False], [True], [True]]
+    # Flagged duplicates are not matched again.
+    assert dedup.find_duplicates(flagged) == []
+
+
+def test_merge_keeps_meta_of_both():
+    merged = dedup.merge_duplicates(three_way())
+    assert [(key, len(entries)) for key, entries in merged] == [
+        ('alipay.csv', 1), ('wechat.csv', 0), ('bank.csv', 0)]
+    meta = merged[0][1][0].meta
+    assert (meta['filename'], meta['lineno']) == ('alipay.csv', 2)
+    # The metadata of the kept transaction wins over the one of its duplicates.
+    assert meta['time'] == '12:30:00'
+    assert (meta['tag'], meta['last4']) == ('food', '1111')
+    assert meta[dedup.MERGED_META] == 'wechat.csv:7, bank.csv:4'
@@ -0,0 +1,138 @@
+__copyright__ = "Copyright (C) 2018 Dongchao Li"
+__license__ = "GNU GPLv2"
+
+import textwrap
+
+import pytest
+
+import batch
+import fingerprint as fingerprint_module
+from fingerprint import FingerprintIndex, row_fingerprint
+
+
+def test_claim(tmp_path):
+    filename = str(tmp_path / 'fp.sqlite')
+    first, second = row_fingerprint(['1', '2018-01-01']), row_fingerprint(['2', '2018-01-01'])
+    index = FingerprintIndex(filename)
+    assert index.claim(first)
+    # Two identical rows of the same statement are both new.
+    assert index.claim(first)
+    index.commit()
+    assert not index.claim(first)
+    assert index.claim(second)
+    # Dropped without commit.
+    index.close()
+
+    index = FingerprintIndex(filename)
+    assert not index.claim(first)
+    assert index.claim(second)
+    index.close()
+
+
+def test_claim_skips_other_import(tmp_path):
+    filename = str(tmp_path / 'fp.sqlite')
+    fingerprint = row_fingerprint(['1', '2018-01-01'])
+    first = FingerprintIndex(filename)
+    second = FingerprintIndex(filename, timeout=0.1)
+    try:
+        # The claims of an import in progress are skipped without waiting,
+        # and do not hold the other imports.
+        assert first.claim(fingerprint)
+        assert not second.claim(fingerprint)
+        assert second.claim(row_fingerprint(['2', '2018-01-01']))
+        second.commit()
+        # Released if the import fails.
+        first.close()
+        third = FingerprintIndex(filename)
+        assert third.claim(fingerprint)
+        third.close()
+    finally:
+        second.close()
+
+
+def test_claim_abandoned(tmp_path, monkeypatch):
+    filename = str(tmp_path / 'fp.sqlite')
+    fingerprint = row_fingerprint(['1', '2018-01-01'])
+    first = FingerprintIndex(filename)
+    second = FingerprintIndex(filename)
+    try:
+        assert first.claim(fingerprint)
+        monkeypatch.setattr(fingerprint_module, 'CLAIM_TIMEOUT', -1.0)
+        assert second.claim(fingerprint)
+        second.commit()
+    finally:
+        second.close()
+        # Like a process killed, without releasing its claims.
+        first.connection.close()
+
+
+def test_deferred_commits(tmp_path):
+    filename = str(tmp_path / 'fp.sqlite')
+    fingerprint = row_fingerprint(['1', '2018-01-01'])
+    for finish, claimed_again in [(fingerprint_module.release_claims, True),
+                                  (fingerprint_module.commit_claims, False)]:
+        with fingerprint_module.deferred_commits() as claims:
+            index = FingerprintIndex(filename)
+            assert index.claim(fingerprint)
+            index.commit()
+            index.close()
+        assert claims == [(filename, index.token)]
+        other = FingerprintIndex(filename)
+        assert not other.claim(fingerprint)
+        other.close()
+
+        finish(claims)
+        other = FingerprintIndex(filename)
+        assert other.claim(fingerprint) == claimed_again
+        other.close()
+
+
+def write_statement(filename, numbers):
+    with open(filename, 'w') as outfile:
+        outfile.write('id,date,payee,amount\n')
+        for number in numbers:
+            outfile.write('{0},2018-01-{1:02d},Shop {0},{0}.00\n'.format(
+                number, 1 + number % 28))
+
+
+def write_config(tmp_path):
+    config = tmp_path / 'test.config'
+    config.write_text(textwrap.dedent('''\
+        from beanmaker import Col, Importer
+        CONFIG = [Importer({{Col.TXN_ID: 'id', Col.DATE: 'date', Col.PAYEE: 'payee',
+                            Col.AMOUNT: 'amount'}},
+                           'Assets:Bank', 'CNY', fingerprint_index={!r})]
+        '''.format(str(tmp_path / 'fp.sqlite'))))
+    return str(config)
+
+
+def test_batch_overlapping_exports(tmp_path):
+    config = write_config(tmp_path)
+    inbox = tmp_path / 'inbox'
+    inbox.mkdir()
+    write_statement(str(inbox / 'a.csv'), range(0, 5000))
+    write_statement(str(inbox / 'b.csv'), range(2000, 6000))
+
+    results = batch.run(config, [str(inbox)], str(tmp_path / 'Data'), jobs=2)
+    assert sum(len(entries) for _, _, entries in results) == 6000
+    results = batch.run(config, [str(inbox)], str(tmp_path / 'Data'), jobs=2)
+    assert sum(len(entries) for _, _, entries in results) == 0
+
+
+def test_batch_write_failure(tmp_path, monkeypatch):
+    config = write_config(tmp_path)
+    inbox = tmp_path / 'inbox'
+    inbox.mkdir()
+    write_statement(str(inbox / 'a.csv'), range(0, 50))
+    write_statement(str(inbox / 'b.csv'), range(20, 60))
+
+    def write_entries(filename, source, entries):
+        raise OSError("disk full")
+    with monkeypatch.context() as patch:
+        patch.setattr(batch, 'write_entries', write_entries)
+        with pytest.raises(OSError):
+            batch.run(config, [str(inbox)], str(tmp_path / 'Data'), jobs=2)
+
+    # The rows of the entries not written are imported by the next run.
+    results = batch.run(config, [str(inbox)], str(tmp_path / 'Data'), jobs=2)
+    assert sum(len(entries) for _, _, entries in results) == 60
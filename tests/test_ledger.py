@@ -0,0 +1,104 @@
+__copyright__ = "Copyright (C) 2018 Dongchao Li"
+__license__ = "GNU GPLv2"
+
+import datetime
+import os
+import stat
+
+from beancount.core import data
+from beancount.core.amount import Amount
+from beancount.core.number import D
+
+import ledger
+
+
+def file_mode(filename):
+    return stat.S_IMODE(os.stat(filename).st_mode)
+
+
+def test_write_atomically_new_file_mode(tmp_path):
+    filename = str(tmp_path / 'new.beancount')
+    ledger.write_atomically(filename, 'contents\n')
+    assert file_mode(filename) == ledger.NEW_FILE_MODE
+    with open(filename) as infile:
+        assert infile.read() == 'contents\n'
+
+
+def test_write_atomically_keeps_mode(tmp_path):
+    filename = str(tmp_path / '2018.beancount')
+    with open(filename, 'w') as outfile:
+        outfile.write('old\n')
+    os.chmod(filename, 0o664)
+    ledger.write_atomically(filename, b'new\n')
+    assert file_mode(filename) == 0o664
+    with open(filename) as infile:
+        assert infile.read() == 'new\n'
+    assert os.listdir(str(tmp_path)) == ['2018.beancount']
+
+
+def subway_ride(lineno, filename='/statements/2018-01.csv', number='-3.00'):
+    meta = data.new_metadata(filename, lineno)
+    txn = data.Transaction(meta, datetime.date(2018, 1, 15), '*', '地铁', '单程票()',
+                           data.EMPTY_SET, data.EMPTY_SET, [])
+    txn.postings.append(data.Posting('Assets:VirtualCard:Alipay',
+                                     Amount(D(number), 'CNY'), None, None, None, None))
+    return txn
+
+
+def test_sharded_ledger_keeps_identical_rows(tmp_path):
+    root = str(tmp_path / 'Data')
+    include_filename = str(tmp_path / '2018.beancount')
+    with ledger.ShardedLedger(root, include_filename) as shards:
+        assert shards.write([subway_ride(1), subway_ride(2)]) == 2
+    with ledger.ShardedLedger(root, include_filename) as shards:
+        assert shards.write([subway_ride(1), subway_ride(2), subway_ride(3)]) == 1
+
+    filename = ledger.shard_name(root, 'Assets:VirtualCard:Alipay', datetime.date(2018, 1, 1))
+    with open(filename) as infile:
+        assert infile.read().count('地铁') == 3
+    assert ledger.read_sidecar(filename)['count'] == 3
+    with open(include_filename) as infile:
+        assert infile.read() == 'include "Data/Assets/VirtualCard/Alipay/2018-01.beancount"\n'
+
+
+def test_sharded_ledger_crash_before_sync(tmp_path):
+    root = str(tmp_path / 'Data')
+    include_filename = str(tmp_path / '2018.beancount')
+    # Crash after the shard was created, before it was synced and included.
+    shards = ledger.ShardedLedger(root, include_filename)
+    assert shards.write([subway_ride(1)]) == 1
+    for shard in shards.shards.values():
+        shard.close()
+    shards.index.close()
+    assert not os.path.exists(include_filename)
+
+    with ledger.ShardedLedger(root, include_filename) as shards:
+        assert shards.write([subway_ride(1)]) == 1
+    with open(include_filename) as infile:
+        assert infile.read() == 'include "Data/Assets/VirtualCard/Alipay/2018-01.beancount"\n'
+
+
+def test_sharded_ledger_shifted_export(tmp_path):
+    root = str(tmp_path / 'Data')
+    rides = ['-3.00', '-4.00', '-5.00']
+    with ledger.ShardedLedger(root) as shards:
+        assert shards.write([subway_ride(lineno, number=number)
+                             for lineno, number in enumerate(rides, 2)]) == 3
+    # Downloaded again, with a new row at the top of a descending export.
+    with ledger.ShardedLedger(root) as shards:
+        assert shards.write([subway_ride(lineno, '/statements/2018-01 (1).csv', number)
+                             for lineno, number in enumerate(['-6.00'] + rides, 2)]) == 1
+
+    filename = ledger.shard_name(root, 'Assets:VirtualCard:Alipay', datetime.date(2018, 1, 1))
+    with open(filename) as infile:
+        contents = infile.read()
+    assert [number in contents for number in ['-3.00', '-4.00', '-5.00', '-6.00']] == [True] * 4
+    assert contents.count('地铁') == 4
+
+
+def test_sharded_ledger_same_line_other_entry(tmp_path):
+    root = str(tmp_path / 'Data')
+    with ledger.ShardedLedger(root) as shards:
+        assert shards.write([subway_ride(2)]) == 1
+    with ledger.ShardedLedger(root) as shards:
+        assert shards.write([subway_ride(2, number='-7.00')]) == 1
@@ -0,0 +1,84 @@
+__copyright__ = "Copyright (C) 2018 Dongchao Li"
+__license__ = "GNU GPLv2"
+
+import csv
+
+import pytest
+from beancount.ingest import cache
+from beancount.ingest import importer
+
+from beanmaker import Col, Importer
+from registry import ImporterRegistry
+
+
+class TextImporter(importer.ImporterProtocol):
+    """An importer without a config, identifying the files by their name."""
+
+    def identify(self, file):
+        return file.name.endswith('.txt')
+
+
+class BrokenImporter(importer.ImporterProtocol):
+    """An importer whose identify() fails on every file."""
+
+    def identify(self, file):
+        raise ValueError("broken")
+
+
+def make_importers():
+    return [
+        Importer({Col.DATE: 'date', Col.PAYEE: 'payee', Col.AMOUNT: 'amount'},
+                 'Assets:VirtualCard:Alipay', 'CNY'),
+        Importer({Col.DATE: 'date', Col.PAYEE: 'payee', Col.AMOUNT: 'amount',
+                  Col.DRCR: 'drcr'}, 'Assets:MoneyFund:Yuebao', 'CNY'),
+        Importer({Col.DATE: '交易日期', Col.NARRATION: '摘要', Col.AMOUNT_DEBIT: '支出',
+                  Col.AMOUNT_CREDIT: '收入'}, 'Assets:DepositCard:CMB', 'CNY'),
+        Importer({Col.DATE: 0, Col.PAYEE: 1, Col.AMOUNT: 2}, 'Assets:Cash', 'CNY'),
+        TextImporter(),
+        BrokenImporter(),
+    ]
+
+
+def identifies(importer, file):
+    # Like beancount.ingest.identify, which logs the errors of identify().
+    try:
+        return importer.identify(file)
+    except (ValueError, csv.Error):
+        return False
+
+
+FILES = {
+    'shared.csv': 'date,payee,amount,drcr\n2018-01-01,Shop,1.00,支出\n',
+    'subset.csv': 'date, payee ,amount,status\n2018-01-01,Shop,1.00,done\n',
+    'bank.csv': '交易日期,摘要,支出,收入,余额\n2018-01-01,工资,,100.00,100.00\n',
+    'garbage.csv': ('支付宝交易记录明细查询\n账号:[2088]\n'
+                    'date,payee,amount,drcr\n2018-01-01,Shop,1.00,支出\n'),
+    'preamble.csv': ('# Exported 2018-01-31, account 2088\n'
+                     'date,payee,amount\n2018-01-01,Shop,1.00\n'),
+    'headerless.csv': '2018-01-01,Shop,1.00\n2018-01-02,Market,2.00\n',
+    'notes.txt': 'date,payee,amount\n2018-01-01,Shop,1.00\n',
+    'statement.pdf': '%PDF-1.4\n',
+}
+
+
+@pytest.mark.parametrize('name', sorted(FILES))
+def test_match_like_identify(tmp_path, name):
+    filename = tmp_path / name
+    filename.write_text(FILES[name])
+    file = cache.get_file(str(filename))
+
+    expected = [position for position, linear in enumerate(make_importers())
+                if identifies(linear, file)]
+    registry = ImporterRegistry(make_importers())
+    assert [registry.index(matched) for matched in registry.match(file)] == expected
+    assert [position for position, indexed in enumerate(registry)
+            if identifies(indexed, file)] == expected
+
+
+def test_match_shared_header(tmp_path):
+    filename = tmp_path / 'shared.csv'
+    filename.write_text(FILES['shared.csv'])
+    registry = ImporterRegistry(make_importers())
+    # Both Alipay importers, and the one of the column indexes.
+    assert [registry.index(matched)
+            for matched in registry.match(cache.get_file(str(filename)))] == [0, 1, 3]
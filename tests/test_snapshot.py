@@ -0,0 +1,120 @@
+__copyright__ = "Copyright (C) 2018 Dongchao Li"
+__license__ = "GNU GPLv2"
+
+import os
+import runpy
+import textwrap
+from os import path
+
+import pytest
+from beancount.ingest import cache
+from beancount.parser import printer
+
+import beanmaker
+import snapshot
+from registry import ImporterRegistry
+
+
+def test_validate_account_map_merge():
+    account_map = {
+        'DEFAULT': 'Expenses:Daily:Food',
+        r'(?P<shop>超市)\d': 'Expenses:Daily:Commodity',
+        r'(?P<shop>Market)s?': 'Expenses:Daily:Market',
+    }
+    problems = snapshot.validate_account_map('debit_account', account_map,
+                                             'Assets:Cash')
+    assert [level for level, _ in problems] == ['warning']
+    assert 'tried one by one' in problems[0][1]
+
+    del account_map[r'(?P<shop>Market)s?']
+    assert snapshot.validate_account_map('debit_account', account_map, 'Assets:Cash') == []
+
+
+CONFIG = '''\
+from beanmaker import Col, Importer
+CONFIG = [Importer({{Col.DATE: 'date', Col.PAYEE: 'payee', Col.AMOUNT: 'amount',
+                    Col.DRCR: 'drcr'}},
+                   {account!r}, 'CNY', DRCR_dict={{'支出': 'DEBIT', '收入': 'CREDIT'}},
+                   debit_account={{'DEFAULT': 'Expenses:Other',
+                                   '超市|Market': 'Expenses:Daily:Commodity',
+                                   r'(?P<ride>地铁|公交)\\d+': 'Expenses:Transport'}},
+                   credit_account={{'DEFAULT': 'Income:Other'}})]
+'''
+
+
+def write_config(tmp_path, account='Assets:VirtualCard:Alipay'):
+    config = tmp_path / 'test.config'
+    config.write_text(CONFIG.format(account=account))
+    return str(config)
+
+
+def test_compile_config_errors(tmp_path):
+    config = tmp_path / 'test.config'
+    config.write_text(textwrap.dedent('''\
+        from beanmaker import Col, Importer
+        CONFIG = [Importer({Col.PAYEE: 'payee', Col.AMOUNT: 'amount'},
+                           'Assets:Alipay', 'CNY',
+                           debit_account={'DEFAULT': 'Expenses:Other',
+                                          '超市': 'expenses:daily'})]
+        '''))
+    with pytest.raises(snapshot.ConfigError) as exc_info:
+        snapshot.load_config(str(config))
+    message = str(exc_info.value)
+    assert 'config has no Col.DATE column' in message
+    assert 'invalid account name "expenses:daily"' in message
+    assert not path.exists(snapshot.snapshot_name(str(config)))
+
+
+def test_load_config_stale(tmp_path, monkeypatch):
+    config = write_config(tmp_path)
+    importers = snapshot.load_config(config)
+    assert path.exists(snapshot.snapshot_name(config))
+    assert importers[0].default_account == 'Assets:VirtualCard:Alipay'
+
+    # Up to date: loaded without running the config.
+    def compile_config(config_filename):
+        raise AssertionError("compiled again")
+    with monkeypatch.context() as patch:
+        patch.setattr(snapshot, 'compile_config', compile_config)
+        importers = snapshot.load_config(config)
+    assert importers[0].default_account == 'Assets:VirtualCard:Alipay'
+
+    # Same size, older modification time: still stale.
+    stat = os.stat(config)
+    write_config(tmp_path, account='Assets:VirtualCard:Wechat')
+    os.utime(config, ns=(stat.st_atime_ns, stat.st_mtime_ns - 10**9))
+    assert snapshot.load_config(config)[0].default_account == 'Assets:VirtualCard:Wechat'
+    assert snapshot.load_config(config)[0].default_account == 'Assets:VirtualCard:Wechat'
+
+
+def test_load_config_corrupted(tmp_path):
+    config = write_config(tmp_path)
+    snapshot.load_config(config)
+    with open(snapshot.snapshot_name(config), 'r+b') as outfile:
+        outfile.truncate(20)
+    assert snapshot.load_config(config)[0].default_account == 'Assets:VirtualCard:Alipay'
+
+
+def test_snapshot_round_trip(tmp_path):
+    statement = tmp_path / 'alipay.csv'
+    statement.write_text(
+        'date,payee,amount,drcr\n'
+        '2018-01-01,Market,12.50,支出\n'
+        '2018-01-02,地铁12,3.00,支出\n'
+        '2018-01-03,Employer,100.00,收入\n'
+        '2018-01-04,Unknown,1.00,支出\n')
+    config = write_config(tmp_path)
+
+    def extract(importers):
+        file = cache.get_file(str(statement))
+        matched = [importer for importer in importers if importer.identify(file)]
+        assert len(matched) == 1
+        return [printer.format_entry(entry) for entry in matched[0].extract(file)]
+
+    fresh = extract(runpy.run_path(config)['CONFIG'])
+    assert len(fresh) == 4
+    snapshot.compile_config(config)
+    loaded = snapshot.load_config(config)
+    assert isinstance(loaded, ImporterRegistry)
+    beanmaker.clear_parsed_cache()
+    assert extract(loaded) == fresh
@@ -0,0 +1,224 @@
+__copyright__ = "Copyright (C) 2018 Dongchao Li"
+__license__ = "GNU GPLv2"
+
+import asyncio
+import concurrent.futures
+import datetime
+import logging
+import os
+import stat
+import textwrap
+
+from beancount.core import data
+
+import batch
+import ledger
+import watch
+from csvstream import file_identity
+from watch import WatchDaemon
+
+
+def file_mode(filename):
+    return stat.S_IMODE(os.stat(filename).st_mode)
+
+
+def test_write_modes(tmp_path):
+    output_dir = str(tmp_path / 'Data')
+    include_filename = str(tmp_path / '2018.beancount')
+    with open(include_filename, 'w') as outfile:
+        outfile.write('option "title" "Test"\n')
+    os.chmod(include_filename, 0o664)
+    daemon = WatchDaemon('my.config', str(tmp_path), output_dir, include_filename)
+
+    entries = [data.Open(data.new_metadata('a.csv', 1), datetime.date(2018, 1, 1),
+                         'Assets:Cash', None, None)]
+    outname = os.path.join(output_dir, 'a.beancount')
+    daemon._write('a.csv', outname, entries, [])
+    assert file_mode(outname) == ledger.NEW_FILE_MODE
+    assert file_mode(include_filename) == 0o664
+
+    os.chmod(outname, 0o640)
+    daemon._write('a.csv', outname, entries, [])
+    assert file_mode(outname) == 0o640
+    with open(include_filename) as infile:
+        assert infile.read().count('include "Data/a.beancount"') == 1
+
+
+def write_statement(filename, numbers=range(3)):
+    with open(filename, 'w') as outfile:
+        outfile.write('date,payee,amount\n')
+        for number in numbers:
+            outfile.write('2018-01-{:02d},Shop {},{}.00\n'.format(1 + number, number, number))
+
+
+def test_changed_settles_once(tmp_path):
+    inbox = tmp_path / 'inbox'
+    inbox.mkdir()
+    filename = str(inbox / 'a.csv')
+    daemon = WatchDaemon('my.config', str(inbox), str(tmp_path / 'Data'), settle=0.2)
+
+    async def download():
+        daemon.queue = asyncio.Queue()
+        # Written in several steps, each restarting the settle delay.
+        for numbers in [range(1), range(2), range(3)]:
+            write_statement(filename, numbers)
+            os.utime(filename, ns=(0, 10**9 * len(numbers)))
+            daemon.changed(filename)
+            await asyncio.sleep(0.01)
+        daemon.changed(str(inbox / 'notes.txt'))
+        daemon.changed(str(inbox / '.a.csv.part'))
+        await asyncio.sleep(0.5)
+        queued = [daemon.queue.get_nowait() for _ in range(daemon.queue.qsize())]
+
+        # Not queued again while unchanged since imported.
+        daemon.imported[filename] = file_identity(filename)
+        daemon.changed(filename)
+        await asyncio.sleep(0.3)
+        return queued, daemon.queue.qsize(), daemon.timers
+    assert asyncio.run(download()) == ([os.path.abspath(filename)], 0, {})
+
+
+def test_changed_removed_file(tmp_path):
+    inbox = tmp_path / 'inbox'
+    inbox.mkdir()
+    filename = str(inbox / 'a.csv')
+    write_statement(filename)
+    daemon = WatchDaemon('my.config', str(inbox), str(tmp_path / 'Data'), settle=0.05)
+
+    async def remove():
+        daemon.queue = asyncio.Queue()
+        daemon.changed(filename)
+        os.unlink(filename)
+        await asyncio.sleep(0.1)
+        daemon.changed(filename)
+        return daemon.queue.qsize(), daemon.timers
+    assert asyncio.run(remove()) == (0, {})
+
+
+def test_pending_files(tmp_path):
+    inbox = tmp_path / 'inbox'
+    output_dir = tmp_path / 'Data'
+    inbox.mkdir()
+    output_dir.mkdir()
+    for name in ['a.csv', 'b.CSV', 'c.csv', '.d.csv', 'e.txt']:
+        write_statement(str(inbox / name))
+    daemon = WatchDaemon('my.config', str(inbox), str(output_dir))
+    # a.csv was imported after its download, c.csv before.
+    (output_dir / 'a.beancount').write_text('')
+    (output_dir / 'c.beancount').write_text('')
+    os.utime(str(output_dir / 'c.beancount'), (0, 0))
+    assert [os.path.basename(name) for name in daemon.pending_files()] == ['b.CSV', 'c.csv']
+
+
+def test_worker_errors(tmp_path, monkeypatch, caplog):
+    inbox = tmp_path / 'inbox'
+    inbox.mkdir()
+    names = ['bad.csv', 'unknown.csv', 'unwritable.csv', 'good.csv']
+    for name in names:
+        write_statement(str(inbox / name))
+    output_dir = tmp_path / 'Data'
+    daemon = WatchDaemon('my.config', str(inbox), str(output_dir))
+
+    entries = [data.Open(data.new_metadata('a.csv', 1), datetime.date(2018, 1, 1),
+                         'Assets:Cash', None, None)]
+
+    def extract_file(filename):
+        name = os.path.basename(filename)
+        if name == 'bad.csv':
+            raise ValueError("Invalid amount")
+        return filename, None if name == 'unknown.csv' else entries, [(name, 'token')]
+    write_entries = batch.write_entries
+
+    def failing_write_entries(filename, source, entries):
+        if source.endswith('unwritable.csv'):
+            raise OSError("disk full")
+        write_entries(filename, source, entries)
+    committed, released = [], []
+    monkeypatch.setattr(batch, 'extract_file', extract_file)
+    monkeypatch.setattr(batch, 'write_entries', failing_write_entries)
+    monkeypatch.setattr(watch, 'commit_claims', committed.extend)
+    monkeypatch.setattr(watch, 'release_claims', released.extend)
+
+    async def work():
+        daemon.queue = asyncio.Queue()
+        daemon.write_lock = asyncio.Lock()
+        for name in names:
+            daemon.queue.put_nowait(str(inbox / name))
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            worker = asyncio.get_running_loop().create_task(daemon._worker(executor))
+            await daemon.queue.join()
+            worker.cancel()
+            await asyncio.gather(worker, return_exceptions=True)
+    with caplog.at_level(logging.INFO):
+        asyncio.run(work())
+
+    # The worker went on after each failure, and only the good file is
+    # recorded as imported.
+    assert sorted(os.path.basename(name) for name in daemon.imported) == [
+        'good.csv', 'unknown.csv']
+    assert os.listdir(str(output_dir)) == ['good.beancount']
+    assert committed == [('good.csv', 'token')]
+    assert released == [('unwritable.csv', 'token')]
+    messages = [record.getMessage() for record in caplog.records]
+    assert any(message.startswith('Importing {} failed'.format(inbox / 'bad.csv'))
+               for message in messages)
+    assert any(message.startswith('Importing {} failed'.format(inbox / 'unwritable.csv'))
+               for message in messages)
+    assert 'No importer identified {}'.format(inbox / 'unknown.csv') in messages
+
+
+def test_run(tmp_path):
+    config = tmp_path / 'test.config'
+    config.write_text(textwrap.dedent('''\
+        from beanmaker import Col, Importer
+        CONFIG = [Importer({Col.DATE: 'date', Col.PAYEE: 'payee', Col.AMOUNT: 'amount'},
+                           'Assets:Bank', 'CNY')]
+        '''))
+    inbox = tmp_path / 'inbox'
+    inbox.mkdir()
+    output_dir = tmp_path / 'Data'
+    include_filename = str(tmp_path / '2018.beancount')
+    write_statement(str(inbox / 'a.csv'))
+    daemon = WatchDaemon(str(config), str(inbox), str(output_dir), include_filename,
+                         jobs=1, settle=0.05, poll_interval=0.05, polling=True)
+
+    async def serve():
+        stop = asyncio.Event()
+        task = asyncio.get_running_loop().create_task(daemon.run(stop))
+        # The statement already in the inbox, then one downloaded later.
+        await wait_for(lambda: os.path.exists(str(output_dir / 'a.beancount')))
+        write_statement(str(inbox / 'b.csv'))
+        await wait_for(lambda: os.path.exists(str(output_dir / 'b.beancount')))
+        stop.set()
+        await task
+
+    async def wait_for(predicate):
+        for _ in range(400):
+            if predicate():
+                return
+            await asyncio.sleep(0.05)
+        raise AssertionError("timed out")
+    asyncio.run(serve())
+    with open(str(output_dir / 'b.beancount')) as infile:
+        assert infile.read().count('Shop') == 3
+    with open(include_filename) as infile:
+        assert infile.read() == 'include "Data/a.beancount"\ninclude "Data/b.beancount"\n'
+
+
+def test_caches_bounded(tmp_path, monkeypatch):
+    import beanmaker
+    import csvstream
+    from registry import ImporterRegistry
+    importers = ImporterRegistry([beanmaker.Importer(
+        {beanmaker.Col.DATE: 'date', beanmaker.Col.PAYEE: 'payee',
+         beanmaker.Col.AMOUNT: 'amount'}, 'Assets:Bank', 'CNY')])
+    caches = [csvstream._ENCODING_CACHE, beanmaker._HEADER_CACHE, importers.matches]
+    for cache in caches:
+        monkeypatch.setattr(cache, 'maxsize', 2)
+    for number in range(5):
+        filename = str(tmp_path / '{}.csv'.format(number))
+        write_statement(filename)
+        _, entries, _ = batch.extract_file(filename, importers)
+        assert len(entries) == 3
+        assert not beanmaker._PARSED_CACHE
+    assert [len(cache) for cache in caches] == [2, 2, 2]